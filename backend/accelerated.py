@@ -0,0 +1,201 @@
+"""
+Accelerated inference backends (TorchScript, torch.compile, ONNX Runtime) for UVR models
+"""
+
+import getpass
+import hashlib
+import logging
+import os
+import stat
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+BACKEND_EAGER = 'eager'
+BACKEND_TORCHSCRIPT = 'torchscript'
+BACKEND_COMPILE = 'compile'
+BACKEND_ONNX = 'onnx'
+BACKENDS = (BACKEND_EAGER, BACKEND_TORCHSCRIPT, BACKEND_COMPILE, BACKEND_ONNX)
+
+# Exported graphs are specialised to the streaming window: one second of stereo at 44.1 kHz
+EXPORT_SAMPLE_RATE = 44100
+EXPORT_CHANNELS = 2
+EXPORT_FRAMES = 44100
+
+# Largest absolute difference from eager output we still accept from an exported graph
+PARITY_TOLERANCE = 1e-3
+
+ONNX_CACHE_NAME = 'music-separator-onnx'
+
+
+def private_cache_dir(name):
+    """Directory `name` under the temp dir, private to this user (mode 0700), for cached model files.
+
+    The temp dir is shared, so a file another user planted there must never
+    be loaded; raises PermissionError if the directory is not ours alone.
+    """
+    owner = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    path = os.path.join(tempfile.gettempdir(), f"{name}-{owner}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):  # On Windows the temp dir is already per user
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+            raise PermissionError(f"Cache directory {path} is not private to this user")
+    return path
+
+
+def spec_digest(spec):
+    """Short hash of everything that decides a model's network, for naming files cached for it"""
+    identity = repr((spec.model_class, spec.name, spec.metadata, spec.quantize, torch.__version__))
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+
+def reference_chunk():
+    """Deterministic test chunk: a few tones plus low-level noise, already normalised"""
+    t = np.arange(EXPORT_FRAMES, dtype=np.float32) / EXPORT_SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    left = np.sin(2 * np.pi * 220 * t) + 0.5 * np.sin(2 * np.pi * 1760 * t)
+    right = np.sin(2 * np.pi * 330 * t) + 0.5 * np.sin(2 * np.pi * 55 * t)
+    audio = np.stack([left, right]) + 0.05 * rng.standard_normal((EXPORT_CHANNELS, EXPORT_FRAMES))
+    audio = (audio - audio.mean()) / audio.std()
+    return audio[None].astype(np.float32)
+
+
+def _export_torchscript(module, example):
+    traced = torch.jit.trace(module, torch.from_numpy(example), check_trace=False)
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+    def run(batch):
+        with torch.no_grad():
+            return frozen(torch.from_numpy(batch)).numpy()
+    return run
+
+
+def _export_compile(module, example):
+    compiled = torch.compile(module, dynamic=False)
+
+    def run(batch):
+        with torch.no_grad():
+            return compiled(torch.from_numpy(batch)).numpy()
+    run(example)  # Compilation happens on the first call; do it now rather than mid-stream
+    return run
+
+
+def _export_onnx(module, example, spec):
+    if onnxruntime is None:
+        raise RuntimeError("onnxruntime is not installed")
+    path = os.path.join(private_cache_dir(ONNX_CACHE_NAME),
+                        f"{spec.name}-{spec_digest(spec)}-{EXPORT_CHANNELS}x{EXPORT_FRAMES}.onnx")
+    if not os.path.exists(path):
+        export_args = ((torch.from_numpy(example),), path + '.tmp')
+        export_kwargs = {'input_names': ['mix'], 'output_names': ['stems']}
+        try:
+            # The tracing exporter handles the LSTMs in these networks; the dynamo one stalls on them
+            torch.onnx.export(module, *export_args, dynamo=False, **export_kwargs)
+        except TypeError:
+            torch.onnx.export(module, *export_args, **export_kwargs)  # torch < 2.5 has no dynamo flag
+        os.replace(path + '.tmp', path)  # Never leave a half-written graph behind for the next load
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def run(batch):
+        return session.run(None, {'mix': batch})[0]
+    return run
+
+
+def _as_numpy(stem):
+    return stem.cpu().numpy() if hasattr(stem, 'cpu') else np.asarray(stem)
+
+
+class AcceleratedModel:
+    """Wraps a loaded UVR model, running fixed-shape chunks through an exported graph.
+
+    Only chunks of exactly EXPORT_CHANNELS x EXPORT_FRAMES at EXPORT_SAMPLE_RATE
+    take the exported path; anything else (and every chunk when export failed)
+    goes through the wrapped model's own predict(). `report` records which
+    backend is active, why it fell back, and the parity error against the
+    wrapped model's predict() on the reference clip.
+    """
+
+    def __init__(self, model, spec):
+        self.eager = model
+        self.model = getattr(model, 'model', None)  # So size estimates still see the torch module
+        self.quantization_report = getattr(model, 'quantization_report', None)
+        self.backend = BACKEND_EAGER
+        self.sources = None
+        self._run = None
+        self.report = {'requested_backend': spec.backend, 'backend': BACKEND_EAGER}
+        if spec.backend != BACKEND_EAGER:
+            self._export(spec)
+
+    def _export(self, spec):
+        backend = spec.backend
+        module = self.model
+        if not isinstance(module, torch.nn.Module) or not hasattr(module, 'sources') or hasattr(module, 'models'):
+            self.report['fallback_reason'] = "model has no single torch network with a direct forward pass"
+            logger.warning(f"Cannot export {type(self.eager).__name__} to {backend}; using eager mode")
+            return
+
+        example = reference_chunk()
+        started = time.perf_counter()
+        try:
+            module.eval()
+            if backend == BACKEND_TORCHSCRIPT:
+                run = _export_torchscript(module, example)
+            elif backend == BACKEND_COMPILE:
+                run = _export_compile(module, example)
+            elif backend == BACKEND_ONNX:
+                run = _export_onnx(module, example, spec)
+            else:
+                raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+
+            # Parity with what the session would get in eager mode: predict(), with its own
+            # splitting and normalisation, on the reference clip at a typical music level
+            clip = example[0] * 0.25
+            sources = list(module.sources)
+            with torch.no_grad():
+                reference = self.eager.predict(clip, sampling_rate=EXPORT_SAMPLE_RATE)
+            exported = self._predict_exported(run, sources, clip)
+            error = np.concatenate([
+                np.abs(exported[name] - _as_numpy(reference[name])).reshape(-1) for name in sources if name in reference
+            ])
+        except Exception as e:
+            self.report['fallback_reason'] = f"export failed: {e}"
+            logger.warning(f"Export to {backend} failed, using eager mode: {e}", exc_info=True)
+            return
+
+        self.report['export_seconds'] = round(time.perf_counter() - started, 3)
+        self.report['parity'] = {'max_abs_error': float(error.max()), 'mean_abs_error': float(error.mean())}
+        if not np.isfinite(error).all() or error.max() > PARITY_TOLERANCE:
+            self.report['fallback_reason'] = f"parity error above {PARITY_TOLERANCE}"
+            logger.warning(f"{backend} output differs from eager by up to {error.max():.2e}; using eager mode")
+            return
+
+        self.backend = backend
+        self.sources = sources
+        self._run = run
+        self.report['backend'] = backend
+        logger.info(f"Using {backend} backend (parity max {error.max():.2e}, mean {error.mean():.2e})")
+
+    @staticmethod
+    def _predict_exported(run, sources, audio):
+        # Same per-chunk normalisation demucs applies around its forward pass
+        reference = audio.mean(axis=0)
+        mean, std = reference.mean(), reference.std() + 1e-8
+        output = np.asarray(run(((audio - mean) / std)[None].astype(np.float32)))[0]
+        output *= std
+        output += mean
+        return {name: output[index] for index, name in enumerate(sources)}
+
+    def predict(self, audio, sampling_rate=44100):
+        if self._run is None or sampling_rate != EXPORT_SAMPLE_RATE or audio.shape != (EXPORT_CHANNELS, EXPORT_FRAMES):
+            return self.eager.predict(audio, sampling_rate=sampling_rate)
+        return self._predict_exported(self._run, self.sources, audio)
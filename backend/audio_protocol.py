@@ -0,0 +1,140 @@
+"""
+Binary WebSocket frame protocol for streaming PCM audio
+
+Every binary frame is a fixed 24-byte little-endian header followed by raw
+PCM samples (interleaved when channels > 1):
+
+    offset  size  field
+    0       2     magic (b'AS')
+    2       1     protocol version
+    3       1     message type (MSG_AUDIO_DATA / MSG_SEPARATED_AUDIO)
+    4       4     sequence number (uint32)
+    8       4     sample rate (uint32)
+    12      1     channels
+    13      1     sample dtype (DTYPE_FLOAT32 / DTYPE_FLOAT16 / DTYPE_INT16)
+    14      1     stem id (see STEM_IDS, 0 = original mix)
+    15      1     reserved
+    16      8     timestamp in milliseconds (float64)
+
+JSON text messages are still used for 'hello', 'configure', status and errors.
+"""
+
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b'AS'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('<2sBBIIBBBBd')
+HEADER_SIZE = HEADER.size
+
+MSG_AUDIO_DATA = 1
+MSG_SEPARATED_AUDIO = 2
+
+DTYPE_FLOAT32 = 0
+DTYPE_FLOAT16 = 1
+DTYPE_INT16 = 2
+
+DTYPES = {
+    DTYPE_FLOAT32: np.dtype('<f4'),
+    DTYPE_FLOAT16: np.dtype('<f2'),
+    DTYPE_INT16: np.dtype('<i2'),
+}
+DTYPE_CODES = {
+    'float32': DTYPE_FLOAT32,
+    'float16': DTYPE_FLOAT16,
+    'int16': DTYPE_INT16,
+}
+
+STEM_IDS = {
+    'mix': 0,
+    'vocals': 1,
+    'drums': 2,
+    'bass': 3,
+    'other': 4,
+    'instrumental': 5,
+    'remix': 6,  # All stems summed with the client's gains
+}
+STEM_NAMES = {stem_id: name for name, stem_id in STEM_IDS.items()}
+
+PROTOCOL_JSON = 'json'
+PROTOCOL_BINARY = 'binary'
+SUPPORTED_PROTOCOLS = (PROTOCOL_BINARY, PROTOCOL_JSON)
+
+AudioFrame = namedtuple(
+    'AudioFrame',
+    ['msg_type', 'seq', 'sample_rate', 'channels', 'dtype', 'stem', 'timestamp', 'samples']
+)
+
+
+class ProtocolError(ValueError):
+    """Raised when a binary frame cannot be decoded"""
+
+
+def negotiate_protocol(requested):
+    """Pick the first protocol from the client's preference list that we support"""
+    if isinstance(requested, str):
+        requested = [requested]
+    for protocol in requested or []:
+        if protocol in SUPPORTED_PROTOCOLS:
+            return protocol
+    return PROTOCOL_JSON
+
+
+def decode_frame(message):
+    """Decode a binary frame. The returned samples are a zero-copy view of the message"""
+    if len(message) < HEADER_SIZE:
+        raise ProtocolError(f"Frame too short: {len(message)} bytes")
+
+    magic, version, msg_type, seq, sample_rate, channels, dtype_code, stem_id, _, timestamp = \
+        HEADER.unpack_from(message)
+
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic: {magic!r}")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    if dtype_code not in DTYPES:
+        raise ProtocolError(f"Unsupported sample dtype code: {dtype_code}")
+    if channels < 1:
+        raise ProtocolError("Frame declares zero channels")
+
+    dtype = DTYPES[dtype_code]
+    payload_bytes = len(message) - HEADER_SIZE
+    if payload_bytes % (dtype.itemsize * channels):
+        raise ProtocolError(
+            f"Payload of {payload_bytes} bytes is not a whole number of {channels}-channel {dtype.name} frames"
+        )
+
+    samples = np.frombuffer(message, dtype=dtype, offset=HEADER_SIZE)
+    return AudioFrame(msg_type, seq, sample_rate, channels, dtype_code,
+                      STEM_NAMES.get(stem_id, 'mix'), timestamp, samples)
+
+
+def encode_frame(msg_type, samples, seq=0, sample_rate=44100, channels=1, stem='mix',
+                 timestamp=0.0, dtype='float32'):
+    """Encode samples into a binary frame, converting to the wire dtype in a single pass"""
+    dtype_code = DTYPE_CODES[dtype] if isinstance(dtype, str) else dtype
+    wire_dtype = DTYPES[dtype_code]
+    samples = np.asarray(samples)
+
+    frame = bytearray(HEADER_SIZE + samples.size * wire_dtype.itemsize)
+    HEADER.pack_into(frame, 0, MAGIC, PROTOCOL_VERSION, msg_type, seq & 0xFFFFFFFF,
+                     int(sample_rate), channels, dtype_code, STEM_IDS.get(stem, 0), 0,
+                     float(timestamp or 0.0))
+
+    payload = np.frombuffer(frame, dtype=wire_dtype, offset=HEADER_SIZE)
+    if dtype_code == DTYPE_INT16 and samples.dtype.kind == 'f':
+        np.multiply(np.clip(samples.reshape(-1), -1.0, 1.0), 32767.0, out=payload, casting='unsafe')
+    else:
+        payload[:] = samples.reshape(-1)
+    return frame
+
+
+def as_float32(samples):
+    """Return samples as float32 in [-1, 1], without copying when already float32"""
+    if samples.dtype == np.float32:
+        return samples
+    if samples.dtype.kind == 'i':
+        return samples.astype(np.float32) / 32768.0
+    return samples.astype(np.float32)
@@ -0,0 +1,99 @@
+"""
+Cross-session micro-batching of separation calls
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingBatch:
+    def __init__(self, model, sample_rate):
+        self.model = model
+        self.sample_rate = sample_rate
+        self.audios = []
+        self.futures = []
+        self.opened_at = time.perf_counter()
+        self.timer = None
+
+
+class BatchScheduler:
+    """Collects chunks that share a model and shape, and separates them in one call.
+
+    The first chunk for a group opens a batch and starts a `window_ms` timer;
+    the batch is flushed when the timer fires or `max_batch` chunks have
+    joined, whichever comes first. `run_batch(model, audios, sample_rate)`
+    runs in the default executor and returns one stem dict per input, which
+    is handed back to the waiting session. A lone chunk therefore waits at
+    most `window_ms` longer than it would without batching.
+    """
+
+    def __init__(self, run_batch, window_ms=10.0, max_batch=8):
+        self.run_batch = run_batch
+        self.window_seconds = max(0.0, float(window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._pending = {}
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def submit(self, key, model, audio, sample_rate):
+        """Separate [channels, frames] audio, possibly together with other sessions' chunks"""
+        loop = asyncio.get_event_loop()
+        group = (key, sample_rate, audio.shape)
+        batch = self._pending.get(group)
+        if batch is None:
+            batch = _PendingBatch(model, sample_rate)
+            self._pending[group] = batch
+            batch.timer = loop.call_later(self.window_seconds, self._flush, group, batch)
+
+        future = loop.create_future()
+        batch.audios.append(audio)
+        batch.futures.append(future)
+        if len(batch.audios) >= self.max_batch:
+            self._flush(group, batch)
+        return await future
+
+    def _flush(self, group, batch):
+        if self._pending.get(group) is not batch:
+            return  # Already flushed because it filled up
+        del self._pending[group]
+        batch.timer.cancel()
+
+        waited = time.perf_counter() - batch.opened_at
+        self.batches += 1
+        self.items += len(batch.audios)
+        self.largest_batch = max(self.largest_batch, len(batch.audios))
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(None, self.run_batch, batch.model, batch.audios, batch.sample_rate)
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'window_ms': self.window_seconds * 1000.0,
+            'max_batch': self.max_batch,
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': round(self.items / self.batches, 3) if self.batches else 0.0,
+            'largest_batch': self.largest_batch,
+            'mean_wait_ms': round(1000.0 * self.total_wait_seconds / self.batches, 3) if self.batches else 0.0,
+            'max_wait_ms': round(1000.0 * self.max_wait_seconds, 3),
+            'pending_groups': len(self._pending),
+        }
@@ -0,0 +1,500 @@
+"""
+Multi-client load generator and throughput benchmark for server.py and hance_server.py
+
+Opens N WebSocket sessions, streams synthetic or file-sourced audio at a
+controlled multiple of real time, and writes JSON results (latency
+percentiles, sustained real-time factor, drops, server CPU and RSS) that can
+be diffed between releases. With --spawn the server is started here, with
+--mock so it needs neither Hance nor the UVR models:
+
+    python benchmark.py --spawn server.py --mock --clients 8 --duration 30 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import websockets
+
+from audio_protocol import MSG_SEPARATED_AUDIO, MSG_AUDIO_DATA, decode_frame, encode_frame
+from offline_jobs import open_reader
+from resampler import StreamingResampler
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of the results JSON changes
+RESULTS_VERSION = 1
+
+_SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$')
+
+
+def synthetic_audio(seconds, sample_rate, channels=2, seed=0):
+    """Deterministic music-like test signal as [frames, channels] float32: a chord, a bass line, kicks and hats"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / float(sample_rate)
+    chord = sum(np.sin(2 * np.pi * f * t * (1 + 0.002 * np.sin(2 * np.pi * 5 * t))) for f in (261.6, 329.6, 392.0))
+    bass = np.sin(2 * np.pi * np.where((t % 2.0) < 1.0, 55.0, 73.4) * t)
+    beat = t % 0.5
+    kick = np.sin(2 * np.pi * 60 * beat) * np.exp(-beat * 30)
+    hats = rng.standard_normal(len(t)) * np.exp(-((t + 0.25) % 0.5) * 80)
+    mono = 0.12 * chord + 0.25 * bass + 0.4 * kick + 0.05 * hats
+    audio = np.stack([mono * (1.0 - 0.2 * channel) for channel in range(channels)], axis=1)
+    return audio.astype(np.float32)
+
+
+def file_audio(path, sample_rate, channels=2):
+    """A whole audio file as [frames, channels] float32 at sample_rate"""
+    reader = open_reader(path)
+    try:
+        audio = reader.read(reader.frames)
+        source_rate = reader.sample_rate
+    finally:
+        reader.close()
+    if audio.shape[1] < channels:
+        audio = np.repeat(audio[:, :1], channels, axis=1)
+    audio = audio[:, :channels]
+    if source_rate != sample_rate:
+        audio = StreamingResampler(source_rate, sample_rate).process(audio.T).T
+    return np.ascontiguousarray(audio, dtype=np.float32)
+
+
+def summarize_ms(seconds):
+    """Percentiles of a list of durations in seconds, in milliseconds"""
+    if not seconds:
+        return {'count': 0}
+    values = np.asarray(seconds) * 1000.0
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 3),
+        'p50': round(float(np.percentile(values, 50)), 3),
+        'p90': round(float(np.percentile(values, 90)), 3),
+        'p99': round(float(np.percentile(values, 99)), 3),
+        'max': round(float(values.max()), 3),
+    }
+
+
+def parse_metrics(text):
+    """Prometheus text samples as {name: {labels string: value}}"""
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE_PATTERN.match(line.strip())
+        if match is None or line.startswith('#'):
+            continue
+        name, labels, value = match.groups()
+        try:
+            samples.setdefault(name, {})[labels or ''] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+def _metric_total(samples, name):
+    return sum(samples.get(name, {}).values())
+
+
+def _stage_means(before, after):
+    """Mean ms per pipeline stage between two /metrics scrapes"""
+    means = {}
+    sums, counts = after.get('separator_stage_seconds_sum', {}), after.get('separator_stage_seconds_count', {})
+    for labels, total in sums.items():
+        stage = re.search(r'stage="([^"]*)"', labels).group(1)
+        count = counts.get(labels, 0) - before.get('separator_stage_seconds_count', {}).get(labels, 0)
+        seconds = total - before.get('separator_stage_seconds_sum', {}).get(labels, 0)
+        if count > 0:
+            previous = means.get(stage, (0.0, 0))
+            means[stage] = (previous[0] + seconds, previous[1] + count)
+    return {stage: round(1000.0 * seconds / count, 3) for stage, (seconds, count) in sorted(means.items())}
+
+
+class ProcessMonitor:
+    """Samples CPU use and RSS of a process (and, with psutil, its children) in a background thread"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_percent = []
+        self.rss_bytes = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _processes(self):
+        process = psutil.Process(self.pid)
+        return [process] + process.children(recursive=True)
+
+    def _proc_times(self):
+        """CPU seconds and RSS bytes of the process from /proc (children not included)"""
+        with open(f'/proc/{self.pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{self.pid}/statm') as statm:
+            rss = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), rss
+
+    def _run(self):
+        try:
+            if psutil is not None:
+                processes = {process.pid: process for process in self._processes()}
+                for process in processes.values():
+                    process.cpu_percent()
+            else:
+                last_cpu, _ = self._proc_times()
+                last_time = time.perf_counter()
+            while not self._stop.wait(self.interval):
+                if psutil is not None:
+                    for process in self._processes():
+                        if process.pid not in processes:
+                            processes[process.pid] = process
+                            process.cpu_percent()
+                    alive = [process for process in processes.values() if process.is_running()]
+                    self.cpu_percent.append(sum(process.cpu_percent() for process in alive))
+                    self.rss_bytes.append(sum(process.memory_info().rss for process in alive))
+                else:
+                    cpu, rss = self._proc_times()
+                    now = time.perf_counter()
+                    self.cpu_percent.append(100.0 * (cpu - last_cpu) / (now - last_time))
+                    self.rss_bytes.append(rss)
+                    last_cpu, last_time = cpu, now
+        except Exception as e:  # The process went away; keep what was sampled
+            logger.warning(f"Stopped monitoring process {self.pid}: {e}")
+
+    def summary(self):
+        if not self.cpu_percent:
+            return None
+        return {
+            'source': 'psutil (with child processes)' if psutil is not None else 'procfs',
+            'cpu_percent_mean': round(float(np.mean(self.cpu_percent)), 1),
+            'cpu_percent_max': round(float(np.max(self.cpu_percent)), 1),
+            'rss_bytes_max': int(max(self.rss_bytes)),
+            'rss_bytes_last': int(self.rss_bytes[-1]),
+        }
+
+
+class ClientResult:
+    def __init__(self, index):
+        self.index = index
+        self.chunks_sent = 0
+        self.audio_seconds_sent = 0.0
+        self.outputs = 0
+        self.output_seconds = 0.0
+        self.fallback_chunks = 0  # 'mix' stems: the server dropped a chunk and passed its audio through
+        self.errors = []
+        self.latencies = []
+        self.first_send = None
+        self.first_output = None
+        self.last_output = None
+        self.status = None
+
+    def realtime_factor(self):
+        """Seconds of separated audio received per wall second, from the first output to the last"""
+        if self.first_output is None or self.last_output <= self.first_output or self.outputs < 2:
+            return None
+        # The first output's audio arrived at first_output, so it does not count towards the rate
+        return (self.output_seconds - self.output_seconds / self.outputs) / (self.last_output - self.first_output)
+
+    def describe(self):
+        factor = self.realtime_factor()
+        return {
+            'client': self.index,
+            'chunks_sent': self.chunks_sent,
+            'audio_seconds_sent': round(self.audio_seconds_sent, 3),
+            'outputs': self.outputs,
+            'output_seconds': round(self.output_seconds, 3),
+            'realtime_factor': round(factor, 3) if factor is not None else None,
+            'fallback_chunks': self.fallback_chunks,
+            'errors': self.errors[:5],
+            'error_count': len(self.errors),
+            'latency_ms': summarize_ms(self.latencies),
+        }
+
+
+async def run_client(index, args, audio, result):
+    """One session: configure, stream `args.duration` seconds at `args.speed` times real time, collect output"""
+    frames_per_chunk = max(1, int(round(args.chunk_ms * args.sample_rate / 1000.0)))
+    chunk_seconds = frames_per_chunk / float(args.sample_rate)
+    total_chunks = int(args.duration / chunk_seconds)
+    binary = args.protocol == 'binary'
+    sent_at = {}  # client timestamp (ms) -> perf_counter() when the chunk was sent
+    timed_stem = None  # Latency and throughput follow one stem so multi-stem output is not counted twice
+
+    await asyncio.sleep(args.ramp_seconds * index / max(1, args.clients))
+    async with websockets.connect(args.url, max_size=None) as websocket:
+        await websocket.send(json.dumps({'type': 'hello', 'protocols': [args.protocol]}))
+        config = dict(json.loads(args.config), model=args.model)
+        await websocket.send(json.dumps({'type': 'configure', 'config': config}))
+        while result.status is None:
+            reply = json.loads(await asyncio.wait_for(websocket.recv(), args.configure_timeout))
+            if reply['type'] == 'error':
+                result.errors.append(reply.get('error'))
+                return
+            # Models load in the background; progress updates come first, then the one for the active model
+            if reply['type'] == 'status' and reply.get('loading', {}).get('state', 'active') == 'active':
+                result.status = reply
+
+        async def receive():
+            nonlocal timed_stem
+            async for message in websocket:
+                now = time.perf_counter()
+                if isinstance(message, (bytes, bytearray)):
+                    frame = decode_frame(message)
+                    if frame.msg_type != MSG_SEPARATED_AUDIO:
+                        continue
+                    stem, timestamp = frame.stem, frame.timestamp
+                    frames = frame.samples.size // max(1, frame.channels)
+                else:
+                    data = json.loads(message)
+                    if data.get('type') == 'error':
+                        result.errors.append(data.get('error'))
+                        continue
+                    if data.get('type') != 'separated_audio':
+                        continue
+                    stem, timestamp = data['stem'], data['timestamp']
+                    frames = len(data['data']) // max(1, data.get('channels', 1))
+                if stem == 'mix':
+                    result.fallback_chunks += 1
+                    continue
+                if timed_stem is None:
+                    timed_stem = stem
+                if stem != timed_stem:
+                    continue
+                result.outputs += 1
+                result.output_seconds += frames / float(args.sample_rate)
+                if timestamp in sent_at:
+                    result.latencies.append(now - sent_at[timestamp])
+                result.first_output = result.first_output or now
+                result.last_output = now
+
+        receiver = asyncio.ensure_future(receive())
+        started = time.perf_counter()
+        result.first_send = started
+        for chunk in range(total_chunks):
+            # Paced against the start time, so slow sends do not accumulate drift
+            delay = started + chunk * chunk_seconds / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            offset = (chunk * frames_per_chunk) % max(1, len(audio) - frames_per_chunk)
+            samples = audio[offset:offset + frames_per_chunk].reshape(-1)
+            timestamp = time.time() * 1000.0
+            sent_at[timestamp] = time.perf_counter()
+            if binary:
+                await websocket.send(encode_frame(MSG_AUDIO_DATA, samples, seq=chunk, sample_rate=args.sample_rate,
+                                                  channels=audio.shape[1], timestamp=timestamp))
+            else:
+                await websocket.send(json.dumps({'type': 'audio_data', 'data': samples.tolist(),
+                                                 'sample_rate': args.sample_rate, 'channels': audio.shape[1],
+                                                 'timestamp': timestamp}))
+            result.chunks_sent += 1
+            result.audio_seconds_sent += chunk_seconds
+
+        # Let the last windows come back, until output stops for drain_seconds
+        last_seen = -1
+        while result.outputs + result.fallback_chunks != last_seen and not receiver.done():
+            last_seen = result.outputs + result.fallback_chunks
+            await asyncio.sleep(args.drain_seconds)
+        receiver.cancel()
+
+
+def http_get(base_url, path, timeout=5.0):
+    with urllib.request.urlopen(base_url + path, timeout=timeout) as response:
+        return response.read().decode('utf-8')
+
+
+def wait_for_http(base_url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before it was ready")
+        try:
+            http_get(base_url, '/health', timeout=1.0)
+            return
+        except OSError:
+            time.sleep(0.3)
+    raise RuntimeError(f"Server at {base_url} did not answer /health within {timeout}s")
+
+
+def spawn_server(args):
+    """Start the server script in a child process, with the mock engine if asked"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.spawn)
+    command = [sys.executable, script, '--host', args.host, '--port', str(args.port), '--http-port', str(args.http_port)]
+    if args.mock:
+        command += ['--mock-engine', '--mock-rtf', str(args.mock_rtf)]
+    command += args.server_arg
+    logger.info(f"Starting {' '.join(command)}")
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=os.path.dirname(script), stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGINT)  # Lets the server shut its workers down
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def run_clients(args, audio):
+    results = [ClientResult(index) for index in range(args.clients)]
+    outcomes = await asyncio.gather(*(run_client(index, args, audio, result) for index, result in enumerate(results)),
+                                    return_exceptions=True)
+    for result, outcome in zip(results, outcomes):
+        if isinstance(outcome, Exception):
+            result.errors.append(f"{type(outcome).__name__}: {outcome}")
+    return results
+
+
+def run_benchmark(args):
+    """Run the whole benchmark and return the results dict"""
+    if args.audio:
+        audio = file_audio(args.audio, args.sample_rate, args.channels)
+    else:
+        audio = synthetic_audio(min(args.duration, 30.0), args.sample_rate, args.channels, seed=args.seed)
+
+    base_url = f'http://{args.host}:{args.http_port}'
+    process = spawn_server(args) if args.spawn else None
+    try:
+        wait_for_http(base_url, args.startup_timeout, process)
+        pid = process.pid if process is not None else args.server_pid
+        monitor = ProcessMonitor(pid).start() if pid else None
+        try:
+            metrics_before = parse_metrics(http_get(base_url, '/metrics'))
+        except OSError:
+            metrics_before = None
+
+        started = time.perf_counter()
+        results = asyncio.run(run_clients(args, audio))
+        wall_seconds = time.perf_counter() - started
+
+        if monitor is not None:
+            monitor.stop()
+        metrics_after = parse_metrics(http_get(base_url, '/metrics')) if metrics_before is not None else None
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    latencies = [latency for result in results for latency in result.latencies]
+    factors = [result.realtime_factor() for result in results if result.realtime_factor() is not None]
+    report = {
+        'version': RESULTS_VERSION,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'config': {
+            'server': args.spawn or args.url,
+            'mock': bool(args.mock),
+            'mock_rtf': args.mock_rtf if args.mock else None,
+            'server_args': args.server_arg,
+            'clients': args.clients,
+            'duration_seconds': args.duration,
+            'speed': args.speed,
+            'chunk_ms': args.chunk_ms,
+            'sample_rate': args.sample_rate,
+            'channels': args.channels,
+            'protocol': args.protocol,
+            'model': args.model,
+            'configure': json.loads(args.config),
+            'audio': args.audio or f'synthetic (seed {args.seed})',
+        },
+        'wall_seconds': round(wall_seconds, 3),
+        'latency_ms': summarize_ms(latencies),
+        # Per client; at speed 1 a client that keeps up receives one second of audio per second
+        'realtime_factor': {
+            'mean': round(float(np.mean(factors)), 3) if factors else None,
+            'min': round(float(np.min(factors)), 3) if factors else None,
+            'aggregate': round(sum(factors), 3) if factors else None,
+        },
+        'keeping_up': bool(factors) and min(factors) >= 0.95 * args.speed,
+        'chunks_sent': sum(result.chunks_sent for result in results),
+        'outputs': sum(result.outputs for result in results),
+        'fallback_chunks': sum(result.fallback_chunks for result in results),
+        'errors': sum(len(result.errors) for result in results),
+        'server_process': monitor.summary() if monitor is not None else None,
+        'clients': [result.describe() for result in results],
+    }
+    if metrics_after is not None:
+        report['server_metrics'] = {
+            name: _metric_total(metrics_after, f'separator_{name}_total') - _metric_total(metrics_before, f'separator_{name}_total')
+            for name in ('chunks_processed', 'chunks_dropped', 'chunk_errors')
+        }
+        report['server_metrics']['stage_mean_ms'] = _stage_means(metrics_before, metrics_after)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a separation server with concurrent streaming clients")
+    parser.add_argument('--spawn', choices=('server.py', 'hance_server.py'),
+                        help="Start this server for the run (otherwise one must already be listening)")
+    parser.add_argument('--mock', action='store_true', help="Start the spawned server with its mock engine")
+    parser.add_argument('--mock-rtf', type=float, default=10.0, help="Speed of the mock engine (x real time)")
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="Extra argument for the spawned server (repeatable), e.g. --server-arg=--workers=2")
+    parser.add_argument('--server-log', help="File for the spawned server's output")
+    parser.add_argument('--server-pid', type=int, help="PID of an already running server, to sample CPU and RSS")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--http-port', type=int, default=8766)
+    parser.add_argument('--clients', type=int, default=4, help="Concurrent WebSocket sessions")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds of audio each client streams")
+    parser.add_argument('--speed', type=float, default=1.0, help="Streaming rate as a multiple of real time")
+    parser.add_argument('--chunk-ms', type=float, default=185.0, help="Audio per message (the extension sends 8192 frames)")
+    parser.add_argument('--sample-rate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--protocol', choices=('binary', 'json'), default='binary')
+    parser.add_argument('--model', default='htdemucs', help="Model named in configure")
+    parser.add_argument('--config', default='{}', help="Extra configure options as a JSON object")
+    parser.add_argument('--audio', help="Audio file to stream (looped); default is a synthetic signal")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ramp-seconds', type=float, default=1.0, help="Spread client connections over this long")
+    parser.add_argument('--drain-seconds', type=float, default=3.0,
+                        help="After sending, wait until no output arrives for this long")
+    parser.add_argument('--configure-timeout', type=float, default=120.0)
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+    args.url = f'ws://{args.host}:{args.port}'
+    return args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    args = parse_args()
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+        logger.info(f"Results written to {args.output}")
+    else:
+        print(text)
+    logger.info(f"latency p50 {report['latency_ms'].get('p50')} ms, p99 {report['latency_ms'].get('p99')} ms; "
+                f"realtime factor min {report['realtime_factor']['min']}; "
+                f"{report['fallback_chunks']} fallback chunks, {report['errors']} errors")
+
+
+if __name__ == "__main__":
+    main()
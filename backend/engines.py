@@ -0,0 +1,526 @@
+"""
+Separation engines: the model-specific part of the server behind one interface
+"""
+
+import functools
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from inference_pool import InferencePool
+from mock_engine import DEFAULT_REALTIME_FACTOR, MOCK_BANDS, MockHanceEngine, MockSeparator
+from model_registry import ModelRegistry
+from processor_pool import HANCE_STEMS, HanceProcessorPool, sample_rate_from_name
+# uvr_models also puts ultimatevocalremover_api on sys.path
+from uvr_models import (
+    Demucs, VrNetwork, MDX, MDXC, DEFAULT_MODEL, describe_model, estimate_model_bytes, load_uvr_model,
+    resolve_model_spec, separate_batch, separate_chunk
+)
+
+# Installed on demand by hance_server.py unless the mock engine is used
+try:
+    import hance
+except ImportError:
+    hance = None
+
+logger = logging.getLogger(__name__)
+
+HANCE_MODELS_DIR = Path(__file__).parent.parent / "hance-api" / "Models"
+
+
+def install_hance():
+    global hance
+    print("Hance API not installed. Installing...")
+    os.system("pip install hance")
+    import hance
+    return hance
+
+
+class PreparedModel:
+    """A model an engine has made ready for a session, waiting to be attached to it"""
+
+    def __init__(self, model_name, model=None, model_key=None, message=None, status=None):
+        self.model_name = model_name
+        self.model = model
+        self.model_key = model_key
+        self.message = message or f'Model {model_name} loaded/configured successfully'
+        self.status = status or {}  # Engine-specific fields for the client's status message
+        self.worker_index = None  # Inference worker assigned to the session for this model, if a new one was
+
+
+class SeparationEngine:
+    """One family of separation models, as the server core sees it.
+
+    Engines declare how their models want audio and the core plans around it:
+    `stateful` engines keep streaming state between calls, so they get
+    back-to-back chunks of whole native blocks; stateless ones get overlapping
+    windows with `context_seconds` on each side, stitched with overlap-add and
+    eligible for the stem cache. `supports_batching` lets chunks of sessions
+    sharing a model go through separate_batch() together. timing() gives the
+    native block (the window, for stateless engines) and the model's own delay.
+    `remix_stems` are passed to separate() as the wanted stems in remix mode.
+
+    Configuring runs off the event loop and never touches what the session
+    is using: warm() does the slow part shared by every session that wants a
+    model (loading weights, probing a processor), coalesced by load_key();
+    prepare() then gets this session its own handle, a cache hit by then.
+    attach() switches the session over between chunks, on the event loop, and
+    discard() gives back a prepared model that was superseded before that.
+    separate() runs in an executor thread and returns
+    {stem: [channels, frames] array}.
+    """
+
+    name = None
+    stems = ()  # Stems the engine's models can produce
+    stateful = False
+    supports_batching = False
+    default_model = None
+    context_seconds = 0.0
+    remix_stems = None  # Stems the remix is summed from; None for every stem the model produces
+
+    def available(self):
+        return True
+
+    def native_rate(self, model_name):
+        return 44100
+
+    def timing(self, model_name):
+        """Native block and algorithmic latency of a model, in seconds"""
+        raise NotImplementedError
+
+    def list_models(self):
+        return {}
+
+    def describe(self):
+        return {
+            'name': self.name,
+            'available': self.available(),
+            'stems': list(self.stems),
+            'stateful': self.stateful,
+            'supports_batching': self.supports_batching,
+            'context_ms': round(self.context_seconds * 1000.0, 3),
+            'default_model': self.default_model,
+        }
+
+    def load_key(self, config):
+        """What identifies the model `config` asks for; configures with equal keys share one warm()"""
+        return config.get('model', self.default_model)
+
+    def warm(self, config):
+        """Load the model `config` asks for into the engine's caches (blocking)"""
+
+    def prepare(self, session, config):
+        """The session's handle on a warm model (blocking); returns a PreparedModel"""
+        raise NotImplementedError
+
+    def attach(self, session, prepared):
+        """Switch the session to a prepared model, giving back the one it had"""
+        self.release(session)
+        session.model = prepared.model
+        session.model_key = prepared.model_key
+        session.model_name = prepared.model_name
+
+    def release(self, session):
+        """Give back the session's model handle"""
+        session.model = None
+        session.model_key = None
+
+    def discard(self, session, prepared):
+        """Give back a prepared model that was never attached"""
+
+    def close(self, session):
+        """The session disconnected or moved to another engine"""
+        self.release(session)
+
+    def cache_key(self, session):
+        """What identifies the session's model in the stem cache; None keeps its output out of the cache"""
+        return None if self.stateful else session.model_key
+
+    def separate(self, session, audio, sample_rate, wanted=None):
+        """Separate [channels, frames] audio (blocking); `wanted` is the stems the session needs, None for all"""
+        raise NotImplementedError
+
+    def separate_batch(self, model, audio_batch, sample_rate):
+        """One stem dict per [channels, frames] input, all through `model` at once (blocking)"""
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class UVREngine(SeparationEngine):
+    """Ultimate Vocal Remover models: Demucs, MDX, VR network and MDXC.
+
+    Stateless 1 second windows at 44.1 kHz. Loaded models are shared between
+    sessions through the registry, or live in worker processes when
+    `inference_workers` is set; batching only applies without workers, since
+    the workers already run sessions in parallel.
+    """
+
+    name = 'uvr'
+    stems = ('vocals', 'drums', 'bass', 'other', 'instrumental')
+    default_model = DEFAULT_MODEL
+    model_sample_rate = 44100  # UVR models are trained on 44.1 kHz audio; other rates are resampled
+    window_seconds = 1.0  # The streaming segment separate_chunk accepts
+    context_seconds = 0.125
+
+    def __init__(self, memory_manager, model_cache_bytes=2 * 1024 ** 3, inference_workers=0, offline_workers=1,
+                 memory_budget_bytes=4 * 1024 ** 3, mock_realtime_factor=None):
+        self.memory_manager = memory_manager
+        # When set, every model is the mock separator running at this speed (for benchmarks)
+        self.mock_realtime_factor = mock_realtime_factor
+
+        # Loaded models are shared between sessions and kept around after a switch
+        self.model_registry = ModelRegistry(load_uvr_model, model_cache_bytes, size_fn=estimate_model_bytes)
+
+        # Optional worker processes so sessions run inference in parallel, outside this interpreter
+        self.inference_pool = None
+        if inference_workers > 0:
+            self.inference_pool = InferencePool(
+                inference_workers, load_uvr_model, separate_chunk,
+                size_fn=estimate_model_bytes, describe_fn=describe_model, model_cache_bytes=model_cache_bytes,
+                memory_budget_bytes=memory_budget_bytes, offline_workers=offline_workers
+            )
+        self.supports_batching = self.inference_pool is None
+
+    def available(self):
+        return self.mock_realtime_factor is not None or Demucs is not None
+
+    def native_rate(self, model_name):
+        return self.model_sample_rate
+
+    def timing(self, model_name):
+        return {'block_seconds': self.window_seconds, 'latency_seconds': 0.0, 'source': 'engine'}
+
+    def list_models(self):
+        if self.mock_realtime_factor is not None:
+            return {'mock': MockSeparator.list_models()}
+        return {
+            'demucs': Demucs.list_models(),
+            'vr_network': VrNetwork.list_models(),
+            'mdx': MDX.list_models(),
+            'mdxc': MDXC.list_models()
+        }
+
+    def resolve(self, config, offline=False):
+        # Force CPU usage completely
+        return resolve_model_spec(config, device='cpu', offline=offline, mock_realtime_factor=self.mock_realtime_factor)
+
+    def load_key(self, config):
+        return self.resolve(config)
+
+    def warm(self, config):
+        if self.inference_pool is not None:
+            return  # Each worker process loads its own copy in prepare(), and caches it for its other sessions
+        # Kept in the registry unreferenced (and not evicted) until the session's prepare() takes it over
+        self.model_registry.warm(self.resolve(config))
+
+    def prepare(self, session, config):
+        model_name = config.get('model', self.default_model)
+        spec = self.resolve(config)
+        if spec.name != model_name:
+            model_name = f'{spec.name} (defaulted due to unknown type)'
+
+        assigned = None
+        if self.inference_pool is not None:
+            # The session's worker process loads (or reuses) the weights; we only keep the spec.
+            # A session keeps its worker across model switches.
+            worker_index = session.worker_index
+            if worker_index is None:
+                worker_index = assigned = self.inference_pool.assign()
+            try:
+                model_info = self.inference_pool.load(worker_index, spec)
+            except Exception:
+                self.inference_pool.unassign(assigned)
+                raise
+            model, model_key = spec, None
+        else:
+            # Reuses an already loaded model with the same spec; otherwise loads it
+            model = self.model_registry.acquire(spec)
+            model_info = describe_model(model)
+            model_key = spec
+        prepared = PreparedModel(
+            model_name, model, model_key,
+            message=f'Model {model_name} loaded/configured successfully (CPU mode for memory efficiency)',
+            status={'backend': model_info['backend'], 'quantization': model_info['quantization'],
+                    'batching': model_info.get('batching')}
+        )
+        prepared.worker_index = assigned
+        return prepared
+
+    def attach(self, session, prepared):
+        super().attach(session, prepared)
+        if self.inference_pool is None:
+            return
+        if prepared.worker_index is not None:
+            self.inference_pool.unassign(session.worker_index)
+            session.worker_index = prepared.worker_index
+        elif session.worker_index is None:
+            # The worker it was loaded on was given back meanwhile; another one loads it on first use
+            session.worker_index = self.inference_pool.assign()
+
+    def release(self, session):
+        self.model_registry.release(session.model_key)
+        super().release(session)
+
+    def discard(self, session, prepared):
+        self.model_registry.release(prepared.model_key)
+        if self.inference_pool is not None:
+            self.inference_pool.unassign(prepared.worker_index)
+
+    def close(self, session):
+        self.release(session)
+        if self.inference_pool is not None and session.worker_index is not None:
+            self.inference_pool.unassign(session.worker_index)
+            session.worker_index = None
+
+    def cache_key(self, session):
+        return session.model if self.inference_pool is not None else session.model_key
+
+    def separate(self, session, audio, sample_rate, wanted=None):
+        if self.inference_pool is not None:
+            # Audio goes to the session's worker process through shared memory. A profile of
+            # this call only shows the wait; the model itself runs in the worker.
+            return self.inference_pool.run(session.worker_index, session.model, audio, sample_rate,
+                                           max_seconds=self.window_seconds)
+        # Windows are cut to the chunk plan (timing()), so the cap only trims malformed input
+        return separate_chunk(session.model, audio, sample_rate, memory_manager=self.memory_manager,
+                              max_seconds=self.window_seconds)
+
+    def separate_batch(self, model, audio_batch, sample_rate):
+        return separate_batch(model, audio_batch, sample_rate, memory_manager=self.memory_manager,
+                              max_seconds=self.window_seconds)
+
+    def open_offline_model(self, spec):
+        """Model handle for an offline job: a worker process (an offline one if kept) if there are any, else a registry model"""
+        if self.inference_pool is not None:
+            worker_index = self.inference_pool.assign(offline=True)
+            try:
+                self.inference_pool.load(worker_index, spec)
+            except Exception:
+                self.inference_pool.unassign(worker_index)
+                raise
+            return worker_index, spec, None
+        return None, spec, self.model_registry.acquire(spec)
+
+    def run_offline_window(self, handle, audio, sample_rate):
+        """Separate one full-length offline window (blocking), without the real-time 1 second cap"""
+        worker_index, spec, model = handle
+        if self.inference_pool is not None:
+            return self.inference_pool.run(worker_index, spec, audio, sample_rate, timeout=600, max_seconds=None)
+        return separate_chunk(model, audio, sample_rate, memory_manager=self.memory_manager, max_seconds=None)
+
+    def close_offline_model(self, handle):
+        worker_index, spec, model = handle
+        if self.inference_pool is not None:
+            self.inference_pool.unassign(worker_index)
+        else:
+            self.model_registry.release(spec)
+
+    def start(self):
+        if self.inference_pool is not None:
+            self.inference_pool.start()
+
+    def shutdown(self):
+        if self.inference_pool is not None:
+            self.inference_pool.close()
+
+
+class HanceEngine(SeparationEngine):
+    """Hance models: stateful processors with a short native block, designed for real time.
+
+    One Hance engine per process; processors are pooled per (model, channels,
+    sample rate). prepare() takes a processor for the session's current
+    stream format, so a model switch finds it ready; if the format turns out
+    different, the next separate() call swaps it, out of reach of a running
+    call.
+    """
+
+    name = 'hance'
+    stems = HANCE_STEMS
+    stateful = True
+    default_model = 'music_stem_fast'
+    # The other stems are scaled copies of these two, so the remix only needs them
+    remix_stems = frozenset(('vocals', 'instrumental'))
+
+    # Available models mapping
+    models = {
+        'stem_separation': 'stem_separation-44.1kHz-209ms.hance',
+        'music_stem_large': 'music-stem-separation-44.1kHz-209ms-large.hance',
+        'music_stem_fast': 'music-stem-separation-70ms-large.hance'
+    }
+
+    # Requests for UVR models are served by the closest Hance model
+    uvr_to_hance = {
+        'hdemucs_mmi': 'music_stem_fast',
+        'htdemucs': 'music_stem_fast',
+        'htdemucs_ft': 'music_stem_fast',
+        'mdx_extra': 'music_stem_large',
+        'mdx': 'music_stem_large'
+    }
+
+    def __init__(self, models_dir=HANCE_MODELS_DIR, mock_realtime_factor=None):
+        self.models_dir = Path(models_dir)
+        # When set, a mock engine running at this speed replaces Hance (for benchmarks)
+        self.mock_realtime_factor = mock_realtime_factor
+        if mock_realtime_factor is not None:
+            engine_factory = functools.partial(MockHanceEngine, mock_realtime_factor)
+        else:
+            engine_factory = self._create_engine
+        self.processor_pool = HanceProcessorPool(engine_factory)
+
+    @staticmethod
+    def _create_engine():
+        if hance is None:
+            raise RuntimeError("The Hance API is not installed (pip install hance, or start hance_server.py)")
+        return hance.HanceEngine()
+
+    def available(self):
+        return self.mock_realtime_factor is not None or hance is not None
+
+    def native_rate(self, model_name):
+        return sample_rate_from_name(model_name)
+
+    def timing(self, model_name):
+        return self.processor_pool.timing(model_name, 2, self.native_rate(model_name))
+
+    def list_models(self):
+        return {
+            'hance_models': [str(model_file) for model_file in self.models_dir.glob("*.hance")
+                             if "stem" in model_file.name.lower()],
+            'default_models': self.models
+        }
+
+    def resolve(self, model_name):
+        """Path of the model file for a Hance model name, file name or path"""
+        # If the requested model is a UVR model, map it to a Hance model
+        if model_name in self.uvr_to_hance:
+            logger.info(f"Converting UVR model name '{model_name}' to Hance model '{self.uvr_to_hance[model_name]}'")
+            model_name = self.uvr_to_hance[model_name]
+        model_file = self.models.get(model_name, model_name)  # Else assume it's a direct path or filename
+
+        possible_paths = [
+            self.models_dir / model_file,                 # Direct path
+            self.models_dir / (model_file + ".hance"),    # Add extension if missing
+            Path(model_file)                              # Absolute path provided
+        ]
+        for path in possible_paths:
+            if path.exists():
+                return path
+        if self.mock_realtime_factor is not None:
+            return Path(model_file)  # The mock engine never opens the file
+        available_models = [f.name for f in self.models_dir.glob("*.hance")]
+        raise FileNotFoundError(f"Model file not found: {model_file}. Available models: {available_models}")
+
+    def load_key(self, config):
+        return str(self.resolve(config.get('model', self.default_model)))
+
+    def warm(self, config):
+        model_path = self.resolve(config.get('model', self.default_model))
+        logger.info(f"Loading Hance model: {model_path}")
+        # Probes a processor for the buses and timing, and leaves it pooled
+        self.processor_pool.timing(model_path, 2, sample_rate_from_name(model_path))
+
+    def prepare(self, session, config):
+        model_path = self.resolve(config.get('model', self.default_model))
+        native_rate = sample_rate_from_name(model_path)
+        sample_rate = native_rate if config.get('resample', True) else session.sample_rate
+        model_key, processor = self.processor_pool.acquire(model_path, session.channels, sample_rate)
+        return PreparedModel(str(model_path), processor, model_key,
+                             message=f'Hance model {model_path.name} loaded successfully',
+                             status={'buses': self.processor_pool.bus_names(model_path, 2, native_rate)})
+
+    def release(self, session):
+        self.processor_pool.release(session.model_key, session.model)
+        super().release(session)
+
+    def discard(self, session, prepared):
+        self.processor_pool.release(prepared.model_key, prepared.model)
+
+    def ensure_processor(self, session, channels, sample_rate):
+        """The session's processor for this stream format, swapping it via the pool if the format changed"""
+        key = (session.model_name, int(channels), int(sample_rate))
+        if session.model is not None and session.model_key == key:
+            return session.model
+
+        self.release(session)
+        session.model_key, session.model = self.processor_pool.acquire(session.model_name, channels, sample_rate)
+        logger.info(f"Session {session.id}: using Hance processor for {channels} ch at {sample_rate} Hz")
+        return session.model
+
+    def separate(self, session, audio, sample_rate, wanted=None):
+        processor = self.ensure_processor(session, audio.shape[0], sample_rate)
+        # audio.T is the [frames, channels] ring buffer view, the layout Hance expects
+        stem_names, separated = run_hance_separation(
+            processor, audio.T, self.processor_pool.routing(session.model_name), wanted)
+        return dict(zip(stem_names, separated.T[:, None, :]))
+
+
+def run_hance_separation(processor, audio_input, routing, wanted=None):
+    """Run Hance separation (much faster and more efficient than UVR).
+
+    `routing` is the model's bus-to-stem matrix from the processor pool, so
+    every stem comes out of one matrix multiply. `wanted` is the session's
+    stem subscription (None for all); only those columns are computed.
+    Returns the stem names and a [frames, stems] array.
+    """
+    stem_names = list(HANCE_STEMS)
+    if wanted is not None:
+        columns = [index for index, stem_name in enumerate(stem_names) if stem_name in wanted]
+        stem_names = [stem_names[index] for index in columns]
+        routing = routing[:, columns]
+
+    processed_audio = processor.process(audio_input)
+    frames = min(len(processed_audio), len(audio_input))
+    processed_audio = np.asarray(processed_audio, dtype=np.float32).reshape(len(processed_audio), -1)
+
+    # Model output buses followed by the input mix, the layout the routing matrix expects
+    num_buses = routing.shape[0] - 1
+    produced = min(num_buses, processed_audio.shape[1])
+    sources = np.zeros((frames, num_buses + 1), dtype=np.float32)
+    sources[:, :produced] = processed_audio[:frames, :produced]
+    np.mean(audio_input[:frames], axis=1, out=sources[:, num_buses])
+    return stem_names, sources @ routing
+
+
+class MockEngine(SeparationEngine):
+    """The band-splitting mock separator (mock_engine.py) as an engine of its own.
+
+    Needs no model files, so any model name works; `realtime_factor` in
+    configure sets how fast it runs. Half-second windows keep its latency
+    between the other two engines.
+    """
+
+    name = 'mock'
+    stems = tuple(stem_name for stem_name, _, _ in MOCK_BANDS)
+    default_model = 'mock'
+    window_seconds = 0.5
+    context_seconds = 0.05
+
+    def __init__(self, realtime_factor=DEFAULT_REALTIME_FACTOR):
+        self.realtime_factor = realtime_factor
+
+    def timing(self, model_name):
+        return {'block_seconds': self.window_seconds, 'latency_seconds': 0.0, 'source': 'engine'}
+
+    def list_models(self):
+        return {'mock': MockSeparator.list_models()}
+
+    def load_key(self, config):
+        return (config.get('model', self.default_model), float(config.get('realtime_factor', self.realtime_factor)))
+
+    def prepare(self, session, config):
+        realtime_factor = float(config.get('realtime_factor', self.realtime_factor))
+        if realtime_factor < 0:
+            raise ValueError(f"realtime_factor must not be negative, got {realtime_factor:g}")
+        model = MockSeparator(config.get('model', self.default_model), {'realtime_factor': realtime_factor})
+        return PreparedModel(model.name, model, ('mock', model.name, realtime_factor),
+                             status={'realtime_factor': realtime_factor})
+
+    def separate(self, session, audio, sample_rate, wanted=None):
+        return session.model.predict(audio, sample_rate)
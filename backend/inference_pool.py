@@ -0,0 +1,270 @@
+"""
+Process-pool inference workers with shared-memory audio transfer
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCrashedError(RuntimeError):
+    """Raised for the job that was running when a worker process died"""
+
+
+def _worker_main(worker_id, conn, input_name, output_name, output_floats, loader, separate_fn,
+                 size_fn, describe_fn, model_cache_bytes, memory_budget_bytes):
+    """Worker process loop: keep models loaded and separate audio found in shared memory"""
+    from memory_manager import MemoryManager
+    from model_registry import ModelRegistry
+
+    logging.basicConfig(level=logging.INFO)
+    input_shm = shared_memory.SharedMemory(name=input_name)
+    output_shm = shared_memory.SharedMemory(name=output_name)
+    registry = ModelRegistry(loader, model_cache_bytes, size_fn=size_fn)
+    memory_manager = MemoryManager(memory_budget_bytes) if memory_budget_bytes else None
+    logger.info(f"Inference worker {worker_id} started")
+
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            op = message[0]
+            if op == 'stop':
+                break
+
+            try:
+                if op == 'load':
+                    _, spec = message
+                    model = registry.acquire(spec)
+                    registry.release(spec)
+                    conn.send(('ok', describe_fn(model) if describe_fn else None, None))
+                elif op == 'separate':
+                    _, spec, shape, sample_rate, options = message
+                    audio = np.ndarray(shape, dtype=np.float32, buffer=input_shm.buf)
+                    model = registry.acquire(spec)
+                    try:
+                        stems = separate_fn(model, audio, sample_rate, memory_manager=memory_manager, **options)
+                    finally:
+                        registry.release(spec)
+
+                    names = list(stems.keys())
+                    arrays = [stem.cpu().numpy() if hasattr(stem, 'cpu') else np.asarray(stem, dtype=np.float32)
+                              for stem in stems.values()]
+                    out_shape = (len(arrays),) + arrays[0].shape
+                    if int(np.prod(out_shape)) > output_floats:
+                        raise ValueError(f"Separated output {out_shape} does not fit the worker's output buffer")
+                    out = np.ndarray(out_shape, dtype=np.float32, buffer=output_shm.buf)
+                    for index, array in enumerate(arrays):
+                        out[index] = array
+                    conn.send(('ok', names, out_shape))
+                else:
+                    conn.send(('error', f"Unknown worker op: {op}", None))
+            except Exception as e:
+                logger.error(f"Inference worker {worker_id} failed: {e}", exc_info=True)
+                conn.send(('error', str(e), None))
+    finally:
+        input_shm.close()
+        output_shm.close()
+
+
+class _WorkerSlot:
+    def __init__(self, index, input_shm, output_shm):
+        self.index = index
+        self.input_shm = input_shm
+        self.output_shm = output_shm
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()  # One job at a time per worker
+        self.sessions = 0
+        self.jobs = 0
+        self.restarts = 0
+        self.busy_seconds = 0.0
+
+
+class InferencePool:
+    """Fixed set of worker processes, each holding its own loaded models.
+
+    Audio moves through two shared-memory blocks per worker (input and stacked
+    stem output); only small control tuples go over the pipe. Sessions are
+    pinned to the least-loaded worker when they connect, so a session's model
+    stays warm in one process while other sessions run in parallel elsewhere.
+    `offline_workers` more processes are kept for offline jobs, whose long
+    windows would otherwise hold a live session's worker for seconds at a
+    time. A worker that dies is restarted and the job it was running fails
+    with WorkerCrashedError.
+    """
+
+    def __init__(self, num_workers, loader, separate_fn, size_fn=None, describe_fn=None, max_frames=480000,
+                 max_channels=2, max_stems=6, model_cache_bytes=2 * 1024 ** 3, memory_budget_bytes=None,
+                 job_timeout=60.0, offline_workers=0):
+        self.num_workers = int(num_workers)
+        self.offline_workers = int(offline_workers)  # After the live ones; 0 runs offline jobs on live workers
+        self.loader = loader
+        self.separate_fn = separate_fn
+        self.size_fn = size_fn
+        self.describe_fn = describe_fn
+        self.max_frames = int(max_frames)
+        self.max_channels = int(max_channels)
+        self.max_stems = int(max_stems)
+        self.model_cache_bytes = model_cache_bytes
+        self.memory_budget_bytes = memory_budget_bytes  # Per worker process
+        self.job_timeout = job_timeout
+        self._context = multiprocessing.get_context('spawn')
+        self._slots = []
+        self._assign_lock = threading.Lock()
+
+    @property
+    def input_floats(self):
+        return self.max_frames * self.max_channels
+
+    @property
+    def output_floats(self):
+        return self.max_stems * self.max_frames * self.max_channels
+
+    def start(self):
+        for index in range(self.num_workers + self.offline_workers):
+            input_shm = shared_memory.SharedMemory(create=True, size=self.input_floats * 4)
+            output_shm = shared_memory.SharedMemory(create=True, size=self.output_floats * 4)
+            slot = _WorkerSlot(index, input_shm, output_shm)
+            self._spawn(slot)
+            self._slots.append(slot)
+        logger.info(f"Started {self.num_workers} inference worker processes"
+                    + (f" and {self.offline_workers} for offline jobs" if self.offline_workers else ""))
+
+    def _spawn(self, slot):
+        parent_conn, child_conn = self._context.Pipe()
+        slot.process = self._context.Process(
+            target=_worker_main,
+            args=(slot.index, child_conn, slot.input_shm.name, slot.output_shm.name, self.output_floats,
+                  self.loader, self.separate_fn, self.size_fn, self.describe_fn, self.model_cache_bytes,
+                  self.memory_budget_bytes),
+            name=f'inference-worker-{slot.index}',
+            daemon=True
+        )
+        slot.process.start()
+        child_conn.close()
+        slot.conn = parent_conn
+
+    def _restart(self, slot, reason):
+        logger.error(f"Inference worker {slot.index} {reason}; restarting it")
+        try:
+            slot.conn.close()
+        except OSError:
+            pass
+        if slot.process.is_alive():
+            slot.process.kill()
+        slot.process.join(timeout=5)
+        slot.restarts += 1
+        self._spawn(slot)
+
+    def assign(self, offline=False):
+        """Pin a new session (or offline job) to the worker with the fewest sessions and return its index"""
+        with self._assign_lock:
+            slots = self._slots[self.num_workers:] if offline and self.offline_workers else self._slots[:self.num_workers]
+            slot = min(slots, key=lambda candidate: (candidate.sessions, candidate.jobs))
+            slot.sessions += 1
+            return slot.index
+
+    def unassign(self, index):
+        if index is None:
+            return
+        with self._assign_lock:
+            slot = self._slots[index]
+            slot.sessions = max(0, slot.sessions - 1)
+
+    def _call(self, slot, message, timeout=None):
+        if not slot.process.is_alive():
+            self._restart(slot, f"exited with code {slot.process.exitcode}")
+
+        slot.conn.send(message)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not slot.conn.poll(0.1):
+            if not slot.process.is_alive():
+                self._restart(slot, f"crashed with exit code {slot.process.exitcode}")
+                raise WorkerCrashedError(f"Inference worker {slot.index} crashed while running '{message[0]}'")
+            if deadline is not None and time.monotonic() > deadline:
+                self._restart(slot, f"did not answer within {timeout}s")
+                raise WorkerCrashedError(f"Inference worker {slot.index} timed out running '{message[0]}'")
+        try:
+            status, payload, shape = slot.conn.recv()
+        except (EOFError, OSError):
+            self._restart(slot, "closed its pipe")
+            raise WorkerCrashedError(f"Inference worker {slot.index} crashed while running '{message[0]}'")
+        if status != 'ok':
+            raise RuntimeError(payload)
+        return payload, shape
+
+    def load(self, index, spec):
+        """Make sure the worker has the model for spec loaded (blocking, no timeout: weights may download).
+
+        Returns describe_fn(model) for the loaded model, if the pool has a describe_fn.
+        """
+        slot = self._slots[index]
+        with slot.lock:
+            report, _ = self._call(slot, ('load', spec))
+        return report
+
+    def run(self, index, spec, audio, sample_rate, timeout=None, **options):
+        """Separate [channels, frames] audio on worker `index` (blocking). Returns a dict of stems.
+
+        `options` are passed on to separate_fn; `timeout` overrides job_timeout.
+        """
+        channels, frames = audio.shape
+        if channels > self.max_channels or frames > self.max_frames:
+            raise ValueError(f"Audio {audio.shape} exceeds worker buffers "
+                             f"({self.max_channels} channels, {self.max_frames} frames)")
+
+        slot = self._slots[index]
+        with slot.lock:
+            started = time.perf_counter()
+            shared_input = np.ndarray((channels, frames), dtype=np.float32, buffer=slot.input_shm.buf)
+            np.copyto(shared_input, audio)
+            names, shape = self._call(slot, ('separate', spec, (channels, frames), sample_rate, options),
+                                      timeout or self.job_timeout)
+
+            # The output block is reused by the next job, so take our own copy before unlocking
+            stacked = np.ndarray(shape, dtype=np.float32, buffer=slot.output_shm.buf).copy()
+            slot.jobs += 1
+            slot.busy_seconds += time.perf_counter() - started
+        return dict(zip(names, stacked))
+
+    def close(self):
+        for slot in self._slots:
+            try:
+                with slot.lock:
+                    slot.conn.send(('stop',))
+            except (OSError, ValueError):
+                pass
+            slot.process.join(timeout=5)
+            if slot.process.is_alive():
+                slot.process.kill()
+            slot.input_shm.close()
+            slot.input_shm.unlink()
+            slot.output_shm.close()
+            slot.output_shm.unlink()
+        self._slots = []
+
+    def stats(self):
+        return {
+            'workers': [
+                {
+                    'index': slot.index,
+                    'offline': slot.index >= self.num_workers,
+                    'pid': slot.process.pid if slot.process else None,
+                    'alive': bool(slot.process and slot.process.is_alive()),
+                    'sessions': slot.sessions,
+                    'jobs': slot.jobs,
+                    'restarts': slot.restarts,
+                    'busy_seconds': round(slot.busy_seconds, 3),
+                }
+                for slot in self._slots
+            ]
+        }
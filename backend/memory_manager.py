@@ -0,0 +1,123 @@
+"""
+Process memory tracking, threshold-driven collection and reusable scratch buffers
+"""
+
+import gc
+import logging
+import threading
+import time
+
+import numpy as np
+import torch
+
+from metrics import RSS_SOURCE, rss_bytes
+
+logger = logging.getLogger(__name__)
+
+
+def accelerator_bytes():
+    """Bytes currently held by torch's CUDA or MPS allocator (0 on CPU-only setups)"""
+    try:
+        if torch.cuda.is_available():
+            return torch.cuda.memory_allocated()
+        if hasattr(torch, 'mps') and hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+            return torch.mps.current_allocated_memory()
+    except (AttributeError, RuntimeError):
+        pass
+    return 0
+
+
+def empty_accelerator_caches():
+    try:
+        if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
+            torch.mps.empty_cache()
+    except (AttributeError, RuntimeError):
+        pass
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class MemoryManager:
+    """Keeps inference memory under a budget without paying for a GC pass on every chunk.
+
+    check() is cheap (one RSS read) and is meant to run after each chunk; it only
+    triggers gc.collect() and the allocator cache flushes once usage crosses
+    `collect_fraction` of the budget, and at most once per `min_interval`
+    seconds. workspace() hands out per-thread scratch arrays that are reused for
+    every chunk of the same shape. Only arrays we fill ourselves use them: the
+    model input (single and batched) and the stacked stems. The stems a model
+    returns, the mixed or selected stems, every overlap-add hop and the
+    resampled output are still new arrays each chunk.
+    """
+
+    def __init__(self, budget_bytes, collect_fraction=0.85, min_interval=5.0):
+        self.budget_bytes = int(budget_bytes)
+        self.collect_fraction = collect_fraction
+        self.min_interval = min_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_collect = 0.0
+        self.checks = 0
+        self.collections = 0
+        self.collect_seconds = 0.0
+        self.over_budget = 0
+        self.peak_rss = 0
+
+    @property
+    def threshold_bytes(self):
+        return int(self.budget_bytes * self.collect_fraction)
+
+    def usage_bytes(self):
+        return rss_bytes() + accelerator_bytes()
+
+    def check(self):
+        """Collect garbage if memory use has crossed the threshold; returns True if it did"""
+        usage = self.usage_bytes()
+        with self._lock:
+            self.checks += 1
+            self.peak_rss = max(self.peak_rss, usage)
+            if usage < self.threshold_bytes or time.monotonic() - self._last_collect < self.min_interval:
+                return False
+            self._last_collect = time.monotonic()
+        self.collect(f"usage {usage / 1e6:.0f} MB over threshold {self.threshold_bytes / 1e6:.0f} MB")
+
+        if self.usage_bytes() > self.budget_bytes:
+            self.over_budget += 1
+            logger.warning(f"Memory still over budget after collection: "
+                           f"{self.usage_bytes() / 1e6:.0f} MB > {self.budget_bytes / 1e6:.0f} MB")
+        return True
+
+    def collect(self, reason):
+        started = time.perf_counter()
+        gc.collect()
+        empty_accelerator_caches()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.collections += 1
+            self.collect_seconds += elapsed
+        logger.info(f"Collected garbage in {elapsed * 1000:.1f} ms ({reason})")
+
+    def workspace(self, name, shape, dtype=np.float32):
+        """Scratch array owned by the calling thread, reused while the shape stays the same"""
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        shape = tuple(shape)
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def stats(self):
+        return {
+            'budget_bytes': self.budget_bytes,
+            'threshold_bytes': self.threshold_bytes,
+            'rss_bytes': rss_bytes(),
+            'accelerator_bytes': accelerator_bytes(),
+            'peak_bytes': self.peak_rss,
+            'checks': self.checks,
+            'collections': self.collections,
+            'collect_ms_total': round(self.collect_seconds * 1000.0, 1),
+            'over_budget': self.over_budget,
+            'rss_source': RSS_SOURCE,
+        }
@@ -0,0 +1,258 @@
+"""
+Prometheus-style metrics for the separation servers, rendered in the text exposition format
+"""
+
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers sub-millisecond decodes up to multi-second model loads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+RSS_SOURCE = 'psutil' if psutil is not None else 'procfs'
+
+
+def rss_bytes():
+    """Resident set size of this process (0 if it cannot be determined)"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), const_labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.const_labels = tuple((const_labels or {}).items())
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        return self.const_labels + tuple(zip(self.labelnames, key)) + tuple(extra)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), const_labels=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames, const_labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def _render_sample(self, key, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(self._labels(key, [("le", _format_value(float(bound)))]))} '
+                         f'{cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self._labels(key))} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self._labels(key))} {cumulative}')
+        return lines
+
+
+def model_label(session):
+    """Short model name for labels: the configured model, or a Hance model file's base name"""
+    if not session.model_name:
+        return 'none'
+    return os.path.basename(str(session.model_name))
+
+
+def engine_label(session):
+    return session.engine.name if session.engine is not None else 'none'
+
+
+class PipelineMetrics:
+    """Counters, gauges and per-stage latency histograms for one server process.
+
+    Every per-chunk series carries the session's `engine` ('uvr', 'hance' or
+    'mock') and `model` labels. Values that describe the current state (queue
+    depth, clients, RSS) are read from the sessions when the metrics are
+    rendered. The real-time factor is seconds of audio separated per second of
+    processing, smoothed over recent chunks; below 1 the model cannot keep up.
+    """
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.stage_seconds = Histogram(
+            'separator_stage_seconds', 'Time a chunk spends in each pipeline stage.',
+            ('engine', 'model', 'stage'))
+        self.chunks_processed = Counter(
+            'separator_chunks_processed_total', 'Chunks separated and sent.', ('engine', 'model'))
+        self.chunks_dropped = Counter(
+            'separator_chunks_dropped_total', 'Chunks skipped by load shedding.', ('engine', 'model', 'reason'))
+        self.chunk_errors = Counter(
+            'separator_chunk_errors_total', 'Chunks whose separation failed.', ('engine', 'model'))
+        self.audio_seconds = Counter(
+            'separator_audio_seconds_total', 'Seconds of audio separated.', ('engine', 'model'))
+        self.processing_seconds = Counter(
+            'separator_processing_seconds_total', 'Wall time spent separating and sending chunks.',
+            ('engine', 'model'))
+        self.realtime_factor = Gauge(
+            'separator_realtime_factor', 'Seconds of audio per second of processing, smoothed; below 1 falls behind.',
+            ('engine', 'model'))
+        self.model_load_seconds = Histogram(
+            'separator_model_load_seconds', 'Time configure spent making a model ready (near 0 when cached).',
+            ('engine', 'model'))
+        self.queue_depth = Gauge(
+            'separator_queue_depth', 'Chunks waiting to be separated, summed over sessions.', ('engine', 'model'))
+        self.sessions = Gauge(
+            'separator_sessions', 'Connected clients by configured model.', ('engine', 'model'))
+        self.latency = Gauge(
+            'separator_latency_seconds', 'Algorithmic latency of the chunk plan (buffering, model and resampler '
+            'delay, without separation time); the largest over sessions.', ('engine', 'model'))
+        self.rss = Gauge(
+            'separator_process_resident_memory_bytes', f'Resident set size of the server process ({RSS_SOURCE}).')
+        self._metrics = (self.stage_seconds, self.chunks_processed, self.chunks_dropped, self.chunk_errors,
+                         self.audio_seconds, self.processing_seconds, self.realtime_factor, self.model_load_seconds,
+                         self.queue_depth, self.sessions, self.latency, self.rss)
+        self._realtime = {}  # (engine, model) -> smoothed real-time factor
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(session):
+        return {'engine': engine_label(session), 'model': model_label(session)}
+
+    def observe_stage(self, session, stage, seconds):
+        self.stage_seconds.observe(seconds, stage=stage, **self._labels(session))
+
+    @contextlib.contextmanager
+    def timed(self, session, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(session, stage, time.perf_counter() - started)
+
+    def record_chunk(self, session, audio_seconds, wall_seconds):
+        """One chunk's worth of audio went through separation and sending in wall_seconds"""
+        labels = self._labels(session)
+        self.audio_seconds.inc(audio_seconds, **labels)
+        self.processing_seconds.inc(wall_seconds, **labels)
+        if wall_seconds <= 0:
+            return
+        factor = audio_seconds / wall_seconds
+        key = (labels['engine'], labels['model'])
+        with self._lock:
+            previous = self._realtime.get(key)
+            factor = factor if previous is None else previous + self.smoothing * (factor - previous)
+            self._realtime[key] = factor
+        self.realtime_factor.set(factor, **labels)
+
+    def chunk_processed(self, session):
+        self.chunks_processed.inc(**self._labels(session))
+
+    def chunk_dropped(self, session, reason):
+        self.chunks_dropped.inc(reason=reason, **self._labels(session))
+
+    def chunk_failed(self, session):
+        self.chunk_errors.inc(**self._labels(session))
+
+    def model_loaded(self, session, seconds):
+        self.model_load_seconds.observe(seconds, **self._labels(session))
+
+    def render(self, sessions):
+        """Text exposition of every metric, with the session gauges taken now"""
+        self.queue_depth.clear()
+        self.sessions.clear()
+        self.latency.clear()
+        depths, counts, latencies = {}, {}, {}
+        for session in sessions:
+            key = (engine_label(session), model_label(session))
+            depths[key] = depths.get(key, 0) + session.processing_queue.qsize()
+            counts[key] = counts.get(key, 0) + 1
+            if session.chunking is not None:
+                latencies[key] = max(latencies.get(key, 0.0), session.chunking['latency_ms'] / 1000.0)
+        for (engine, model), depth in depths.items():
+            self.queue_depth.set(depth, engine=engine, model=model)
+            self.sessions.set(counts[engine, model], engine=engine, model=model)
+        for (engine, model), seconds in latencies.items():
+            self.latency.set(seconds, engine=engine, model=model)
+        self.rss.set(rss_bytes())
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
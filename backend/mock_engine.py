@@ -0,0 +1,114 @@
+"""
+Stand-in separation engines for benchmarking and development without Hance or the UVR models
+"""
+
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Seconds of audio a mock model separates per second of wall time
+DEFAULT_REALTIME_FACTOR = 10.0
+
+# Stems of the mock UVR model and the frequency band (Hz) each one takes from the input
+MOCK_BANDS = (
+    ('bass', 0.0, 200.0),
+    ('vocals', 200.0, 3000.0),
+    ('other', 3000.0, 8000.0),
+    ('drums', 8000.0, None),
+)
+
+
+def split_bands(audio, sample_rate, bands):
+    """Split [..., frames] audio into one array per (low, high) Hz band; the bands sum to the input"""
+    spectrum = np.fft.rfft(audio, axis=-1)
+    frequencies = np.fft.rfftfreq(audio.shape[-1], 1.0 / sample_rate)
+    outputs = []
+    for low, high in bands:
+        mask = frequencies >= low
+        if high is not None:
+            mask &= frequencies < high
+        outputs.append(np.fft.irfft(spectrum * mask, n=audio.shape[-1], axis=-1).astype(np.float32))
+    return outputs
+
+
+def _pace(started, audio_seconds, realtime_factor):
+    """Sleep (releasing the GIL, as model inference does) until the call took audio_seconds / realtime_factor"""
+    if realtime_factor:
+        remaining = audio_seconds / realtime_factor - (time.perf_counter() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+class MockSeparator:
+    """Drop-in for the UVR model classes: predict() returns band-split stems at a fixed speed.
+
+    The stems are cheap FFT band splits (they sum back to the input), and each
+    call is padded with sleep so it takes the audio's duration divided by
+    `realtime_factor` from `other_metadata`.
+    """
+
+    def __init__(self, name, other_metadata=None, device='cpu'):
+        self.name = name
+        self.device = device
+        self.realtime_factor = float((other_metadata or {}).get('realtime_factor', DEFAULT_REALTIME_FACTOR))
+
+    @classmethod
+    def list_models(cls):
+        return ['mock']
+
+    def predict(self, audio, sampling_rate=44100):
+        started = time.perf_counter()
+        audio = np.asarray(audio, dtype=np.float32)
+        stems = split_bands(audio, sampling_rate, [(low, high) for _, low, high in MOCK_BANDS])
+        _pace(started, audio.shape[-1] / float(sampling_rate), self.realtime_factor)
+        return {name: stem for (name, _, _), stem in zip(MOCK_BANDS, stems)}
+
+
+class MockHanceProcessor:
+    """Processor with the slice of the Hance API the server uses: a 'vocals' and an 'accompaniment' bus"""
+
+    bus_names = ('vocals', 'accompaniment')
+
+    def __init__(self, channels, sample_rate, realtime_factor):
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.realtime_factor = realtime_factor
+        self.volumes = [1.0] * len(self.bus_names)
+
+    def get_number_of_output_buses(self):
+        return len(self.bus_names)
+
+    def get_output_bus_name(self, bus):
+        return self.bus_names[bus]
+
+    def set_output_bus_sensitivity(self, bus, sensitivity):
+        pass
+
+    def set_output_bus_volume(self, bus, volume):
+        self.volumes[bus] = volume
+
+    def reset(self):
+        pass
+
+    def process(self, audio):
+        """[frames, channels] in, [frames, buses] out: the mono mix split at the vocal band"""
+        started = time.perf_counter()
+        mono = np.asarray(audio, dtype=np.float32).mean(axis=1)
+        vocals, = split_bands(mono, self.sample_rate, [(200.0, 3000.0)])
+        output = np.stack([vocals * self.volumes[0], (mono - vocals) * self.volumes[1]], axis=1)
+        _pace(started, len(mono) / float(self.sample_rate), self.realtime_factor)
+        return output
+
+
+class MockHanceEngine:
+    """Stands in for hance.HanceEngine; model files are not read, so any model name works"""
+
+    def __init__(self, realtime_factor=DEFAULT_REALTIME_FACTOR):
+        self.realtime_factor = realtime_factor
+
+    def create_processor(self, model_path, channels, sample_rate):
+        logger.info(f"Creating mock Hance processor for {model_path} ({channels} ch, {sample_rate} Hz)")
+        return MockHanceProcessor(channels, sample_rate, self.realtime_factor)
@@ -0,0 +1,116 @@
+"""
+Background model loading, shared between the sessions that ask for the same model
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ModelLoad:
+    """One load in flight and how many configures are waiting on it.
+
+    Each caller of ModelLoader.load() counts as a waiter until it calls
+    leave(), once the load has finished or it stopped waiting.
+    """
+
+    def __init__(self, key, expected_seconds=None):
+        self.key = key
+        self.started_at = time.perf_counter()
+        self.expected_seconds = expected_seconds  # How long the last load of this key took, if any
+        self.future = None
+        self.waiters = 0
+
+    def leave(self):
+        self.waiters = max(0, self.waiters - 1)
+
+    @property
+    def elapsed_seconds(self):
+        return time.perf_counter() - self.started_at
+
+    def progress(self):
+        """Elapsed time, and an estimated fraction done when this model has been loaded before"""
+        elapsed = self.elapsed_seconds
+        info = {'elapsed_ms': round(elapsed * 1000.0, 1), 'waiters': self.waiters}
+        if self.expected_seconds:
+            info['expected_ms'] = round(self.expected_seconds * 1000.0, 1)
+            info['progress'] = round(min(0.99, elapsed / self.expected_seconds), 3)
+        return info
+
+
+class ModelSwap:
+    """A warm model waiting to take over a session at a chunk boundary"""
+
+    def __init__(self, engine, prepared, config, chunking, load_seconds):
+        self.engine = engine
+        self.prepared = prepared
+        self.config = config
+        self.chunking = chunking
+        self.load_seconds = load_seconds
+
+
+class ModelLoader:
+    """Runs model loads on threads of their own, off the event loop and the inference threads.
+
+    load(key, fn, *args) starts fn(*args) unless a load with the same key is
+    already running, in which case the caller shares that one, so any number
+    of concurrent configures for one model cost a single load. Must be called
+    from the event loop. How long each key took is remembered, so a later
+    load of the same model can report its progress against that.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max(1, int(max_workers))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='model-loader')
+        self._loads = {}  # key -> ModelLoad in flight
+        self._seconds = {}  # key -> duration of its last successful load
+        self.loads = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def load(self, key, fn, *args):
+        """The ModelLoad for key, starting fn(*args) on a loader thread if none is in flight.
+
+        The caller must call leave() on it when done waiting.
+        """
+        load = self._loads.get(key)
+        if load is not None:
+            load.waiters += 1
+            self.coalesced += 1
+            logger.info(f"Joining the load of {key} already in flight ({load.waiters} waiting)")
+            return load
+
+        load = ModelLoad(key, self._seconds.get(key))
+        load.waiters = 1
+        load.future = asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+        load.future.add_done_callback(lambda future: self._finished(load, future))
+        self._loads[key] = load
+        self.loads += 1
+        return load
+
+    def _finished(self, load, future):
+        if self._loads.get(load.key) is load:
+            del self._loads[load.key]
+        if future.cancelled() or future.exception() is not None:
+            self.failures += 1
+        else:
+            self._seconds[load.key] = load.elapsed_seconds
+
+    def run(self, fn, *args):
+        """fn(*args) on a loader thread, without sharing (per-session work after a shared load)"""
+        return asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    def stats(self):
+        return {
+            'max_workers': self.max_workers,
+            'in_flight': [dict(load.progress(), key=str(load.key)) for load in list(self._loads.values())],
+            'loads': self.loads,
+            'coalesced': self.coalesced,
+            'failures': self.failures,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,144 @@
+"""
+LRU cache of loaded separation models with reference counting
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# How long a warmed model is kept for the acquire() that takes it over, even over the budget
+WARM_HOLD_SECONDS = 60.0
+
+
+def _describe_key(key):
+    if hasattr(key, '_asdict'):
+        return {field: (dict(value) if field == 'metadata' else value) for field, value in key._asdict().items()}
+    return list(key) if isinstance(key, tuple) else key
+
+
+class _Entry:
+    def __init__(self, model, size_bytes, load_seconds):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.load_seconds = load_seconds
+        self.refcount = 0
+        self.hits = 0
+        self.last_used = time.time()
+        self.warm_until = 0.0  # time.monotonic() until which an unreferenced warmed model is not evicted
+
+
+class ModelRegistry:
+    """Keeps loaded models keyed by their spec, evicting least-recently-used idle ones.
+
+    acquire() hands out a model and bumps its reference count; release() drops
+    it again. Models with a non-zero reference count are never evicted, so the
+    memory budget can be exceeded temporarily while every cached model is in use.
+    warm() loads a model without holding a reference; it is kept (even over the
+    budget) until the next acquire() takes it over, or for WARM_HOLD_SECONDS if
+    nobody does.
+    """
+
+    def __init__(self, loader, memory_budget_bytes, size_fn=None):
+        self.loader = loader
+        self.memory_budget_bytes = int(memory_budget_bytes)
+        self.size_fn = size_fn or (lambda model: 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def total_bytes(self):
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def acquire(self, key):
+        """Return the model for key, loading it on a miss (blocking)"""
+        return self._get(key, 1)
+
+    def warm(self, key):
+        """Load the model for key without taking a reference, and keep it for the acquire() that follows"""
+        self._get(key, 0)
+
+    def _get(self, key, references):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._use_locked(key, entry, references)
+                entry.hits += 1
+                self.hits += 1
+                return entry.model
+            self.misses += 1
+
+        started = time.perf_counter()
+        model = self.loader(key)
+        load_seconds = time.perf_counter() - started
+        size_bytes = self.size_fn(model)
+        logger.info(f"Loaded model {key} in {load_seconds:.2f}s ({size_bytes / 1e6:.1f} MB)")
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Another caller may have loaded the same key meanwhile; keep the first one
+                entry = _Entry(model, size_bytes, load_seconds)
+                self._entries[key] = entry
+            self._use_locked(key, entry, references)
+            self._evict_locked()
+            return entry.model
+
+    def _use_locked(self, key, entry, references):
+        if references:
+            entry.refcount += references
+            entry.warm_until = 0.0  # Taken over: the reference keeps it from now on
+        else:
+            entry.warm_until = time.monotonic() + WARM_HOLD_SECONDS
+        entry.last_used = time.time()
+        self._entries.move_to_end(key)
+
+    def release(self, key):
+        """Drop one reference to key; idle models become eligible for eviction"""
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount = max(0, entry.refcount - 1)
+            self._evict_locked()
+
+    def _evict_locked(self):
+        now = time.monotonic()
+        while self.total_bytes > self.memory_budget_bytes:
+            idle_key = next((key for key, entry in self._entries.items()
+                             if entry.refcount == 0 and entry.warm_until <= now), None)
+            if idle_key is None:
+                break
+            entry = self._entries.pop(idle_key)
+            self.evictions += 1
+            logger.info(f"Evicted model {idle_key} from cache ({entry.size_bytes / 1e6:.1f} MB)")
+
+    def stats(self):
+        """JSON-serialisable cache state for the HTTP API"""
+        with self._lock:
+            return {
+                'memory_budget_bytes': self.memory_budget_bytes,
+                'total_bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': [
+                    {
+                        'key': _describe_key(key),
+                        'size_bytes': entry.size_bytes,
+                        'refcount': entry.refcount,
+                        'warm': entry.refcount == 0 and entry.warm_until > time.monotonic(),
+                        'hits': entry.hits,
+                        'load_seconds': round(entry.load_seconds, 3),
+                        'last_used': entry.last_used,
+                    }
+                    for key, entry in self._entries.items()
+                ],
+            }
@@ -0,0 +1,390 @@
+"""
+Offline separation of whole audio files in bounded-memory windows
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from resampler import StreamingResampler, delay_seconds
+from session import stem_selection
+from streaming import OverlapAddStream
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.path.join(tempfile.gettempdir(), 'music-separator-jobs')
+
+# Offline windows: 8 s of output per model call with 1 s of context on each side
+OFFLINE_WINDOW_SECONDS = 10.0
+OFFLINE_CONTEXT_SECONDS = 1.0
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class _SoundFileReader:
+    """Decodes a file block by block with soundfile, so only one block is in memory"""
+
+    def __init__(self, path):
+        self._file = soundfile.SoundFile(path)
+        self.sample_rate = self._file.samplerate
+        self.channels = self._file.channels
+        self.frames = self._file.frames
+
+    def read(self, frames):
+        return self._file.read(frames, dtype='float32', always_2d=True)
+
+    def close(self):
+        self._file.close()
+
+
+class _WaveReader:
+    """Block-by-block decoding of 16/24/32-bit PCM WAV files with the standard library"""
+
+    def __init__(self, path):
+        self._file = wave.open(path, 'rb')
+        self.sample_rate = self._file.getframerate()
+        self.channels = self._file.getnchannels()
+        self.frames = self._file.getnframes()
+        self._width = self._file.getsampwidth()
+        if self._width not in (2, 3, 4):
+            self._file.close()
+            raise ValueError(f"Unsupported WAV sample width: {self._width * 8} bits")
+
+    def read(self, frames):
+        data = np.frombuffer(self._file.readframes(frames), dtype=np.uint8)
+        if self._width == 3:
+            # Widen 24-bit samples to 32-bit by putting each one in the top three bytes
+            padded = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+            padded[:, 1:] = data.reshape(-1, 3)
+            data = padded.reshape(-1)
+        width = 2 if self._width == 2 else 4
+        samples = data.view(f'<i{width}').astype(np.float32) / float(2 ** (8 * width - 1))
+        return samples.reshape(-1, self.channels)
+
+    def close(self):
+        self._file.close()
+
+
+class _ArrayReader:
+    """Fallback for formats soundfile cannot open: the file is decoded at once, then handed out in blocks"""
+
+    def __init__(self, path, read_audio):
+        audio, self.sample_rate = read_audio(path)
+        audio = np.atleast_2d(np.asarray(audio, dtype=np.float32))
+        if audio.shape[0] > audio.shape[1]:
+            audio = audio.T  # Always [channels, frames]
+        self._audio = audio
+        self.channels, self.frames = audio.shape
+        self._position = 0
+
+    def read(self, frames):
+        block = self._audio[:, self._position:self._position + frames].T
+        self._position += len(block)
+        return block
+
+    def close(self):
+        self._audio = None
+
+
+def open_reader(path, read_audio=None):
+    """Streaming reader for an audio file: soundfile, then the stdlib WAV reader, then read_audio in one piece"""
+    if soundfile is not None:
+        try:
+            return _SoundFileReader(path)
+        except Exception as e:
+            logger.info(f"soundfile cannot read {path}: {e}")
+    try:
+        return _WaveReader(path)
+    except (wave.Error, EOFError, ValueError) as e:
+        if read_audio is None:
+            raise ValueError(f"Cannot decode {path}: {e}")
+    logger.info(f"Decoding {path} in one piece")
+    return _ArrayReader(path, read_audio)
+
+
+class StemWriter:
+    """Appends [frames, channels] float audio to a WAV file: 32-bit float with soundfile, else 16-bit PCM"""
+
+    def __init__(self, path, sample_rate, channels):
+        self.path = path
+        self.frames = 0
+        if soundfile is not None:
+            self._file = soundfile.SoundFile(path, 'w', samplerate=sample_rate, channels=channels, subtype='FLOAT')
+            self._wave = None
+        else:
+            self._file = None
+            self._wave = wave.open(path, 'wb')
+            self._wave.setnchannels(channels)
+            self._wave.setsampwidth(2)
+            self._wave.setframerate(sample_rate)
+
+    def write(self, frames):
+        if self._file is not None:
+            self._file.write(frames)
+        else:
+            pcm = (np.clip(frames, -1.0, 1.0) * 32767.0).astype('<i2')
+            self._wave.writeframes(pcm.tobytes())
+        self.frames += len(frames)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        else:
+            self._wave.close()
+
+
+class SeparationJob:
+    def __init__(self, source, output_dir, spec, stems=None, remove_source=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.source = source
+        self.output_dir = output_dir or os.path.join(JOBS_DIR, self.id)
+        self.spec = spec
+        self.stems = set(stems) if stems else None
+        self.remove_source = remove_source  # Uploaded files are deleted once the job ends
+        self.status = JOB_QUEUED
+        self.error = None
+        self.outputs = {}
+        self.sample_rate = None
+        self.total_frames = 0
+        self.done_frames = 0
+        self.windows = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.separation_seconds = 0.0
+        self.cancel_event = threading.Event()
+
+    @property
+    def audio_seconds(self):
+        return self.done_frames / self.sample_rate if self.sample_rate else 0.0
+
+    def describe(self):
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        return {
+            'id': self.id,
+            'status': self.status,
+            'source': self.source,
+            'output_dir': self.output_dir,
+            'model': self.spec.name,
+            'progress': round(self.done_frames / self.total_frames, 4) if self.total_frames else 0.0,
+            'audio_seconds': round(self.audio_seconds, 3),
+            'duration_seconds': round(self.total_frames / self.sample_rate, 3) if self.sample_rate else None,
+            'elapsed_seconds': round(elapsed, 3),
+            # Seconds of audio separated per second of wall time; above 1 is faster than real time
+            'realtime_factor': round(self.audio_seconds / elapsed, 3) if elapsed > 0 else None,
+            'separation_seconds': round(self.separation_seconds, 3),
+            'windows': self.windows,
+            'stems': dict(self.outputs),
+            'error': self.error,
+        }
+
+
+class OfflineJobManager:
+    """Runs whole-file separation jobs on a few background threads.
+
+    A job decodes its file one block at a time, resamples it to the model
+    rate, and runs windows of OFFLINE_WINDOW_SECONDS through `separate` with
+    OFFLINE_CONTEXT_SECONDS of context on each side, stitched with the same
+    overlap-add as the live stream. The hop of every window is resampled back
+    and appended to one WAV file per stem, so memory stays bounded by a window
+    whatever the file length. The stems line up with the file: the output
+    resampler starts past both resamplers' delay, and both are flushed with
+    silence at the end of the file. A
+    requested 'instrumental' the model does not produce is the sum of its
+    non-vocal stems, as for live sessions. `open_model(spec)` returns a handle that
+    `separate(handle, audio, sample_rate)` uses, and `close_model(handle)`
+    releases it when the job ends.
+    """
+
+    def __init__(self, open_model, separate, close_model, model_rate=44100, max_parallel=1, read_audio=None,
+                 max_window_frames=None):
+        self.open_model = open_model
+        self.separate = separate
+        self.close_model = close_model
+        self.model_rate = int(model_rate)
+        self.read_audio = read_audio
+        self.max_window_frames = max_window_frames
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(max_parallel)), thread_name_prefix='offline-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, source, spec, output_dir=None, stems=None, remove_source=False):
+        """Queue a job; output_dir, if given, must lie inside JOBS_DIR (a relative one is taken from there)"""
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"Audio file not found: {source}")
+        if output_dir:
+            jobs_dir = os.path.realpath(JOBS_DIR)
+            output_dir = os.path.realpath(os.path.join(jobs_dir, output_dir))
+            if output_dir == jobs_dir or os.path.commonpath([output_dir, jobs_dir]) != jobs_dir:
+                raise ValueError(f"output_dir must be a directory inside {JOBS_DIR}")
+        job = SeparationJob(source, output_dir, spec, stems, remove_source)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        logger.info(f"Queued offline job {job.id} for {source} with {spec.name}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+        return job
+
+    def shutdown(self):
+        for job in self.list():
+            job.cancel_event.set()
+        self._executor.shutdown(wait=False)
+
+    def _stream_for(self):
+        window = OFFLINE_WINDOW_SECONDS
+        if self.max_window_frames:
+            window = min(window, self.max_window_frames / self.model_rate)
+        return OverlapAddStream.from_seconds(self.model_rate, window, min(OFFLINE_CONTEXT_SECONDS, window / 4))
+
+    def _run(self, job):
+        if job.cancel_event.is_set():
+            job.status = JOB_CANCELLED
+            return
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        handle = None
+        reader = None
+        writers = {}
+        try:
+            reader = open_reader(job.source, self.read_audio)
+            job.sample_rate = reader.sample_rate
+            job.total_frames = reader.frames
+            os.makedirs(job.output_dir, exist_ok=True)
+            handle = self.open_model(job.spec)
+            self._separate_file(job, handle, reader, writers)
+            job.status = JOB_DONE
+            logger.info(f"Offline job {job.id} finished: {job.audio_seconds:.1f}s of audio "
+                        f"at {job.describe()['realtime_factor']}x real time")
+        except JobCancelled:
+            job.status = JOB_CANCELLED
+            logger.info(f"Offline job {job.id} cancelled at {job.done_frames}/{job.total_frames} frames")
+        except Exception as e:
+            job.status = JOB_FAILED
+            job.error = str(e)
+            logger.error(f"Offline job {job.id} failed: {e}", exc_info=True)
+        finally:
+            job.finished_at = time.time()
+            for writer in writers.values():
+                writer.close()
+            if reader is not None:
+                reader.close()
+            if handle is not None:
+                self.close_model(handle)
+            if job.remove_source:
+                try:
+                    os.remove(job.source)
+                except OSError:
+                    pass
+
+    def _separate_file(self, job, handle, reader, writers):
+        stream = self._stream_for()
+        to_model = StreamingResampler(reader.sample_rate, self.model_rate)
+        to_file = StreamingResampler(self.model_rate, reader.sample_rate)
+        # Both filters hold the audio back; output starts that far in, so the stems line up with the file
+        input_delay = delay_seconds(reader.sample_rate, self.model_rate)
+        to_file.skip(input_delay + delay_seconds(self.model_rate, reader.sample_rate))
+        channels = 2  # The models are stereo; mono files are duplicated, extra channels dropped
+        block_frames = max(1, int(round(stream.hop_frames * reader.sample_rate / self.model_rate)))
+
+        # [channels, frames] model-rate audio not yet covered by a window, primed with the left context
+        pending = np.zeros((channels, stream.left_context), dtype=np.float32)
+        # The file's last frames reach the model rate this much later; they are flushed out at the end of the file
+        target_model_frames = (int(round(reader.frames * self.model_rate / reader.sample_rate))
+                               + int(np.ceil(input_delay * self.model_rate)))
+        emitted_model_frames = 0
+        written_frames = 0
+        end_of_file = False
+        selection = None
+
+        while emitted_model_frames < target_model_frames:
+            if job.cancel_event.is_set():
+                raise JobCancelled()
+
+            if pending.shape[1] < stream.window_frames and not end_of_file:
+                block = reader.read(block_frames)
+                if len(block) < block_frames:
+                    end_of_file = True
+                if len(block):
+                    block = block.T
+                    if block.shape[0] == 1:
+                        block = np.repeat(block, channels, axis=0)
+                    pending = np.concatenate([pending, to_model.process(block[:channels])], axis=1)
+                if end_of_file and not to_model.passthrough:
+                    flush = to_model.process(np.zeros((channels, to_model.taps), dtype=np.float32))
+                    pending = np.concatenate([pending, flush], axis=1)
+                continue
+            if pending.shape[1] < stream.window_frames:
+                # Past the end of the file the last windows see silence
+                padding = np.zeros((channels, stream.window_frames - pending.shape[1]), dtype=np.float32)
+                pending = np.concatenate([pending, padding], axis=1)
+
+            window = np.ascontiguousarray(pending[:, :stream.window_frames])
+            pending = pending[:, stream.hop_frames:]
+
+            started = time.perf_counter()
+            stems = self.separate(handle, window, self.model_rate)
+            job.separation_seconds += time.perf_counter() - started
+            if selection is None:
+                names, selection = stem_selection(list(stems), job.stems)
+                if not names:
+                    raise ValueError(f"{job.spec.name} produces none of the requested stems "
+                                     f"({', '.join(sorted(job.stems))}); it produces {', '.join(stems)}")
+            stacked = np.stack([
+                stem.cpu().numpy() if hasattr(stem, 'cpu') else np.asarray(stem, dtype=np.float32)
+                for stem in stems.values()
+            ])
+            if stacked.ndim == 2:
+                stacked = stacked[:, None, :]  # Mono stems: [stems, 1, frames]
+            selected = np.tensordot(selection, stacked, axes=1)
+
+            hop = stream.process(selected)[..., :target_model_frames - emitted_model_frames]
+            emitted_model_frames += hop.shape[-1]
+            output = to_file.process(hop)
+            if emitted_model_frames >= target_model_frames and not to_file.passthrough:
+                flush = to_file.process(np.zeros(hop.shape[:-1] + (to_file.taps,), dtype=np.float32))
+                output = np.concatenate([output, flush], axis=-1)
+            output = output[..., :reader.frames - written_frames]
+            written_frames += output.shape[-1]
+
+            for name, stem_audio in zip(names, output):
+                writer = writers.get(name)
+                if writer is None:
+                    path = os.path.join(job.output_dir, f"{name}.wav")
+                    writer = writers[name] = StemWriter(path, reader.sample_rate, stem_audio.shape[0])
+                    job.outputs[name] = path
+                writer.write(stem_audio.T)
+            job.windows += 1
+            job.done_frames = written_frames
@@ -0,0 +1,97 @@
+"""
+Vectorized post-processing of separated stems: downmix, limiting and wire dtype conversion
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DTYPES = ('float32', 'float16', 'int16')
+
+
+class StemPostProcessor:
+    """Turns stacked [stems, channels, frames] output into wire-ready [stems, frames, channels] arrays.
+
+    Every step is a whole-array operation into buffers that are reused while the
+    shape stays the same. Instead of peak-normalising each chunk on its own, a
+    per-stem limiter gain is carried across chunks: it drops at once when a
+    chunk would clip, and recovers with the `release_seconds` time constant,
+    ramped linearly across each chunk so releases never step at a boundary.
+    """
+
+    def __init__(self, sample_rate, keep_stereo=False, dtype='float32', threshold=0.98, release_seconds=1.0):
+        if dtype not in OUTPUT_DTYPES:
+            raise ValueError(f"Unknown output dtype '{dtype}', expected one of {', '.join(OUTPUT_DTYPES)}")
+        self.sample_rate = int(sample_rate)
+        self.keep_stereo = keep_stereo
+        self.dtype = dtype
+        self.threshold = threshold
+        self.release_seconds = release_seconds
+        self._gain = None  # Limiter gain per stem at the end of the previous chunk
+        self._ramp = None
+        self._buffers = {}
+        self.limited_chunks = 0
+
+    def reset(self):
+        self._gain = None
+
+    def _buffer(self, name, shape, dtype=np.float32):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def process(self, stacked, keep_stereo=None):
+        """Downmix (unless keeping stereo), limit and convert; returns [stems, frames, channels]"""
+        keep_stereo = self.keep_stereo if keep_stereo is None else keep_stereo
+        stems, channels, frames = stacked.shape
+
+        if channels > 1 and not keep_stereo:
+            mixed = self._buffer('downmix', (stems, 1, frames))
+            np.mean(stacked, axis=1, keepdims=True, out=mixed)
+        else:
+            mixed = self._buffer('stereo', stacked.shape)
+            np.copyto(mixed, stacked)
+
+        # Smoothed limiter: the gain each stem needs to stay under the threshold this chunk
+        peaks = np.abs(mixed).max(axis=(1, 2))
+        needed = np.minimum(1.0, self.threshold / np.maximum(peaks, 1e-9)).astype(np.float32)
+        if self._gain is None or self._gain.shape != needed.shape:
+            self._gain = needed
+        release = 1.0 - np.exp(-frames / (self.sample_rate * self.release_seconds))
+        target = np.where(needed < self._gain, needed, self._gain + (needed - self._gain) * release).astype(np.float32)
+        if (target < 1.0).any():
+            self.limited_chunks += 1
+
+        if self._ramp is None or self._ramp.shape[0] != frames:
+            self._ramp = np.arange(1, frames + 1, dtype=np.float32) / frames
+        start = np.minimum(self._gain, needed)  # Attack applies from the first frame
+        gains = self._buffer('gains', (stems, 1, frames))
+        np.multiply((target - start)[:, None, None], self._ramp, out=gains)
+        gains += start[:, None, None]
+        mixed *= gains
+        np.clip(mixed, -1.0, 1.0, out=mixed)
+        self._gain = target
+
+        out_channels = mixed.shape[1]
+        interleaved = mixed.transpose(0, 2, 1)  # [stems, frames, channels]
+        if self.dtype == 'float32':
+            out = self._buffer('out_float32', (stems, frames, out_channels))
+            np.copyto(out, interleaved)
+        elif self.dtype == 'float16':
+            out = self._buffer('out_float16', (stems, frames, out_channels), np.float16)
+            np.copyto(out, interleaved, casting='same_kind')
+        else:
+            out = self._buffer('out_int16', (stems, frames, out_channels), np.int16)
+            np.multiply(interleaved, 32767.0, out=out, casting='unsafe')
+        return out
+
+    def describe(self):
+        return {
+            'keep_stereo': self.keep_stereo,
+            'dtype': self.dtype,
+            'limiter_gain': self._gain.tolist() if self._gain is not None else None,
+            'limited_chunks': self.limited_chunks,
+        }
@@ -0,0 +1,237 @@
+"""
+Shared Hance engine and a pool of stateful processors keyed by stream format
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Hance model files name their block length, e.g. 'music-stem-separation-44.1kHz-209ms-large.hance'
+_BLOCK_MS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)ms', re.IGNORECASE)
+_RATE_KHZ_PATTERN = re.compile(r'(\d+(?:\.\d+)?)kHz', re.IGNORECASE)
+
+DEFAULT_BLOCK_SECONDS = 0.1
+DEFAULT_SAMPLE_RATE = 44100
+
+# Logical stems every Hance model is mapped onto, and the bus name fragments that identify them
+HANCE_STEMS = ('vocals', 'instrumental', 'bass', 'drums', 'other')
+_BUS_MATCHES = (
+    ('vocals', ('vocal',)),
+    ('instrumental', ('instrument', 'accompaniment')),
+    ('bass', ('bass',)),
+    ('drums', ('drum',)),
+    ('other', ('other',)),
+)
+# A stem missing from the model is the mix minus this much of its counterpart (scaled to avoid artifacts)
+RESIDUAL_SCALE = 0.8
+# Stems for models without these buses, as scaled copies of the instrumental (the extension expects four stems)
+DERIVED_STEM_SCALES = {'bass': 0.7, 'drums': 0.8, 'other': 0.9}
+
+
+def block_seconds_from_name(model_path):
+    """Block length encoded in a Hance model's file name, or None"""
+    match = _BLOCK_MS_PATTERN.search(os.path.basename(str(model_path)))
+    return float(match.group(1)) / 1000.0 if match else None
+
+
+def sample_rate_from_name(model_path):
+    """Native sample rate of a Hance model: the 'NN.NkHz' in its file name, else DEFAULT_SAMPLE_RATE"""
+    match = _RATE_KHZ_PATTERN.search(os.path.basename(str(model_path)))
+    return int(round(float(match.group(1)) * 1000)) if match else DEFAULT_SAMPLE_RATE
+
+
+def _processor_seconds(processor, method, sample_rate):
+    """Call a frame-count getter the Hance build may or may not have, converted to seconds"""
+    getter = getattr(processor, method, None)
+    if getter is None:
+        return None
+    try:
+        frames = int(getter())
+    except Exception as e:
+        logger.warning(f"Hance processor {method}() failed: {e}")
+        return None
+    return frames / float(sample_rate) if frames > 0 else None
+
+
+def build_routing(bus_names):
+    """Matrix from a model's output buses (plus the input mix as the last row) to HANCE_STEMS.
+
+    A chunk's [frames, buses + 1] columns times this [buses + 1, stems] matrix
+    gives every logical stem at once. Stems the model has a bus for are routed
+    straight through; vocals and instrumental are otherwise derived from each
+    other and the mix, and bass/drums/other from the instrumental.
+    """
+    buses = len(bus_names)
+    mix = np.zeros(buses + 1, dtype=np.float32)
+    mix[buses] = 1.0
+
+    routes = {}
+    for index, name in enumerate(bus_names):
+        lowered = name.lower()
+        for stem, fragments in _BUS_MATCHES:
+            if stem not in routes and any(fragment in lowered for fragment in fragments):
+                routes[stem] = np.eye(buses + 1, dtype=np.float32)[index]
+                break
+
+    if 'vocals' not in routes and 'instrumental' not in routes:
+        if buses:
+            # No vocal bus: every output bus is part of the instrumental
+            routes['instrumental'] = np.ones(buses + 1, dtype=np.float32) - mix
+            routes['vocals'] = mix - RESIDUAL_SCALE * routes['instrumental']
+        else:
+            routes['vocals'] = np.zeros(buses + 1, dtype=np.float32)
+            routes['instrumental'] = mix
+    elif 'instrumental' not in routes:
+        routes['instrumental'] = mix - RESIDUAL_SCALE * routes['vocals']
+    elif 'vocals' not in routes:
+        routes['vocals'] = mix - RESIDUAL_SCALE * routes['instrumental']
+    for stem, scale in DERIVED_STEM_SCALES.items():
+        routes.setdefault(stem, scale * routes['instrumental'])
+
+    return np.stack([routes[stem] for stem in HANCE_STEMS], axis=1)
+
+
+class HanceProcessorPool:
+    """Hands out Hance processors keyed by (model path, channels, sample rate).
+
+    A processor keeps the model's streaming state between chunks, so each one
+    belongs to a single session while it is acquired. Released processors are
+    kept idle (at most `max_idle_per_key` per key) and handed to the next
+    session with the same model and format instead of being recreated. All
+    processors come from one engine, created on first use.
+    """
+
+    def __init__(self, engine_factory, max_idle_per_key=2):
+        self.engine_factory = engine_factory
+        self.max_idle_per_key = max(0, int(max_idle_per_key))
+        self._engine = None
+        self._idle = {}  # key -> [processor, ...]
+        self._bus_names = {}  # model path -> output bus names
+        self._timing = {}  # model path -> native block and latency
+        self._routing = {}  # model path -> bus-to-stem routing matrix
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.create_seconds = 0.0
+
+    @property
+    def engine(self):
+        with self._lock:
+            if self._engine is None:
+                self._engine = self.engine_factory()
+            return self._engine
+
+    def acquire(self, model_path, channels, sample_rate):
+        """Processor for this model and stream format, reusing an idle one if possible (blocking)"""
+        key = (str(model_path), int(channels), int(sample_rate))
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                processor = idle.pop()
+                self.reused += 1
+                self.in_use += 1
+                return key, processor
+
+        started = time.perf_counter()
+        processor = self.engine.create_processor(*key)
+        for bus in range(processor.get_number_of_output_buses()):
+            processor.set_output_bus_sensitivity(bus, 0.0)  # Default sensitivity
+            processor.set_output_bus_volume(bus, 1.0)      # Full volume for all stems
+        elapsed = time.perf_counter() - started
+        logger.info(f"Created Hance processor for {key[0]} ({key[1]} ch, {key[2]} Hz) in {elapsed * 1000:.1f} ms")
+
+        with self._lock:
+            self.created += 1
+            self.in_use += 1
+            self.create_seconds += elapsed
+            if key[0] not in self._bus_names:
+                bus_names = [processor.get_output_bus_name(bus) for bus in range(processor.get_number_of_output_buses())]
+                self._bus_names[key[0]] = bus_names
+                self._routing[key[0]] = build_routing(bus_names)
+                logger.info(f"Hance buses {bus_names} routed to stems {list(HANCE_STEMS)}")
+            measure = key[0] not in self._timing
+
+        if measure:
+            # Asks the processor, so done outside the lock; a concurrent first acquire may measure too
+            timing = self._measure_timing(key[0], processor, key[2])
+            with self._lock:
+                self._timing.setdefault(key[0], timing)
+        return key, processor
+
+    @staticmethod
+    def _measure_timing(model_path, processor, sample_rate):
+        """Native block and latency of a model: asked of the processor when the API offers it, else from the file name"""
+        named = block_seconds_from_name(model_path)
+        block = _processor_seconds(processor, 'get_block_size', sample_rate)
+        latency = _processor_seconds(processor, 'get_latency', sample_rate)
+        source = 'processor' if block is not None else 'file name' if named is not None else 'default'
+        block = block or named or DEFAULT_BLOCK_SECONDS
+        return {
+            'block_seconds': block,
+            'latency_seconds': latency if latency is not None else (named or 0.0),
+            'source': source,
+        }
+
+    def release(self, key, processor):
+        """Return a processor to the pool once its session no longer uses it"""
+        if processor is None:
+            return
+        reset = getattr(processor, 'reset', None)
+        if reset is not None:
+            reset()  # Don't leak one session's streaming state into the next
+        with self._lock:
+            self.in_use -= 1
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append(processor)
+            else:
+                self.discarded += 1
+
+    def bus_names(self, model_path, channels=2, sample_rate=44100):
+        """Output bus names of a model, creating (and pooling) a processor to find out if needed"""
+        with self._lock:
+            names = self._bus_names.get(str(model_path))
+        if names is None:
+            key, processor = self.acquire(model_path, channels, sample_rate)
+            self.release(key, processor)
+            names = self._bus_names[key[0]]
+        return list(names)
+
+    def timing(self, model_path, channels=2, sample_rate=44100):
+        """Native block and algorithmic latency (in seconds) of a model, probing a processor if needed"""
+        with self._lock:
+            timing = self._timing.get(str(model_path))
+        if timing is None:
+            self.bus_names(model_path, channels, sample_rate)
+            timing = self._timing[str(model_path)]
+        return dict(timing)
+
+    def routing(self, model_path, channels=2, sample_rate=44100):
+        """The model's [buses + 1, len(HANCE_STEMS)] routing matrix (see build_routing)"""
+        with self._lock:
+            routing = self._routing.get(str(model_path))
+        if routing is None:
+            self.bus_names(model_path, channels, sample_rate)
+            routing = self._routing[str(model_path)]
+        return routing
+
+    def stats(self):
+        with self._lock:
+            return {
+                'engine_loaded': self._engine is not None,
+                'in_use': self.in_use,
+                'idle': {f"{path} {channels}ch {sample_rate}Hz": len(idle)
+                         for (path, channels, sample_rate), idle in self._idle.items() if idle},
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'create_ms_total': round(self.create_seconds * 1000.0, 1),
+            }
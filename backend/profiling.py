@@ -0,0 +1,276 @@
+"""
+On-demand profiling of a live server: cProfile for Python, torch.profiler for model forward passes
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'music-separator-profiles')
+MAX_PROFILE_SECONDS = 300.0
+# Forward passes recorded per run; each one adds its whole op trace to the Chrome trace file
+MAX_TORCH_TRACES = 50
+
+
+def _slug(value):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(value)).strip('_') or 'none'
+
+
+class ProfileRun:
+    """One bounded profiling window and everything it has recorded so far"""
+
+    def __init__(self, directory, seconds, session_id=None, model=None, torch_trace=False):
+        self.started_at = time.time()
+        self.seconds = seconds
+        self.session_id = session_id
+        self.model = model
+        self.torch_trace = torch_trace
+        self.id = '-'.join([
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at)),
+            f"session{session_id}" if session_id is not None else 'all',
+            _slug(model) if model is not None else 'all',
+        ])
+        self.directory = os.path.join(directory, self.id)
+        self.stats = {}  # (session, model) -> pstats.Stats of the separation calls
+        self.calls = 0
+        self.skipped_calls = 0
+        self.torch_events = []
+        self.torch_traces = 0
+        self.loop_profile = None  # cProfile of the event loop thread
+        self.loop_stopped = threading.Event()
+        self.finished_at = None
+        self.files = []
+        self.error = None
+
+    def matches(self, session_id, model):
+        return ((self.session_id is None or session_id == self.session_id)
+                and (self.model is None or model == self.model))
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'state': 'running' if self.finished_at is None else 'done',
+            'started_at': self.started_at,
+            'seconds': self.seconds,
+            'session': self.session_id,
+            'model': self.model,
+            'torch_trace': self.torch_trace,
+            'calls': self.calls,
+            'skipped_calls': self.skipped_calls,
+            'torch_traces': self.torch_traces,
+            'directory': self.directory,
+            'files': list(self.files),
+            'error': self.error,
+        }
+
+
+class Profiler:
+    """Starts and stops profiling windows on a running server.
+
+    While no window is open, call() is a single attribute check before the
+    wrapped function runs, so profiling costs nothing when off. During a
+    window, each separation call that matches the session/model filter runs
+    under its own cProfile (and, if asked, torch.profiler); the event loop
+    thread is profiled as a whole. When the window closes (after `seconds`, or
+    on stop()) the results are written as pstats files per session and model,
+    a readable summary, and one merged Chrome trace of the forward passes.
+    """
+
+    def __init__(self, server_type, directory=PROFILE_DIR, torch_supported=False, keep_runs=20):
+        self.server_type = server_type
+        self.directory = directory
+        self.torch_supported = torch_supported
+        self.keep_runs = keep_runs
+        self.active = None
+        self.loop = None  # Event loop to profile; set by the server once it is running
+        self._runs = []
+        self._lock = threading.Lock()
+        self._torch_lock = threading.Lock()  # torch.profiler can only record one forward pass at a time
+        self._torch_ready = threading.Event()
+        self._timer = None
+
+    def start(self, seconds=10.0, session_id=None, model=None, torch_trace=False):
+        """Open a profiling window; raises RuntimeError if one is already open"""
+        seconds = float(seconds)
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {MAX_PROFILE_SECONDS:g}, got {seconds:g}")
+        if session_id is not None:
+            # Session ids are ints; a filter sent as "3" would otherwise never match anything
+            if isinstance(session_id, bool) or not isinstance(session_id, (int, str)):
+                raise ValueError(f"session must be a session id, got {session_id!r}")
+            try:
+                session_id = int(session_id)
+            except ValueError:
+                raise ValueError(f"session must be a session id, got {session_id!r}") from None
+        if torch_trace and not self.torch_supported:
+            raise ValueError(f"torch traces are not available on the {self.server_type} server")
+        with self._lock:
+            if self.active is not None:
+                raise RuntimeError(f"Profile {self.active.id} is already running")
+            run = ProfileRun(self.directory, seconds, session_id, model, torch_trace)
+            self._runs.append(run)
+            del self._runs[:-self.keep_runs]
+            if self.loop is not None:
+                run.loop_profile = cProfile.Profile()
+                self.loop.call_soon_threadsafe(self._enable_loop_profile, run)
+            self.active = run
+            if torch_trace and not self._torch_ready.is_set():
+                threading.Thread(target=self._warm_up_torch, daemon=True).start()
+            self._timer = threading.Timer(seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+        logger.info(f"Profiling started: {run.id} for {seconds:g}s")
+        return run.describe()
+
+    def _warm_up_torch(self):
+        """Profile nothing once: the first torch.profiler session takes seconds to initialise"""
+        # Imported here so torch.profiler is only set up once a trace is asked for
+        from torch.profiler import ProfilerActivity, profile as torch_profile
+
+        with self._torch_lock:
+            started = time.perf_counter()
+            with torch_profile(activities=[ProfilerActivity.CPU]):
+                pass
+        logger.info(f"torch.profiler ready after {time.perf_counter() - started:.1f}s")
+        self._torch_ready.set()
+
+    def _enable_loop_profile(self, run):
+        try:
+            run.loop_profile.enable()
+        except ValueError as e:  # Another profiler already owns this thread (or, on 3.12+, the process)
+            logger.warning(f"Cannot profile the event loop: {e}")
+            run.loop_profile = None
+
+    def _disable_loop_profile(self, run):
+        if run.loop_profile is not None:
+            run.loop_profile.disable()
+        run.loop_stopped.set()
+
+    def stop(self):
+        """Close the open window and write its results; returns its description (None if none was open)"""
+        with self._lock:
+            run = self.active
+            if run is None:
+                return None
+            self.active = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if run.loop_profile is not None and self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._disable_loop_profile, run)
+            if not run.loop_stopped.wait(5.0):
+                logger.warning(f"Event loop did not stop profiling for {run.id}; its profile is skipped")
+                run.loop_profile = None
+        try:
+            self._write(run)
+        except Exception as e:
+            logger.error(f"Could not write profile {run.id}: {e}", exc_info=True)
+            run.error = str(e)
+        run.finished_at = time.time()
+        logger.info(f"Profiling finished: {run.id} ({run.calls} calls) in {run.directory}")
+        return run.describe()
+
+    def call(self, session_id, model, fn, *args, **kwargs):
+        """fn(*args, **kwargs), profiled if a matching window is open (blocking; runs in the caller's thread)"""
+        run = self.active
+        if run is None or not run.matches(session_id, model):
+            return fn(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Python 3.12+ allows one cProfile per process; the event loop profile has it
+            with self._lock:
+                run.skipped_calls += 1
+            return self._call_traced(run, session_id, model, fn, args, kwargs)
+        try:
+            return self._call_traced(run, session_id, model, fn, args, kwargs)
+        finally:
+            profile.disable()
+            stats = pstats.Stats(profile)
+            with self._lock:
+                run.calls += 1
+                key = (session_id, model)
+                if key in run.stats:
+                    run.stats[key].add(stats)
+                else:
+                    run.stats[key] = stats
+
+    def _call_traced(self, run, session_id, model, fn, args, kwargs):
+        """fn under torch.profiler when the run asked for traces and has room for more"""
+        if not run.torch_trace or run.torch_traces >= MAX_TORCH_TRACES or not self._torch_ready.is_set():
+            return fn(*args, **kwargs)
+        from torch.profiler import ProfilerActivity, profile as torch_profile
+
+        with self._torch_lock:
+            with torch_profile(activities=[ProfilerActivity.CPU], record_shapes=True) as trace:
+                result = fn(*args, **kwargs)
+            handle, path = tempfile.mkstemp(suffix='.json')
+            os.close(handle)
+            try:
+                trace.export_chrome_trace(path)
+                with open(path) as trace_file:
+                    events = json.load(trace_file).get('traceEvents', [])
+            finally:
+                os.remove(path)
+        tags = {'session': session_id, 'model': model}
+        for event in events:
+            event.setdefault('args', {}).update(tags)
+        with self._lock:
+            run.torch_events.extend(events)
+            run.torch_traces += 1
+        return result
+
+    def _write(self, run):
+        os.makedirs(run.directory, exist_ok=True)
+        summary = io.StringIO()
+
+        def dump(stats, name, title):
+            path = os.path.join(run.directory, name)
+            stats.dump_stats(path)
+            run.files.append(name)
+            summary.write(f"==== {title} ====\n")
+            stats.stream = summary
+            stats.sort_stats('cumulative').print_stats(30)
+
+        for (session_id, model), stats in sorted(run.stats.items(), key=lambda item: str(item[0])):
+            session_name = f"session{session_id}" if session_id is not None else 'batch'
+            dump(stats, f"separation-{session_name}-{_slug(model)}.pstats",
+                 f"Separation calls: session {session_id}, model {model}")
+        if run.loop_profile is not None:
+            dump(pstats.Stats(run.loop_profile), 'event-loop.pstats', 'Event loop (all sessions)')
+
+        if run.torch_events:
+            with open(os.path.join(run.directory, 'torch-trace.json'), 'w') as trace_file:
+                json.dump({'traceEvents': run.torch_events}, trace_file)
+            run.files.append('torch-trace.json')
+            run.torch_events = []
+
+        with open(os.path.join(run.directory, 'summary.txt'), 'w') as summary_file:
+            summary_file.write(summary.getvalue())
+        run.files.append('summary.txt')
+        with open(os.path.join(run.directory, 'profile.json'), 'w') as meta_file:
+            json.dump(dict(run.describe(), server=self.server_type), meta_file, indent=2)
+        run.files.append('profile.json')
+
+    def runs(self):
+        with self._lock:
+            return [run.describe() for run in self._runs]
+
+    def artifact(self, run_id, name):
+        """Path of a file a finished run wrote, or None"""
+        with self._lock:
+            run = next((run for run in self._runs if run.id == run_id), None)
+        if run is None or name not in run.files:
+            return None
+        return os.path.join(run.directory, name)
@@ -0,0 +1,148 @@
+"""
+Streaming polyphase resampling between the browser's sample rate and a model's native rate
+"""
+
+import functools
+import logging
+from math import gcd
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Filter taps per polyphase branch; the filter delays audio by about half this many input frames
+TAPS_PER_PHASE = 32
+KAISER_BETA = 8.6
+# Passband edge as a fraction of the lower Nyquist frequency
+ROLLOFF = 0.94
+
+
+def delay_seconds(from_rate, to_rate, taps_per_phase=TAPS_PER_PHASE):
+    """How long the resampling filter holds audio back; 0 when the rates match and nothing is filtered"""
+    from_rate, to_rate = int(from_rate), int(to_rate)
+    if from_rate == to_rate:
+        return 0.0
+    # Group delay of the linear-phase filter: half its length at the upsampled rate
+    up = to_rate // gcd(from_rate, to_rate)
+    return (taps_per_phase * up - 1) / (2.0 * up) / from_rate
+
+
+@functools.lru_cache(maxsize=16)
+def polyphase_bank(up, down, taps_per_phase=TAPS_PER_PHASE):
+    """Kaiser-windowed sinc low-pass split into `up` branches: bank[phase, tap] = h[phase + tap * up]"""
+    length = up * taps_per_phase
+    cutoff = ROLLOFF * 0.5 / max(up, down)  # In cycles per sample of the upsampled signal
+    n = np.arange(length) - (length - 1) / 2.0
+    h = 2.0 * cutoff * np.sinc(2.0 * cutoff * n) * np.kaiser(length, KAISER_BETA) * up
+    bank = np.ascontiguousarray(h.reshape(taps_per_phase, up).T, dtype=np.float32)
+    bank.setflags(write=False)  # Shared by every resampler with the same rate pair
+    return bank
+
+
+@functools.lru_cache(maxsize=16)
+def polyphase_table(up, down, taps_per_phase=TAPS_PER_PHASE):
+    """The bank laid out for one matrix product: table[frame, r] weights input `frame` for output r of a run of `up`.
+
+    Output r of a run starting at input frame 0 reads taps at frames r * down // up
+    onwards with phase r * down % up, and every later run of `up` outputs starts
+    `down` frames further on, so a [runs, down + taps - 1] strided view of the
+    input times this table gives `up` outputs per run.
+    """
+    reversed_bank = polyphase_bank(up, down, taps_per_phase)[:, ::-1]  # Taps in input order
+    steps = np.arange(up) * down
+    frames = (steps // up)[:, None] + np.arange(taps_per_phase)
+    table = np.zeros((down + taps_per_phase - 1, up), dtype=np.float32)
+    table[frames, np.arange(up)[:, None]] = reversed_bank[steps % up]
+    table.setflags(write=False)
+    return table
+
+
+class StreamingResampler:
+    """Converts [..., frames] audio from one sample rate to another, chunk by chunk.
+
+    The last taps-1 input frames and the output phase are carried between
+    calls, so the output of consecutive chunks is identical to resampling the
+    whole stream at once. Leading axes (channels, stems) are processed
+    together; if their shape changes the filter state starts afresh.
+    """
+
+    def __init__(self, from_rate, to_rate, taps_per_phase=TAPS_PER_PHASE):
+        self.from_rate = int(from_rate)
+        self.to_rate = int(to_rate)
+        divisor = gcd(self.from_rate, self.to_rate)
+        self.up = self.to_rate // divisor
+        self.down = self.from_rate // divisor
+        self.bank = polyphase_bank(self.up, self.down, taps_per_phase) if self.up != self.down else None
+        self.table = polyphase_table(self.up, self.down, taps_per_phase) if self.bank is not None else None
+        # Outputs this many runs-of-up apart from a phase-0 output; see process()
+        self._inverse_down = pow(self.down, -1, self.up) if self.up > 1 else 0
+        self.taps = taps_per_phase
+        self.lead = 0  # Output starts this far into the input, in 1/up input frames (see skip())
+        self.reset()
+
+    @property
+    def passthrough(self):
+        return self.bank is None
+
+    def reset(self):
+        self._history = None
+        self._position = self.lead  # Next output's position past the end of the history, in 1/up input frames
+
+    def skip(self, seconds):
+        """Start the output `seconds` into the input (to 1/up of an input frame), e.g. to take out a known delay"""
+        if not self.passthrough:
+            self.lead = int(round(seconds * self.from_rate * self.up))
+        self.reset()
+
+    def output_frames(self, input_frames):
+        """Frames the next call to process() returns for this many input frames"""
+        if self.passthrough:
+            return input_frames
+        remaining = input_frames * self.up - self._position
+        return max(0, -(-remaining // self.down))
+
+    def process(self, audio):
+        if self.passthrough:
+            return audio
+
+        audio = np.asarray(audio, dtype=np.float32)
+        leading = audio.shape[:-1]
+        history_frames = self.taps - 1
+        if self._history is None or self._history.shape[:-1] != leading:
+            self._history = np.zeros(leading + (history_frames,), dtype=np.float32)
+            self._position = self.lead
+
+        frames = audio.shape[-1]
+        count = self.output_frames(frames)
+
+        # polyphase_table() is laid out for runs that start on phase 0. Step back `skip` outputs
+        # to where one would (at most up - 1, which reach at most `down` frames before the
+        # history), compute whole runs from there and drop the extra outputs again.
+        skip = self._position * self._inverse_down % self.up
+        first = (self._position - skip * self.down) // self.up  # Input frame of that phase-0 output
+        runs = max(1, -(-(skip + count) // self.up))
+        width = self.table.shape[0]
+        before = max(0, -first)
+        used = history_frames + frames
+        after = max(0, first + (runs - 1) * self.down + width - used)
+        buffer = np.zeros(leading + (before + used + after,), dtype=np.float32)
+        buffer[..., before:before + history_frames] = self._history
+        buffer[..., before + history_frames:before + used] = audio
+
+        # runs_view[..., run, :] is the `width` frames run `run` reads, `down` frames after the previous one
+        runs_view = np.lib.stride_tricks.sliding_window_view(buffer[..., before + first:], width, axis=-1)
+        runs_view = runs_view[..., :(runs - 1) * self.down + 1:self.down, :]
+        output = (runs_view @ self.table).reshape(leading + (runs * self.up,))[..., skip:skip + count]
+
+        self._position += count * self.down - frames * self.up
+        self._history = buffer[..., before + used - history_frames:before + used].copy()
+        return output
+
+    def describe(self):
+        return {
+            'from_rate': self.from_rate,
+            'to_rate': self.to_rate,
+            'ratio': f"{self.up}/{self.down}",
+            'taps_per_phase': self.taps,
+            'delay_ms': round(1000.0 * delay_seconds(self.from_rate, self.to_rate, self.taps), 3),
+        }
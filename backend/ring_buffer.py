@@ -0,0 +1,108 @@
+"""
+Fixed-capacity float32 ring buffer for streaming audio
+"""
+
+import numpy as np
+
+
+class AudioRingBuffer:
+    """Preallocated [frames, channels] ring buffer that hands out windows as numpy views.
+
+    The storage is mirrored (every frame is written at index i and i + capacity),
+    so any window of up to `capacity` frames is contiguous and can be returned
+    as a view without copying, even when it wraps around.
+
+    Three cursors are tracked, all as absolute frame counts:
+      write   - frames written so far
+      read    - start of the next window handed out by read_window()
+      release - frames whose storage may be reused; windows that were handed
+                out stay valid until release() moves past them
+    """
+
+    def __init__(self, capacity_frames, channels=2):
+        self.capacity = int(capacity_frames)
+        self.channels = int(channels)
+        self._storage = np.zeros((2 * self.capacity, self.channels), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self._write_pos = 0
+        self._read_pos = 0
+        self._release_pos = 0
+        self.high_water_mark = 0
+        self.overflow_count = 0
+        self.overflow_frames = 0
+
+    @property
+    def readable(self):
+        """Frames written but not yet handed out by read_window()"""
+        return self._write_pos - self._read_pos
+
+    @property
+    def used(self):
+        """Frames occupying storage (readable plus handed out but not released)"""
+        return self._write_pos - self._release_pos
+
+    @property
+    def free(self):
+        return self.capacity - self.used
+
+    def write(self, samples):
+        """Append interleaved samples. Frames that don't fit are dropped and counted as overflow.
+
+        Returns the number of frames written.
+        """
+        frames = np.asarray(samples, dtype=np.float32).reshape(-1, self.channels)
+        count = len(frames)
+        if count > self.free:
+            self.overflow_count += 1
+            self.overflow_frames += count - self.free
+            count = self.free
+            frames = frames[:count]
+        if count == 0:
+            return 0
+
+        start = self._write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self._storage[start:start + first] = frames[:first]
+        self._storage[start + self.capacity:start + self.capacity + first] = frames[:first]
+        if first < count:
+            rest = count - first
+            self._storage[:rest] = frames[first:]
+            self._storage[self.capacity:self.capacity + rest] = frames[first:]
+
+        self._write_pos += count
+        self.high_water_mark = max(self.high_water_mark, self.used)
+        return count
+
+    def read_window(self, frames, advance=None):
+        """Return a [frames, channels] view starting at the read cursor, or None if not enough data.
+
+        The read cursor moves forward by `advance` frames (default: `frames`), so
+        consecutive windows may overlap. The view stays valid until release().
+        """
+        frames = int(frames)
+        if frames > self.capacity:
+            raise ValueError(f"Window of {frames} frames exceeds ring capacity {self.capacity}")
+        if self.readable < frames:
+            return None
+
+        start = self._read_pos % self.capacity
+        window = self._storage[start:start + frames]
+        self._read_pos += frames if advance is None else int(advance)
+        return window
+
+    def release(self, frames):
+        """Allow the oldest `frames` handed-out frames to be overwritten"""
+        self._release_pos = min(self._release_pos + int(frames), self._read_pos)
+
+    def stats(self):
+        return {
+            'capacity_frames': self.capacity,
+            'channels': self.channels,
+            'readable_frames': self.readable,
+            'used_frames': self.used,
+            'high_water_mark': self.high_water_mark,
+            'overflow_count': self.overflow_count,
+            'overflow_frames': self.overflow_frames,
+        }
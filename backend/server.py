@@ -1,52 +1,133 @@
 """
 Local server for real-time audio separation using Ultimate Vocal Remover API
+
+The WebSocket/HTTP core is shared by every engine in engines.py (UVR, Hance and
+a mock); each session picks one in configure. hance_server.py starts this
+server with Hance as the default engine.
 """
 
+import argparse
 import asyncio
 import json
 import logging
 import numpy as np
 import websockets
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
+import tempfile
 import threading
-import torch
-import sys
+import time
 import os
-from pathlib import Path
-
-# Add ultimatevocalremover_api to path
-PROJECT_ROOT = Path(__file__).parent.parent
-UVR_API_PATH = PROJECT_ROOT / "ultimatevocalremover_api"
-if str(UVR_API_PATH) not in sys.path:
-    sys.path.insert(0, str(UVR_API_PATH))
 
-UVR_SRC_PATH = UVR_API_PATH / "src"
-if str(UVR_SRC_PATH) not in sys.path:
-    sys.path.insert(0, str(UVR_SRC_PATH))
+import engines
+from engines import HanceEngine, MockEngine, UVREngine
+try:
+    from utils.fastio import read  # engines puts ultimatevocalremover_api on sys.path
+except ImportError:
+    read = None  # ultimatevocalremover_api missing; offline jobs still read WAV (and more with soundfile)
 
-from models import Demucs, VrNetwork, MDX, MDXC
-from utils.fastio import read
+from audio_protocol import (
+    MSG_AUDIO_DATA, MSG_SEPARATED_AUDIO, PROTOCOL_BINARY, PROTOCOL_JSON, SUPPORTED_PROTOCOLS,
+    HEADER_SIZE, PROTOCOL_VERSION, ProtocolError, as_float32, decode_frame, encode_frame,
+    negotiate_protocol
+)
+from batching import BatchScheduler
+from memory_manager import MemoryManager
+from metrics import CONTENT_TYPE, PipelineMetrics, model_label
+from mock_engine import DEFAULT_REALTIME_FACTOR
+from model_loader import ModelLoader, ModelSwap
+from offline_jobs import OfflineJobManager
+from postprocess import OUTPUT_DTYPES
+from profiling import Profiler
+from resampler import StreamingResampler, delay_seconds
+from session import Session
+from stem_cache import StemCache
+from streaming import OverlapAddStream
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def check_blocks_per_chunk(blocks_per_chunk):
+    if blocks_per_chunk is not None and (isinstance(blocks_per_chunk, bool) or not isinstance(blocks_per_chunk, int)
+                                         or blocks_per_chunk < 1):
+        raise ValueError(f"blocks_per_chunk must be a positive integer, got {blocks_per_chunk!r}")
+
 class AudioSeparationServer:
-    def __init__(self, host='localhost', port=8765, http_port=8766):
+    def __init__(self, host='localhost', port=8765, http_port=8766, model_cache_bytes=2 * 1024 ** 3,
+                 inference_workers=0, offline_workers=1, batch_window_ms=10.0, max_batch=8, memory_budget_bytes=4 * 1024 ** 3,
+                 stem_cache_bytes=1024 ** 3, stem_cache_dir=None, mock_realtime_factor=None, default_engine='uvr'):
         self.host = host
         self.port = port
         self.http_port = http_port
-        self.clients = set()
-        self.current_model = None
-        self.model_config = {'model': 'hdemucs_mmi', 'realTime': True} 
-        self.processing_queue = asyncio.Queue()
-        self.is_processing = False
-
-        # Reduced buffer size for memory optimization
-        self.audio_buffer = []
-        self.buffer_target_samples = 44100 * 1  # Reduced to 1 second
-        self.current_sample_rate = 44100
-        self.current_channels = 2
+        self.sessions = {}  # websocket -> Session
+        self.metrics = PipelineMetrics()
+        self.profiler = Profiler(default_engine, torch_supported=True)
+
+        # Garbage is collected only when memory use nears this budget, not after every chunk
+        self.memory_manager = MemoryManager(memory_budget_bytes)
+
+        # Every engine is available to every session; with mock_realtime_factor set, the UVR and
+        # Hance engines run mock models at that speed (for benchmarks)
+        self.uvr = UVREngine(
+            self.memory_manager,
+            model_cache_bytes=model_cache_bytes,
+            inference_workers=inference_workers,
+            offline_workers=offline_workers,
+            memory_budget_bytes=memory_budget_bytes,
+            mock_realtime_factor=mock_realtime_factor
+        )
+        self.hance = HanceEngine(mock_realtime_factor=mock_realtime_factor)
+        self.engines = {engine.name: engine for engine in (
+            self.uvr, self.hance, MockEngine(mock_realtime_factor or DEFAULT_REALTIME_FACTOR)
+        )}
+        if default_engine not in self.engines:
+            raise ValueError(f"Unknown engine '{default_engine}', expected one of {', '.join(self.engines)}")
+        self.default_engine = default_engine
+
+        # Models load on threads of their own while sessions keep separating with their current one;
+        # a client hears how a load is going this often
+        self.model_loader = ModelLoader()
+        self.load_progress_seconds = 1.0
+
+        # Chunks from sessions sharing a model are separated together; a 0 ms window disables it.
+        # Only engines that declare batching support use it.
+        self.batch_scheduler = None
+        if batch_window_ms > 0 and max_batch > 1 and any(e.supports_batching for e in self.engines.values()):
+            self.batch_scheduler = BatchScheduler(
+                self.run_batch,
+                window_ms=batch_window_ms,
+                max_batch=max_batch
+            )
+
+        # Chunk sizes come from each engine's native block; stateful engines (Hance) get the
+        # whole number of blocks closest to this, unless the client asks otherwise
+        self.target_chunk_seconds = 0.1
+
+        # Load shedding: at most this many chunks wait per session, and a chunk whose output
+        # cannot be sent within the latency budget is dropped ('mix' passes the input through instead).
+        # The default budget is one chunk plus the model's delay, but never below the minimum.
+        self.max_queue_chunks = 4
+        self.min_latency_budget_ms = 300
+        self.drop_fallback = 'mix'
+
+        # Per-session incoming audio capacity: room for twice the queued and in-flight chunks
+        self.min_ring_buffer_seconds = 5
+
+        # Separated windows of stateless engines are kept on disk so replayed audio skips inference;
+        # 0 bytes disables it
+        self.stem_cache = None
+        if stem_cache_bytes > 0:
+            self.stem_cache = StemCache(stem_cache_bytes, **({'directory': stem_cache_dir} if stem_cache_dir else {}))
+
+        # Whole-file jobs from POST /separate run on UVR, on their own worker processes if there are any
+        offline_slots = (offline_workers or inference_workers) if self.uvr.inference_pool is not None else 1
+        self.offline_jobs = OfflineJobManager(
+            self.uvr.open_offline_model, self.uvr.run_offline_window, self.uvr.close_offline_model,
+            model_rate=self.uvr.model_sample_rate,
+            max_parallel=max(1, offline_slots),
+            read_audio=read,
+            max_window_frames=self.uvr.inference_pool.max_frames if self.uvr.inference_pool is not None else None
+        )
         
         self.app = Flask(__name__)
         CORS(self.app)
@@ -57,22 +138,157 @@ class AudioSeparationServer:
         def health_check():
             return jsonify({
                 'status': 'healthy',
-                'model_loaded': self.current_model is not None,
-                'clients_connected': len(self.clients)
+                'model_loaded': any(session.model is not None for session in list(self.sessions.values())),
+                'clients_connected': len(self.sessions)
             })
+
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics_route():
+            return Response(self.metrics.render(list(self.sessions.values())), mimetype=CONTENT_TYPE)
+
+        @self.app.route('/profile/start', methods=['POST'])
+        def start_profile_route():
+            options = request.get_json(silent=True) or {}
+            try:
+                run = self.profiler.start(
+                    seconds=options.get('seconds', 10),
+                    session_id=options.get('session'),
+                    model=options.get('model'),
+                    torch_trace=bool(options.get('torch', False))
+                )
+            except RuntimeError as e:
+                return jsonify({'error': str(e)}), 409
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(run), 202
+
+        @self.app.route('/profile/stop', methods=['POST'])
+        def stop_profile_route():
+            run = self.profiler.stop()
+            if run is None:
+                return jsonify({'error': 'No profile is running'}), 404
+            return jsonify(run)
+
+        @self.app.route('/profile', methods=['GET'])
+        def list_profiles_route():
+            return jsonify(self.profiler.runs())
+
+        @self.app.route('/profile/<run_id>/<name>', methods=['GET'])
+        def profile_file_route(run_id, name):
+            path = self.profiler.artifact(run_id, name)
+            if path is None:
+                return jsonify({'error': f'No file {name} in profile {run_id}'}), 404
+            return send_file(path, as_attachment=True)
+
+        @self.app.route('/sessions', methods=['GET'])
+        def list_sessions_route():
+            return jsonify([session.describe() for session in list(self.sessions.values())])
         
+        @self.app.route('/engines', methods=['GET'])
+        def list_engines_route():
+            return jsonify([dict(engine.describe(), default=name == self.default_engine)
+                            for name, engine in self.engines.items()])
+
         @self.app.route('/models', methods=['GET'])
         def list_models_route(): # Renamed to avoid conflict
+            engine = self.engines.get(request.args.get('engine', self.default_engine))
+            if engine is None:
+                return jsonify({'error': f"Unknown engine, expected one of {', '.join(self.engines)}"}), 404
             try:
-                models_available = { # Renamed variable
-                    'demucs': Demucs.list_models(),
-                    'vr_network': VrNetwork.list_models(),
-                    'mdx': MDX.list_models(),
-                    'mdxc': MDXC.list_models()
-                }
-                return jsonify(models_available)
+                return jsonify(engine.list_models())
             except Exception as e:
                 return jsonify({'error': str(e)}), 500
+
+        @self.app.route('/models/cache', methods=['GET'])
+        def model_cache_route():
+            return jsonify(self.uvr.model_registry.stats())
+
+        @self.app.route('/models/loading', methods=['GET'])
+        def model_loading_route():
+            return jsonify(self.model_loader.stats())
+
+        @self.app.route('/processors', methods=['GET'])
+        def processors_route():
+            return jsonify(self.hance.processor_pool.stats())
+
+        @self.app.route('/workers', methods=['GET'])
+        def workers_route():
+            if self.uvr.inference_pool is None:
+                return jsonify({'workers': [], 'mode': 'in-process'})
+            return jsonify(dict(self.uvr.inference_pool.stats(), mode='process-pool'))
+
+        @self.app.route('/memory', methods=['GET'])
+        def memory_route():
+            return jsonify(self.memory_manager.stats())
+
+        @self.app.route('/batching', methods=['GET'])
+        def batching_route():
+            if self.batch_scheduler is None:
+                return jsonify({'enabled': False})
+            return jsonify(dict(self.batch_scheduler.stats(), enabled=True))
+
+        @self.app.route('/stems/cache', methods=['GET'])
+        def stem_cache_route():
+            if self.stem_cache is None:
+                return jsonify({'enabled': False})
+            return jsonify(dict(self.stem_cache.stats(), enabled=True))
+
+        @self.app.route('/separate', methods=['POST'])
+        def submit_separation_route():
+            # JSON {"path": ...} for a local file, or a multipart upload in 'file' with options as form fields
+            upload = request.files.get('file')
+            options = request.form.to_dict() if upload is not None else (request.get_json(silent=True) or {})
+            stems = options.get('stems')
+            if isinstance(stems, str):
+                stems = [stem.strip() for stem in stems.split(',') if stem.strip()]
+            try:
+                if options.get('engine', self.uvr.name) != self.uvr.name:
+                    return jsonify({'error': "Offline jobs run on the 'uvr' engine only"}), 400
+                if stems is not None:
+                    if not isinstance(stems, list):
+                        return jsonify({'error': "stems must be a list or a comma-separated string"}), 400
+                    unknown = [stem for stem in stems if stem not in self.uvr.stems]
+                    if unknown:
+                        return jsonify({'error': f"Unknown stems {', '.join(map(str, unknown))}, "
+                                                 f"expected some of {', '.join(self.uvr.stems)}"}), 400
+                spec = self.uvr.resolve(options, offline=True)
+                if upload is not None:
+                    suffix = os.path.splitext(upload.filename or '')[1] or '.wav'
+                    handle, source = tempfile.mkstemp(prefix='upload-', suffix=suffix)
+                    os.close(handle)
+                    upload.save(source)
+                    try:
+                        job = self.offline_jobs.submit(source, spec, options.get('output_dir'), stems, remove_source=True)
+                    except Exception:
+                        os.remove(source)
+                        raise
+                elif options.get('path'):
+                    job = self.offline_jobs.submit(options['path'], spec, options.get('output_dir'), stems)
+                else:
+                    return jsonify({'error': "Send a 'path' to a local audio file or upload one as 'file'"}), 400
+            except FileNotFoundError as e:
+                return jsonify({'error': str(e)}), 404
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify(job.describe()), 202
+
+        @self.app.route('/separate', methods=['GET'])
+        def list_separations_route():
+            return jsonify([job.describe() for job in self.offline_jobs.list()])
+
+        @self.app.route('/separate/<job_id>', methods=['GET'])
+        def separation_status_route(job_id):
+            job = self.offline_jobs.get(job_id)
+            if job is None:
+                return jsonify({'error': f'Unknown job {job_id}'}), 404
+            return jsonify(job.describe())
+
+        @self.app.route('/separate/<job_id>/cancel', methods=['POST'])
+        def cancel_separation_route(job_id):
+            job = self.offline_jobs.cancel(job_id)
+            if job is None:
+                return jsonify({'error': f'Unknown job {job_id}'}), 404
+            return jsonify(job.describe())
     
     async def register_client(self, *args): # MODIFIED for diagnostics
         """Register a new WebSocket client"""
@@ -87,22 +303,46 @@ class AudioSeparationServer:
         # If path is missing, it's an issue with the library call or version
         path = args[1] if len(args) > 1 else "/" 
 
-        self.clients.add(websocket)
-        logger.info(f"Client connected from path: '{path}'. Total clients: {len(self.clients)}")
+        session = Session(websocket, path, max_queue=self.max_queue_chunks)
+        session.model_config = {'engine': self.default_engine, 'model': self.engines[self.default_engine].default_model}
+        self.sessions[websocket] = session
+        logger.info(f"Client connected from path: '{path}' (session {session.id}). Total clients: {len(self.sessions)}")
         
         try:
-            await self.handle_client(websocket)
+            await self.handle_client(session)
         finally:
-            if websocket in self.clients:
-                self.clients.remove(websocket)
-                logger.info(f"Client disconnected (Path: '{path}'). Total clients: {len(self.clients)}")
+            self.sessions.pop(websocket, None)
+            await session.close()
+            if session.engine is not None:
+                session.engine.close(session)
+            # Models loaded for it that never took over; a load still running discards its own
+            for swap in [session.pending_swap] + list(session.swaps.values()):
+                if swap is not None:
+                    swap.engine.discard(session, swap.prepared)
+            session.pending_swap = None
+            session.swaps = {}
+            logger.info(f"Client disconnected (Path: '{path}', session {session.id}). Total clients: {len(self.sessions)}")
 
-    async def handle_client(self, websocket):
+    async def handle_client(self, session):
         """Handle messages from a WebSocket client"""
+        websocket = session.websocket
         async for message in websocket:
             try:
+                if isinstance(message, (bytes, bytearray, memoryview)):
+                    await self.process_binary_message(session, message)
+                    continue
+                decode_started = time.perf_counter()
                 data = json.loads(message)
-                await self.process_message(websocket, data)
+                if data.get('type') == 'audio_data' and isinstance(data.get('data'), list):
+                    # Converted here so the decode timing covers the whole list-to-array cost
+                    data['data'] = np.asarray(data['data'], dtype=np.float32)
+                    self.metrics.observe_stage(session, 'decode_json', time.perf_counter() - decode_started)
+                await self.process_message(session, data)
+            except ProtocolError as e:
+                await websocket.send(json.dumps({
+                    'type': 'error',
+                    'error': f'Invalid binary frame: {e}'
+                }))
             except json.JSONDecodeError:
                 await websocket.send(json.dumps({
                     'type': 'error',
@@ -115,17 +355,53 @@ class AudioSeparationServer:
                     'error': str(e)
                 }))
     
-    async def process_message(self, websocket, data):
+    async def process_message(self, session, data):
         """Process incoming WebSocket messages"""
+        websocket = session.websocket
         message_type = data.get('type')
-        logger.info(f"Server received WebSocket message. Type: '{message_type}', Data: {data}") # ADD THIS LOG
+        if message_type != 'audio_data':
+            logger.info(f"Session {session.id} received WebSocket message. Type: '{message_type}', Data: {data}")
 
-        
-        if message_type == 'configure':
-            await self.configure_model(websocket, data.get('config', {}))
+        if message_type == 'hello':
+            await self.negotiate_protocol(session, data.get('protocols', [PROTOCOL_JSON]))
+        elif message_type == 'configure':
+            config_data = data.get('config', {})
+            if 'protocol' in config_data:
+                await self.negotiate_protocol(session, config_data['protocol'])
+            if 'stems' in config_data:
+                session.set_subscription(config_data['stems'])
+            if 'gains' in config_data:
+                session.set_gains(config_data['gains'])
+            if 'output' in config_data:
+                session.set_output(config_data['output'])
+            if config_data.get('output_dtype', 'float32') not in OUTPUT_DTYPES:
+                raise ValueError(f"Unknown output_dtype '{config_data['output_dtype']}', "
+                                 f"expected one of {', '.join(OUTPUT_DTYPES)}")
+            await self.configure_model(session, config_data)
+        elif message_type == 'subscribe':
+            session.set_subscription(data.get('stems'))
+            await websocket.send(json.dumps({
+                'type': 'status',
+                'status': 'Stem subscription updated',
+                'stems': sorted(session.stems) if session.stems is not None else None
+            }))
+        elif message_type == 'set_gains':
+            # Sent on every slider move, so applied silently
+            session.set_gains(data.get('gains', {}))
         elif message_type == 'audio_data':
-            #logger.info(f"Received audio_data message: {data}") # Verbose log
-            await self.queue_audio_processing(websocket, data)
+            audio_data_list = data.get('data')
+            if audio_data_list is None or len(audio_data_list) == 0:
+                logger.warning(f"No audio data in payload. Data payload keys: {list(data.keys())}")
+                await websocket.send(json.dumps({'type': 'error', 'error': 'No audio data in payload'}))
+                return
+            session.chunk_seq += 1
+            await self.queue_audio_processing(
+                session,
+                np.asarray(audio_data_list, dtype=np.float32),
+                data.get('sample_rate', 44100),
+                data.get('channels', 2),
+                data.get('timestamp', 0)
+            )
         else:
             logger.warning(f"Unknown message type received: {message_type}") # ADD THIS LOG
             await websocket.send(json.dumps({
@@ -133,280 +409,607 @@ class AudioSeparationServer:
                 'error': f'Unknown message type: {message_type}'
             }))
     
-    async def configure_model(self, websocket, config_data):
-        """Configure the separation model"""
-        try:
-            model_name = config_data.get('model', self.model_config.get('model', 'hdemucs_mmi'))
-            real_time = config_data.get('realTime', self.model_config.get('realTime', True))
-            
-            logger.info(f"Configuring model: {model_name} with config: {config_data}")
-            
-            # Force CPU-only operation with environment variable
-            os.environ['CUDA_VISIBLE_DEVICES'] = ''  # Disable CUDA
-            os.environ['PYTORCH_MPS_HIGH_WATERMARK_RATIO'] = '0.0'  # Disable MPS limits
-            
-            # Optimized metadata for memory efficiency (removed device from here)
-            self.model_config = config_data 
-            demucs_metadata = {
-                'segment': 1,  # Very small segment
-                'split': True,
-                'overlap': 0.05,  # Minimal overlap
-                'shifts': 0      # No shifts
-            }
-            
-            # VR/MDX metadata with memory optimizations (removed device from here)
-            vr_mdx_metadata = {
-                'aggressiveness': config_data.get('aggressiveness', 0.05),
-                'batch_size': 1
-            }
+    async def process_binary_message(self, session, message):
+        """Process a binary audio frame (see audio_protocol.py)"""
+        with self.metrics.timed(session, 'decode_binary'):
+            frame = decode_frame(message)
+            if frame.msg_type != MSG_AUDIO_DATA:
+                raise ProtocolError(f"Unexpected binary message type: {frame.msg_type}")
+            samples = as_float32(frame.samples)
+        if samples.size == 0:
+            await session.websocket.send(json.dumps({'type': 'error', 'error': 'No audio data in payload'}))
+            return
+        session.chunk_seq = frame.seq
+        await self.queue_audio_processing(
+            session,
+            samples,
+            frame.sample_rate,
+            frame.channels,
+            frame.timestamp
+        )
 
-            # Force CPU usage completely
-            device = 'cpu'
-            logger.info(f"Using device: {device} (forced CPU for memory efficiency)")
-
-            if 'demucs' in model_name.lower():
-                 logger.info(f"Loading Demucs model: {model_name}")
-                 self.current_model = Demucs(name=model_name, other_metadata=demucs_metadata, device=device)
-            elif model_name.startswith('UVR') or 'MDX' in model_name:
-                if 'MDX' in model_name:
-                    logger.info(f"Loading MDX model: {model_name}")
-                    self.current_model = MDX(name=model_name, other_metadata=vr_mdx_metadata, device=device)
-                else:
-                    logger.info(f"Loading VR model: {model_name}")
-                    self.current_model = VrNetwork(name=model_name, other_metadata=vr_mdx_metadata, device=device)
+    async def negotiate_protocol(self, session, requested):
+        """Agree on the wire protocol used for audio with this client"""
+        protocol = negotiate_protocol(requested)
+        session.protocol = protocol
+        logger.info(f"Session {session.id} requested protocols {requested}, using '{protocol}'")
+        await session.websocket.send(json.dumps({
+            'type': 'protocol',
+            'protocol': protocol,
+            'supported': list(SUPPORTED_PROTOCOLS),
+            'version': PROTOCOL_VERSION,
+            'header_size': HEADER_SIZE
+        }))
+
+    async def send_stem(self, session, stem_name, samples, item, channels=1, dtype='float32'):
+        """Send one separated stem using the client's negotiated protocol"""
+        with self.metrics.timed(session, 'encode'):
+            if session.protocol == PROTOCOL_BINARY:
+                message = encode_frame(
+                    MSG_SEPARATED_AUDIO,
+                    samples,
+                    seq=item.get('seq', 0),
+                    sample_rate=item['sample_rate'],
+                    channels=channels,
+                    stem=stem_name,
+                    timestamp=item['timestamp'],
+                    dtype=dtype
+                )
             else:
-                logger.warning(f"Model type for '{model_name}' not explicitly handled, attempting generic load with hdemucs_mmi.")
-                self.current_model = Demucs(name='hdemucs_mmi', other_metadata=demucs_metadata, device=device)
-                model_name = 'hdemucs_mmi (defaulted due to unknown type)'
-            
-            # Move model to CPU explicitly if it's not already
-            if hasattr(self.current_model, 'model') and hasattr(self.current_model.model, 'cpu'):
-                self.current_model.model = self.current_model.model.cpu()
+                message = json.dumps({
+                    'type': 'separated_audio',
+                    'stem': stem_name,
+                    'channels': channels,
+                    'data': samples.reshape(-1).tolist(), # Send the list of samples (interleaved if channels > 1)
+                    'timestamp': item['timestamp'] # Keep original timestamp for potential sync
+                })
+        with self.metrics.timed(session, 'send'):
+            await session.websocket.send(message)
 
-            await websocket.send(json.dumps({
-                'type': 'status',
-                'status': f'Model {model_name} loaded/configured successfully (CPU mode for memory efficiency)'
-            }))
-            logger.info(f"Model {model_name} loaded successfully on {device}. Type: {type(self.current_model)}")
-            
+    async def send_remix(self, session, item, mixed, postprocessor):
+        """Stitch and send one gain-weighted [channels, frames] mix of all stems in the session's channel count"""
+        with self.metrics.timed(session, 'postprocess'):
+            stream = item.get('stream')
+            if stream is not None:
+                mixed = stream.process(mixed)
+            mixed = session.to_client_rate('remix', mixed, item['model_rate'])
+            if mixed.shape[0] == 1 and item['channels'] > 1:
+                # Mono engines (Hance) mix to one channel; the client plays the remix as it sent it
+                mixed = np.repeat(mixed, item['channels'], axis=0)
+            output = postprocessor.process(mixed[None], keep_stereo=True)[0]
+        await self.send_stem(session, 'remix', output, item, channels=output.shape[1], dtype=postprocessor.dtype)
+
+    def engine_for(self, session, config_data):
+        """The engine a configure asks for; without one the session keeps its engine (or gets the default)"""
+        name = config_data.get('engine') or (session.engine.name if session.engine is not None else self.default_engine)
+        engine = self.engines.get(name)
+        if engine is None:
+            raise ValueError(f"Unknown engine '{name}', expected one of {', '.join(self.engines)}")
+        return engine
+
+    async def configure_model(self, session, config_data):
+        """Start loading the engine and model a configure asks for; the current model serves until it is warm"""
+        try:
+            engine = self.engine_for(session, config_data)
+            default_model = session.model_config.get('model') if engine is session.engine else None
+            model_name = config_data.get('model', default_model or engine.default_model)
+            config_data = dict(config_data, engine=engine.name, model=model_name)
+            check_blocks_per_chunk(config_data.get('blocks_per_chunk'))
         except Exception as e:
-            error_msg = f"Failed to load or configure model '{config_data.get('model', 'N/A')}': {str(e)}"
-            logger.error(error_msg, exc_info=True)
-            await websocket.send(json.dumps({
-                'type': 'error',
-                'error': error_msg
-            }))
-    
-   
+            await self.send_load_error(session, config_data, e)
+            return
 
-    async def queue_audio_processing(self, websocket, data_payload):
-        """Queue audio data for processing with buffering"""
-        if not self.current_model:
-            await websocket.send(json.dumps({'type': 'error', 'error': 'No model loaded/configured'}))
+        logger.info(f"Configuring {engine.name} model: {model_name} with config: {config_data}")
+        # Audio keeps flowing through the current model meanwhile; only the latest configure is swapped in
+        session.load_token += 1
+        session.loading_config = config_data
+        session.loading_task = asyncio.ensure_future(self.load_model(session, engine, config_data, session.load_token))
+
+    def is_current_load(self, session, token):
+        """Whether a load is still the session's latest configure and the client is still connected"""
+        return token == session.load_token and self.sessions.get(session.websocket) is session
+
+    async def send_load_error(self, session, config_data, error):
+        error_msg = f"Failed to load or configure model '{config_data.get('model', 'N/A')}': {str(error)}"
+        logger.error(error_msg, exc_info=True)
+        await session.websocket.send(json.dumps({
+            'type': 'error',
+            'error': error_msg
+        }))
+
+    async def send_loading(self, session, engine, model_name, state, info):
+        """Progress of a background load: 'loading' while it runs, then 'ready' once warm"""
+        status = f"{'Loading' if state == 'loading' else 'Loaded'} {engine.name} model {model_name}"
+        if 'progress' in info:
+            status += f" ({info['progress']:.0%})"
+        await session.websocket.send(json.dumps({
+            'type': 'status',
+            'status': status,
+            'loading': dict(info, state=state, engine=engine.name, model=model_name)
+        }))
+
+    async def load_model(self, session, engine, config_data, token):
+        """Load a model off the event loop, reporting progress, and stage it to take over the session"""
+        model_name = config_data['model']
+        load_started = time.perf_counter()
+        prepared = None
+        try:
+            # Sessions asking for the same model at the same time share one load
+            load = self.model_loader.load((engine.name, engine.load_key(config_data)), engine.warm, config_data)
+            try:
+                while True:
+                    if self.sessions.get(session.websocket) is not session:
+                        return  # Gone; the load itself finishes for whoever else wants the model
+                    if self.is_current_load(session, token):
+                        await self.send_loading(session, engine, model_name, 'loading', load.progress())
+                    done, _ = await asyncio.wait({load.future}, timeout=self.load_progress_seconds)
+                    if done:
+                        break
+            finally:
+                load.leave()
+            load.future.result()
+
+            # The session's own handle on the now warm model, e.g. a processor for its stream format
+            prepared = await self.model_loader.run(engine.prepare, session, config_data)
+            # The client may say what rate it will send at; otherwise the last one it sent (44.1 kHz at first)
+            client_rate = int(config_data.get('sample_rate', session.sample_rate))
+            chunking = self.plan_chunking(engine, prepared.model_name, config_data, client_rate)
+            load_seconds = time.perf_counter() - load_started
+            if self.is_current_load(session, token):
+                await self.send_loading(session, engine, prepared.model_name, 'ready',
+                                        {'load_ms': round(load_seconds * 1000.0, 1)})
+        except Exception as e:
+            if prepared is not None:
+                engine.discard(session, prepared)
+            if self.is_current_load(session, token):
+                await self.send_load_error(session, config_data, e)
             return
-        
-        audio_data_list = data_payload.get('data')
-    
-        if not audio_data_list:
-            logger.warning(f"No audio data in payload. Data payload keys: {list(data_payload.keys())}")
-            await websocket.send(json.dumps({'type': 'error', 'error': 'No audio data in payload'}))
+
+        if not self.is_current_load(session, token):
+            logger.info(f"Session {session.id}: {engine.name} model {prepared.model_name} was superseded, discarding it")
+            engine.discard(session, prepared)
             return
+        await self.stage_swap(session, ModelSwap(engine, prepared, config_data, chunking, load_seconds))
 
-        self.current_sample_rate = data_payload.get('sample_rate', 44100)
-        self.current_channels = data_payload.get('channels', 2)
+    async def stage_swap(self, session, swap):
+        """Hand a warm model to the session: at once if it is idle, otherwise from its next chunk on"""
+        if session.pending_swap is not None:
+            stale = session.pending_swap
+            stale.engine.discard(session, stale.prepared)
+        session.pending_swap = swap
+        if not session.is_processing:
+            self.cut_over(session)
+            await self.activate_model(session, session.cut_generation)
 
-        # Add incoming audio to buffer
-        self.audio_buffer.extend(audio_data_list)
-        
-        # Process when we have enough audio buffered
-        if len(self.audio_buffer) >= self.buffer_target_samples * self.current_channels:
-            logger.info(f"Buffer full ({len(self.audio_buffer)} samples), processing audio...")
-            
-            # Extract buffer for processing
-            audio_to_process = self.audio_buffer[:self.buffer_target_samples * self.current_channels]
-            # Keep remaining samples for next processing cycle
-            self.audio_buffer = self.audio_buffer[self.buffer_target_samples * self.current_channels:]
-            
-            # Queue the buffered audio for processing
-            await self.processing_queue.put({
-                'websocket': websocket,
-                'audio_data': np.array(audio_to_process, dtype=np.float32),
-                'timestamp': data_payload.get('timestamp', 0),
-                'channels': self.current_channels,
-                'sample_rate': self.current_sample_rate
-            })
-            
-            if not self.is_processing:
-                asyncio.create_task(self.process_audio_queue())
+    def cut_over(self, session):
+        """Cut new windows for the pending model, carrying over the audio not yet in any window.
+
+        Windows already queued keep the old model's format and are separated
+        by it; activate_model() switches models when the first new one is
+        reached, so the switch happens between two chunks.
+        """
+        swap = session.pending_swap
+        session.pending_swap = None
+        session.cut_generation += 1
+        session.swaps[session.cut_generation] = swap
+        session.model_config = swap.config
+        session.chunking = dict(swap.chunking, engine=swap.engine.name)
+
+        ring = session.ring_buffer
+        if ring is not None and ring.readable:
+            # Streaming windows start with context that was already emitted
+            skip = session.stream.left_context if session.stream is not None else 0
+            session.carried_frames = np.array(ring.read_window(ring.readable, advance=0)[skip:])
+
+        # Start buffering afresh so a streaming session gets a primed ring buffer
+        session.ring_buffer = None
+        session.stream = None
+
+    async def activate_model(self, session, generation):
+        """Attach the model windows of `generation` were cut for (on the event loop, between chunks)"""
+        for stale in [older for older in session.swaps if older < generation]:
+            # Cut for, but every window of it was dropped before it got to run
+            swap = session.swaps.pop(stale)
+            swap.engine.discard(session, swap.prepared)
+        swap = session.swaps.pop(generation)
+        engine, prepared = swap.engine, swap.prepared
+
+        if session.engine is not engine:
+            if session.engine is not None:
+                session.engine.close(session)
+            session.engine = engine
+        engine.attach(session, prepared)
+        session.generation = generation
+        session.separation_seconds = 0.0  # The old model's speed says nothing about the new one
+        self.metrics.model_loaded(session, swap.load_seconds)
+
+        stream = self.create_stream(session)
+        await session.websocket.send(json.dumps(dict(
+            prepared.status,
+            type='status',
+            status=prepared.message,
+            engine=engine.name,
+            streaming=stream.describe() if stream is not None else None,
+            latency=swap.chunking,
+            # Extra latency a chunk may spend waiting for a batch, on top of the streaming latency
+            batch_window_ms=self.batch_scheduler.window_seconds * 1000.0 if self.batches(session) else 0.0,
+            loading={'state': 'active', 'engine': engine.name, 'model': prepared.model_name,
+                     'load_ms': round(swap.load_seconds * 1000.0, 1)}
+        )))
+        logger.info(f"Session {session.id}: {engine.name} model {prepared.model_name} ready")
+
+    def plan_chunking(self, engine, model_name, config_data, client_rate):
+        """Chunk size from the engine's native block, and the algorithmic latency that results.
+
+        Stateless engines separate one native window per call. Stateful ones
+        take a whole number of blocks: `blocks_per_chunk` of 1 asks for the
+        smallest chunk the model supports, and by default it is the multiple
+        closest to target_chunk_seconds.
+        """
+        timing = engine.timing(model_name)
+        block_seconds = timing['block_seconds']
+        blocks_per_chunk = config_data.get('blocks_per_chunk')
+        if not engine.stateful:
+            blocks_per_chunk = 1
+        elif blocks_per_chunk is None:
+            blocks_per_chunk = max(1, int(round(self.target_chunk_seconds / block_seconds)))
+
+        chunk_seconds = blocks_per_chunk * block_seconds
+        if engine.stateful or not config_data.get('streaming', True):
+            # Back-to-back chunks: a sample waits up to one chunk to be buffered
+            right_context = 0.0
+            buffering_seconds = chunk_seconds
         else:
-            # Not enough data yet, just log progress
-            logger.debug(f"Buffering audio: {len(self.audio_buffer)}/{self.buffer_target_samples * self.current_channels} samples")
-    
-    async def process_audio_queue(self):
-        """Process queued audio data"""
-        self.is_processing = True
+            # Overlapping windows (see create_stream): a whole hop, then the right context after it
+            right_context = config_data.get('context_seconds', engine.context_seconds)
+            buffering_seconds = chunk_seconds - right_context
+        return self.plan_latency({
+            'block_ms': round(block_seconds * 1000.0, 3),
+            'blocks_per_chunk': blocks_per_chunk,
+            'chunk_ms': round(chunk_seconds * 1000.0, 3),
+            'context_ms': round(right_context * 1000.0, 3),
+            'buffering_ms': round(buffering_seconds * 1000.0, 3),
+            'model_latency_ms': round(timing['latency_seconds'] * 1000.0, 3),
+            'source': timing['source'],
+            'model_rate': engine.native_rate(model_name),
+            'resample': config_data.get('resample', True),
+        }, client_rate)
+
+    def plan_latency(self, chunking, client_rate):
+        """`chunking` with the resampler delay and the one end-to-end latency figure for a client rate.
+
+        latency_ms is how long after it arrives a sample comes back separated,
+        not counting separation time: buffering, the model's own delay, and the
+        input and output resampling filters.
+        """
+        model_rate = chunking['model_rate'] if chunking['resample'] else client_rate
+        resampler_seconds = delay_seconds(client_rate, model_rate) + delay_seconds(model_rate, client_rate)
+        resampler_ms = round(resampler_seconds * 1000.0, 3)
+        return dict(
+            chunking,
+            client_rate=client_rate,
+            resampler_ms=resampler_ms,
+            latency_ms=round(chunking['buffering_ms'] + chunking['model_latency_ms'] + resampler_ms, 3),
+        )
+
+    def chunk_frames(self, session):
+        """Frames per chunk at the session's sample rate: exactly blocks_per_chunk native blocks"""
+        chunking = session.chunking
+        block_frames = max(1, int(round(chunking['block_ms'] * session.model_rate / 1000.0)))
+        return chunking['blocks_per_chunk'] * block_frames
+
+    def latency_budget_seconds(self, session):
+        """How long after it was sent a chunk's output may arrive before the chunk is dropped"""
+        budget_ms = session.model_config.get('latency_budget_ms')
+        if budget_ms is None:
+            chunking = session.chunking
+            budget_ms = max(self.min_latency_budget_ms, chunking['chunk_ms'] + chunking['model_latency_ms'])
+        return budget_ms / 1000.0
+
+    def ring_buffer_frames(self, session):
+        chunk_seconds = session.chunking['chunk_ms'] / 1000.0
+        seconds = max(self.min_ring_buffer_seconds, 2 * (self.max_queue_chunks + 2) * chunk_seconds)
+        return int(round(seconds * session.model_rate))
+
+    def batches(self, session):
+        """Whether the session's chunks go through the cross-session batch scheduler"""
+        return self.batch_scheduler is not None and session.engine.supports_batching
+
+    def create_stream(self, session):
+        """Overlap-add stream for the session's sample rate, or None for stateful engines or when disabled"""
+        # The engine new windows are cut for, which is not yet the session's during a model switch
+        engine = self.engines[session.chunking['engine']]
+        if engine.stateful or not session.model_config.get('streaming', True):
+            return None
+        return OverlapAddStream.from_seconds(
+            session.model_rate,
+            session.chunking['chunk_ms'] / 1000.0,
+            session.model_config.get('context_seconds', engine.context_seconds)
+        )
+
+    async def queue_audio_processing(self, session, samples, sample_rate, channels, timestamp):
+        """Queue interleaved float32 audio for processing with buffering"""
+        websocket = session.websocket
+        if session.pending_swap is not None:
+            self.cut_over(session)
+        if session.chunking is None:
+            if session.is_loading:
+                await self.pass_through(session, samples, sample_rate, channels, timestamp)
+                return
+            await websocket.send(json.dumps({'type': 'error', 'error': 'No model loaded/configured'}))
+            return
+
+        session.sample_rate = sample_rate
+        if session.chunking['client_rate'] != sample_rate:
+            # Planned for the rate the client was assumed to send at; the resampler delay depends on it
+            session.chunking = self.plan_latency(session.chunking, sample_rate)
+        previous_rate = session.model_rate
+        # Separate at the model's native rate unless the client opts out of resampling
+        session.model_rate = session.chunking['model_rate'] if session.model_config.get('resample', True) else sample_rate
+        session.channels = channels
+        session.stats['chunks_received'] += 1
+        session.stats['samples_received'] += int(samples.size)
+        if session.buffering_since is None:
+            session.buffering_since = time.perf_counter()
+
+        # Add incoming audio to the session's preallocated ring buffer
+        carried = None
+        previous_ring = session.ring_buffer
+        ring = session.ensure_ring_buffer(session.channels, self.ring_buffer_frames(session))
+        if ring is not previous_ring:
+            session.stream = self.create_stream(session)
+            if session.stream is not None:
+                # The first window's left context is silence, so output starts at input frame 0
+                ring.write(np.zeros((session.stream.left_context, ring.channels), dtype=np.float32))
+            carried, session.carried_frames = session.carried_frames, None
+            if carried is not None and carried.shape[1] == ring.channels:
+                # Audio the old model had not reached, brought to the new model's rate
+                if previous_rate != session.model_rate:
+                    carried = StreamingResampler(previous_rate, session.model_rate).process(carried.T).T
+                ring.write(carried)
+                logger.info(f"Session {session.id}: {len(carried)} frames carried over the model switch")
+            else:
+                carried = None
+        ring.write(session.to_model_rate(samples))
+
+        if session.stream is not None:
+            window_frames = session.stream.window_frames
+            hop_frames = session.stream.hop_frames
+        else:
+            window_frames = hop_frames = self.chunk_frames(session)
+
+        budget_seconds = self.latency_budget_seconds(session)
+        if session.max_queue and carried is not None:
+            # The carried audio is cut into windows all at once (up to a second of them for a short
+            # chunk plan), so they get room on top of the usual bound instead of being dropped
+            session.queue_limit = session.max_queue + ring.readable // hop_frames
+        elif session.max_queue:
+            # The extra room goes away as that backlog drains
+            session.queue_limit = max(session.max_queue, min(session.queue_limit, session.processing_queue.qsize() + 1))
+
+        # Hand out every full window as a [frames, channels] view; the hop is released after processing
+        while ring.readable >= window_frames:
+            logger.debug(f"Session {session.id} buffer full ({ring.readable} frames), processing audio...")
+            now = time.perf_counter()
+            self.metrics.observe_stage(session, 'buffering', now - session.buffering_since)
+            session.buffering_since = now
+            item = {
+                'audio_data': ring.read_window(window_frames, advance=hop_frames),
+                'ring_buffer': ring,
+                'release_frames': hop_frames,
+                'hop_frames': hop_frames,  # New audio this window adds to the output
+                'queued_at': now,
+                'stream': session.stream,
+                'window': session.window_index,
+                'deadline': session.deadline_for(timestamp, budget_seconds),
+                'timestamp': timestamp,
+                'seq': session.chunk_seq,
+                'channels': session.channels,
+                'sample_rate': session.sample_rate,
+                'model_rate': session.model_rate,
+                'generation': session.cut_generation
+            }
+            session.window_index += 1
+            if session.queue_full:
+                # Coalesce: the oldest waiting window is the stalest, so it gives way to the newest.
+                # Its frames are released together with the new item's to keep releases in ring order.
+                oldest = session.processing_queue.get_nowait()
+                await self.drop_chunk(session, oldest, 'queue full')
+                if oldest['ring_buffer'] is ring:
+                    item['release_frames'] += oldest['release_frames']
+            session.processing_queue.put_nowait(item)
+            session.start_processing(self.process_audio_queue)
+
+    async def process_audio_queue(self, session):
+        """Process queued audio data for one session"""
         try:
-            while not self.processing_queue.empty():
-                item = await self.processing_queue.get()
-                await self.separate_audio(item)
+            while not session.processing_queue.empty():
+                item = await session.processing_queue.get()
+                self.metrics.observe_stage(session, 'queue', time.perf_counter() - item['queued_at'])
+                try:
+                    if item['generation'] != session.generation:
+                        # First window cut for a newly loaded model: switch to it between chunks
+                        await self.activate_model(session, item['generation'])
+                    if time.monotonic() + session.separation_seconds > item['deadline']:
+                        await self.drop_chunk(session, item, 'deadline')
+                        continue
+
+                    stream = item['stream']
+                    if stream is not None and session.last_window_processed != item['window'] - 1:
+                        stream.reset()  # The crossfade tail belongs to a window that is no longer adjacent
+
+                    started = time.monotonic()
+                    await self.separate_audio(session, item)
+                    elapsed = time.monotonic() - started
+                    session.record_separation_time(elapsed)
+                    self.metrics.record_chunk(session, item['hop_frames'] / item['model_rate'], elapsed)
+                    session.last_window_processed = item['window']
+                    if time.monotonic() > item['deadline']:
+                        session.stats['late_chunks'] += 1
+                finally:
+                    item['ring_buffer'].release(item['release_frames'])
         except Exception as e:
-            logger.error(f"Error in audio processing queue: {e}", exc_info=True)
-        finally:
-            self.is_processing = False
+            logger.error(f"Error in audio processing queue (session {session.id}): {e}", exc_info=True)
     
-    async def separate_audio(self, item):
-        """Separate audio using the loaded model"""
+    async def drop_chunk(self, session, item, reason):
+        """Skip separating a window, sending the configured fallback for its audio instead"""
+        session.stats['dropped_chunks'] += 1
+        self.metrics.chunk_dropped(session, reason)
+        logger.warning(f"Session {session.id}: dropped window {item['window']} ({reason}); "
+                       f"{session.stats['dropped_chunks']} dropped so far")
+
+        fallback = session.model_config.get('drop_fallback', self.drop_fallback)
+        if fallback not in ('mix', 'silence'):
+            return
+
+        # The part of the window this item would have emitted
+        stream = item['stream']
+        if stream is not None:
+            audio = item['audio_data'][stream.left_context:stream.left_context + stream.hop_frames]
+        else:
+            audio = item['audio_data']
+        if fallback == 'mix':
+            samples = np.clip(session.to_client_rate('fallback', audio.mean(axis=1), item['model_rate']), -1.0, 1.0)
+        else:
+            samples = np.zeros(int(round(len(audio) * item['sample_rate'] / item['model_rate'])), dtype=np.float32)
         try:
-            websocket = item['websocket']
-            audio_data_flat = item['audio_data'] # This is flat, interleaved from client
-            sample_rate = item['sample_rate']
-            channels = item['channels']
-            
-            # De-interleave and reshape if necessary for the model
-            # Models usually expect [channels, samples] or [samples, channels]
-            # Our client sends flat interleaved [sample1_ch1, sample1_ch2, sample2_ch1, sample2_ch2, ...]
-            if channels > 0 and len(audio_data_flat) % channels == 0:
-                num_frames = len(audio_data_flat) // channels
-                # Reshape to [frames, channels]
-                audio_reshaped = audio_data_flat.reshape(num_frames, channels)
-                # Transpose to [channels, frames] which is common for PyTorch models
-                audio_for_model = audio_reshaped.T
-                
-                # Ensure it's a proper numpy array with float32 dtype
-                audio_for_model = np.asarray(audio_for_model, dtype=np.float32)
-            else:
-                logger.error(f"Invalid audio data shape or channels. Flat length: {len(audio_data_flat)}, Channels: {channels}")
-                await websocket.send(json.dumps({'type': 'error', 'error': 'Invalid audio data for model processing'}))
-                return
+            await self.send_stem(session, 'mix', samples, item)
+        except Exception as e:
+            logger.warning(f"Session {session.id}: could not send fallback audio: {e}")
+
+    async def pass_through(self, session, samples, sample_rate, channels, timestamp):
+        """Until the first model is warm, answer audio with the configured fallback (counted as dropped)"""
+        session.stats['chunks_received'] += 1
+        session.stats['dropped_chunks'] += 1
+        self.metrics.chunk_dropped(session, 'loading')
+        fallback = session.loading_config.get('drop_fallback', self.drop_fallback)
+        if fallback not in ('mix', 'silence'):
+            return
+        mono = samples.reshape(-1, channels).mean(axis=1)
+        samples = np.clip(mono, -1.0, 1.0) if fallback == 'mix' else np.zeros_like(mono)
+        item = {'seq': session.chunk_seq, 'sample_rate': sample_rate, 'timestamp': timestamp}
+        await self.send_stem(session, 'mix', samples, item)
+
+    async def separate_audio(self, session, item):
+        """Separate audio using the session's engine"""
+        websocket = session.websocket
+        if not session.remix and session.stems is not None and not session.stems:
+            return  # Nothing subscribed, so nothing worth computing
+        try:
+            audio_frames = item['audio_data'] # [frames, channels] view into the session's ring buffer
+            sample_rate = item['model_rate']
+
+            # Transpose to [channels, frames] which is common for PyTorch models.
+            # This is still a view; run_separation makes the one contiguous copy the model needs.
+            audio_for_model = audio_frames.T
 
             loop = asyncio.get_event_loop()
-            separated_stems_dict = await loop.run_in_executor(
-                None, # Default thread pool
-                self.run_separation,
-                audio_for_model, # Pass correctly shaped audio
-                sample_rate
-            )
-            
-            # Send each stem as a separate message for easier client handling
-            for stem_name, stem_audio_np in separated_stems_dict.items():
-                # Ensure stem_audio_np is a numpy array
-                if hasattr(stem_audio_np, 'cpu'):  # It's a PyTorch tensor
-                    stem_audio_np = stem_audio_np.cpu().numpy()
-                elif not isinstance(stem_audio_np, np.ndarray):
-                    stem_audio_np = np.array(stem_audio_np)
-                
-                # UVR models might return multi-channel stems. For playback, often mono is fine.
-                if stem_audio_np.ndim > 1 and stem_audio_np.shape[0] > 1: # if [channels, samples] and channels > 1
-                    # Use numpy mean for numpy arrays
-                    stem_mono_np = np.mean(stem_audio_np, axis=0)
-                else: # Already mono or [1, samples]
-                    stem_mono_np = stem_audio_np.flatten()
-
-                # Normalize audio to [-1, 1] range to prevent clipping on client
-                max_val = np.max(np.abs(stem_mono_np))
-                if max_val > 1e-5: # Avoid division by zero or tiny numbers
-                    stem_mono_normalized_np = stem_mono_np / max_val
-                else:
-                    stem_mono_normalized_np = stem_mono_np
-                
-                stem_data_list = stem_mono_normalized_np.tolist()
+            separated_stems_dict = None
+            cache_key = None
+            spec = session.engine.cache_key(session) if self.stem_cache is not None else None
+            if spec is not None:
+                cache_key = StemCache.key(audio_for_model, sample_rate, spec)
+                separated_stems_dict = self.stem_cache.get(cache_key)  # Replayed audio skips the model
 
-                await websocket.send(json.dumps({
-                    'type': 'separated_audio',
-                    'stem': stem_name,
-                    'data': stem_data_list, # Send the list of samples
-                    'timestamp': item['timestamp'] # Keep original timestamp for potential sync
-                }))
+            if separated_stems_dict is None:
+                started = time.perf_counter()
+                separated_stems_dict = await self.run_model(session, audio_for_model, sample_rate)
+                self.metrics.observe_stage(session, 'inference', time.perf_counter() - started)
+                if cache_key is not None:
+                    # Written in the background; the stems are only read, so sending can go ahead meanwhile
+                    loop.run_in_executor(None, self.stem_cache.put, cache_key, separated_stems_dict,
+                                         time.perf_counter() - started)
+
+            stem_names = list(separated_stems_dict.keys())
+            stem_arrays = [
+                stem.cpu().numpy() if hasattr(stem, 'cpu') else np.asarray(stem)
+                for stem in separated_stems_dict.values()
+            ]
+
+            stacked = self.memory_manager.workspace('stacked_stems', (len(stem_arrays),) + stem_arrays[0].shape)
+            np.stack(stem_arrays, out=stacked)
+            if stacked.ndim == 2:
+                stacked = stacked[:, None, :]  # Mono stems: [stems, 1, frames]
+            stream = item.get('stream')
+            postprocessor = session.ensure_postprocessor()
+
+            if session.remix:
+                mixed = np.tensordot(session.remix_weights(stem_names), stacked, axes=1)
+                await self.send_remix(session, item, mixed, postprocessor)
+                session.stats['chunks_processed'] += 1
+                self.metrics.chunk_processed(session)
+                return
+
+            # Keep only the subscribed stems (plus a summed 'instrumental' if asked for) before stitching
+            send_names, selection = session.stem_selection(stem_names)
+            if not send_names:
+                return
+            selected = np.tensordot(selection, stacked, axes=1)
+
+            with self.metrics.timed(session, 'postprocess'):
+                if stream is not None:
+                    # Stitch this window onto the previous one; yields exactly one hop per stem
+                    selected = stream.process(selected)
+                selected = session.to_client_rate('stems', selected, item['model_rate'])
+
+                # Downmix, limiting and dtype conversion for all stems at once: [stems, frames, channels]
+                output = postprocessor.process(selected)
+            for stem_name, stem_output in zip(send_names, output):
+                await self.send_stem(session, stem_name, stem_output, item,
+                                     channels=stem_output.shape[1], dtype=postprocessor.dtype)
+
+            session.stats['chunks_processed'] += 1
+            self.metrics.chunk_processed(session)
 
         except Exception as e:
             logger.error(f"Error separating audio: {e}", exc_info=True)
+            session.stats['errors'] += 1
+            self.metrics.chunk_failed(session)
+            if item.get('stream') is not None:
+                item['stream'].reset()
             await websocket.send(json.dumps({'type': 'error', 'error': f'Separation failed: {str(e)}'}))
     
-    def run_separation(self, audio_input_np, sr):
-        """Run the actual separation (blocking operation)"""
-        try:
-            logger.info(f"Running separation on audio shape: {audio_input_np.shape}, SR: {sr}")
-            logger.info(f"Audio input type: {type(audio_input_np)}, dtype: {audio_input_np.dtype}")
-            
-            # Aggressive memory cleanup before processing
-            import gc
-            gc.collect()
-            
-            # Clear any existing caches
-            try:
-                if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                    torch.mps.empty_cache()
-            except (AttributeError, RuntimeError):
-                pass
-            
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            # Ensure input is numpy array with correct dtype and contiguous memory layout
-            if not isinstance(audio_input_np, np.ndarray):
-                audio_input_np = np.array(audio_input_np)
-            
-            if audio_input_np.dtype != np.float32:
-                audio_input_np = audio_input_np.astype(np.float32)
-            
-            if not audio_input_np.flags['C_CONTIGUOUS']:
-                audio_input_np = np.ascontiguousarray(audio_input_np)
-            
-            # Further reduce audio length for memory safety
-            max_samples = sr * 1  # Maximum 1 second (was 2)
-            if audio_input_np.shape[-1] > max_samples:
-                logger.warning(f"Truncating audio from {audio_input_np.shape[-1]} to {max_samples} samples")
-                audio_input_np = audio_input_np[..., :max_samples]
-            
-            logger.info(f"Final audio input shape: {audio_input_np.shape}, dtype: {audio_input_np.dtype}")
-            
-            # Run separation with explicit CPU mode
-            with torch.no_grad():  # Disable gradient computation to save memory
-                separated_output = self.current_model.predict(audio_input_np, sampling_rate=sr)
-            
-            # Aggressive cleanup after processing
-            gc.collect()
-            try:
-                if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                    torch.mps.empty_cache()
-            except (AttributeError, RuntimeError):
-                pass
-            
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            if not isinstance(separated_output, dict):
-                logger.error(f"Model prediction did not return a dict. Got: {type(separated_output)}")
-                if isinstance(separated_output, (list, tuple)) and all(isinstance(arr, np.ndarray) for arr in separated_output):
-                    stems = ['vocals', 'drums', 'bass', 'other']
-                    separated_output = {stems[i]: separated_output[i] for i in range(min(len(stems), len(separated_output)))}
-                else:
-                    raise ValueError("Model output format not recognized as a dictionary of stems.")
+    async def run_model(self, session, audio_for_model, sample_rate):
+        """Separate [channels, frames] audio with the session's engine and model"""
+        engine = session.engine
+        if self.batches(session):
+            # May share one forward pass with other sessions using the same model
+            return await self.batch_scheduler.submit(
+                (engine.name, session.model_key),
+                (engine, session.model),
+                audio_for_model,
+                sample_rate
+            )
+        loop = asyncio.get_event_loop()
+        session.inflight = loop.run_in_executor(
+            None, # Default thread pool
+            self.profiler.call,
+            session.id,
+            model_label(session),
+            engine.separate,
+            session,
+            audio_for_model, # Pass correctly shaped audio
+            sample_rate,
+            engine.remix_stems if session.remix else session.stems
+        )
+        # Shielded so cancelling the session's processing task leaves the future to Session.close()
+        return await asyncio.shield(session.inflight)
+
+    def run_batch(self, target, audio_batch, sr):
+        """Batch scheduler callback (blocking); batches mix sessions, so profiles tag them by model only"""
+        engine, model = target
+        return self.profiler.call(None, getattr(model, 'name', None), engine.separate_batch, model, audio_batch, sr)
 
-            logger.info(f"Separation successful. Got stems: {list(separated_output.keys())}")
-            return separated_output
-                
-        except Exception as e:
-            logger.error(f"Model separation error in run_separation: {e}", exc_info=True)
-            # Cleanup on error too
-            import gc
-            gc.collect()
-            try:
-                if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-                    torch.mps.empty_cache()
-            except (AttributeError, RuntimeError):
-                pass
-            
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            raise
-    
     def run_http_server(self):
         """Run the HTTP server in a separate thread"""
         self.app.run(host=self.host, port=self.http_port, debug=False) # threaded=True is default for Flask dev server
     
     async def start_servers(self):
         """Start both WebSocket and HTTP servers"""
+        for engine in self.engines.values():
+            engine.start()
+        self.profiler.loop = asyncio.get_running_loop()
+
         http_thread = threading.Thread(target=self.run_http_server, daemon=True)
         http_thread.start()
         logger.info(f"HTTP server started on {self.host}:{self.http_port}")
@@ -416,15 +1019,65 @@ class AudioSeparationServer:
             logger.info("Audio Separation Server is running...")
             await asyncio.Future()  # Run forever
 
-def main():
+def parse_args(default_engine='uvr'):
+    parser = argparse.ArgumentParser(description="Real-time audio separation server (UVR, Hance and mock engines)")
+    parser.add_argument('--engine', choices=('uvr', 'hance', 'mock'), default=default_engine,
+                        help="Engine for sessions whose configure doesn't name one")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765, help="WebSocket port")
+    parser.add_argument('--http-port', type=int, default=8766)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Inference worker processes (0 runs inference in this process)")
+    parser.add_argument('--offline-workers', type=int, default=1,
+                        help="Extra worker processes for POST /separate jobs with --workers "
+                             "(0 runs them on the sessions' workers)")
+    parser.add_argument('--batch-window-ms', type=float, default=10.0,
+                        help="How long a chunk waits for other sessions' chunks to batch with (0 disables batching)")
+    parser.add_argument('--max-batch', type=int, default=8, help="Largest cross-session inference batch")
+    parser.add_argument('--memory-budget-mb', type=int, default=4096,
+                        help="Process memory budget; garbage is collected when usage nears it")
+    parser.add_argument('--model-cache-mb', type=int, default=2048,
+                        help="Memory budget for cached models, per process")
+    parser.add_argument('--stem-cache-mb', type=int, default=1024,
+                        help="Disk budget for cached separated stems (0 disables the cache)")
+    parser.add_argument('--stem-cache-dir', default=None, help="Where cached stems are kept (default: temp dir)")
+    parser.add_argument('--mock-engine', action='store_true',
+                        help="Separate with mock models instead of the UVR and Hance ones (for benchmarks)")
+    parser.add_argument('--mock-rtf', type=float, default=DEFAULT_REALTIME_FACTOR,
+                        help="Seconds of audio the mock model separates per second")
+    return parser.parse_args()
+
+def main(default_engine='uvr'):
     """Main entry point"""
-    server = AudioSeparationServer()
+    args = parse_args(default_engine)
+    if args.engine == 'hance' and engines.hance is None and not args.mock_engine:
+        engines.install_hance()
+    server = AudioSeparationServer(
+        host=args.host,
+        port=args.port,
+        http_port=args.http_port,
+        model_cache_bytes=args.model_cache_mb * 1024 ** 2,
+        inference_workers=args.workers,
+        offline_workers=args.offline_workers,
+        batch_window_ms=args.batch_window_ms,
+        max_batch=args.max_batch,
+        memory_budget_bytes=args.memory_budget_mb * 1024 ** 2,
+        stem_cache_bytes=args.stem_cache_mb * 1024 ** 2,
+        stem_cache_dir=args.stem_cache_dir,
+        mock_realtime_factor=args.mock_rtf if args.mock_engine else None,
+        default_engine=args.engine
+    )
     try:
         asyncio.run(server.start_servers())
     except KeyboardInterrupt:
         logger.info("Server stopped by user.")
     except Exception as e:
         logger.error(f"Server encountered a fatal error: {e}", exc_info=True)
+    finally:
+        server.offline_jobs.shutdown()
+        server.model_loader.shutdown()
+        for engine in server.engines.values():
+            engine.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,310 @@
+"""
+Per-client session state shared by the separation servers
+"""
+
+import asyncio
+import itertools
+import logging
+import math
+import time
+
+import numpy as np
+
+from audio_protocol import PROTOCOL_BINARY, PROTOCOL_JSON, STEM_IDS
+from postprocess import StemPostProcessor
+from resampler import StreamingResampler
+from ring_buffer import AudioRingBuffer
+
+logger = logging.getLogger(__name__)
+
+_session_ids = itertools.count(1)
+
+
+def stem_selection(produced, wanted):
+    """Names of the wanted stems (all if None), and the [sent, produced] matrix that builds them from `produced`.
+
+    'instrumental', if wanted and not produced, is derived by summing every non-vocal stem.
+    """
+    names, rows = [], []
+    for index, stem in enumerate(produced):
+        if wanted is None or stem in wanted:
+            row = np.zeros(len(produced), dtype=np.float32)
+            row[index] = 1.0
+            names.append(stem)
+            rows.append(row)
+    if wanted is not None and 'instrumental' in wanted and 'instrumental' not in produced:
+        row = np.array([0.0 if stem == 'vocals' else 1.0 for stem in produced], dtype=np.float32)
+        if row.any():
+            names.append('instrumental')
+            rows.append(row)
+    return names, np.array(rows, dtype=np.float32).reshape(len(rows), len(produced))
+
+
+class Session:
+    """Everything one connected client owns: buffer, model handle, queue and stats"""
+
+    def __init__(self, websocket, path="/", max_queue=0):
+        self.id = next(_session_ids)
+        self.websocket = websocket
+        self.path = path
+        self.protocol = PROTOCOL_JSON
+
+        # Engine serving the session (see engines.py), its model handle and config
+        self.engine = None
+        self.model = None
+        self.model_key = None  # Registry key of the shared model, if any
+        self.worker_index = None  # Inference worker process this session is pinned to
+        self.model_name = None
+        self.model_config = {}
+
+        # Model switches (see the server's load_model): a load finishes into pending_swap, new windows are
+        # cut for it from the next chunk on (cut_generation), and it is attached when the first of those
+        # windows is separated (generation). swaps holds the ones cut but not attached yet.
+        self.generation = 0
+        self.cut_generation = 0
+        self.pending_swap = None
+        self.swaps = {}
+        self.carried_frames = None  # Audio the previous model had not windowed yet, for the next ring buffer
+        self.load_token = 0  # Bumped by every configure; a load that is no longer the latest is discarded
+        self.loading_task = None
+        self.loading_config = {}  # The latest configure's config; audio passed through while it loads follows it
+
+        # Stems the client wants back; None means every stem the model produces
+        self.stems = None
+        self._selection_cache = {}
+
+        # Remix mode: stems are summed with per-stem gains into a single 'remix' stream
+        self.remix = False
+        self.gains = {}
+        self._remix_cache = {}
+
+        # Incoming audio; allocated once the stream format is known
+        self.ring_buffer = None
+        self.stream = None  # OverlapAddStream when the server runs in streaming mode
+        self.chunking = None  # Chunk plan from the engine's timing: native block, blocks per chunk and latencies
+        self.postprocessor = None  # StemPostProcessor; carries the limiter state between chunks
+        self.sample_rate = 44100  # Rate the client sends and receives audio at
+        self.model_rate = 44100  # Rate audio is separated at; the resamplers convert to and from it
+        self.resamplers = {}  # name -> StreamingResampler, carrying filter state between chunks
+        self.channels = 2
+        self.chunk_seq = 0
+        self.window_index = 0  # Windows handed to the processing queue so far
+        self.buffering_since = None  # perf_counter() when audio for the next window started arriving
+        self.last_window_processed = None  # Gaps mean the overlap-add tail is stale
+
+        # Bounded: when it is full the oldest window is dropped (see the server's drop handling).
+        # queue_limit rises above max_queue for the backlog carried over a model switch, and comes
+        # back down as that drains; 0 means unbounded.
+        self.max_queue = max_queue
+        self.queue_limit = max_queue
+        self.processing_queue = asyncio.Queue()
+        self.processing_task = None
+        # Executor future of the separation call running for this session; the thread behind it
+        # cannot be cancelled, so it must finish before the model handle is given back
+        self.inflight = None
+
+        # Client timestamps are mapped onto the server clock to derive chunk deadlines
+        self.clock_offset = None
+        self.separation_seconds = 0.0  # Moving average of how long one window takes
+
+        self.stats = {
+            'connected_at': time.time(),
+            'chunks_received': 0,
+            'samples_received': 0,
+            'chunks_processed': 0,
+            'dropped_chunks': 0,
+            'late_chunks': 0,
+            'errors': 0,
+        }
+
+    @property
+    def is_loading(self):
+        return self.loading_task is not None and not self.loading_task.done()
+
+    @property
+    def queue_full(self):
+        return 0 < self.queue_limit <= self.processing_queue.qsize()
+
+    @property
+    def is_processing(self):
+        return self.processing_task is not None and not self.processing_task.done()
+
+    def ensure_ring_buffer(self, channels, capacity_frames):
+        """Return the incoming-audio ring buffer, reallocating it if the stream format changed"""
+        capacity_frames = int(capacity_frames)
+        ring = self.ring_buffer
+        if ring is None or ring.channels != channels or ring.capacity != capacity_frames:
+            if ring is not None:
+                logger.info(f"Session {self.id} stream format changed, reallocating ring buffer "
+                            f"({ring.channels}ch/{ring.capacity} -> {channels}ch/{capacity_frames} frames)")
+            self.ring_buffer = AudioRingBuffer(capacity_frames, channels)
+        return self.ring_buffer
+
+    def resampler(self, name, from_rate, to_rate):
+        """The session's streaming resampler `name`, rebuilt when its rate pair changes"""
+        resampler = self.resamplers.get(name)
+        if resampler is None or resampler.from_rate != from_rate or resampler.to_rate != to_rate:
+            resampler = self.resamplers[name] = StreamingResampler(from_rate, to_rate)
+        return resampler
+
+    def to_model_rate(self, samples):
+        """Interleaved samples from the client as [frames, channels] at the model rate"""
+        frames = samples.reshape(-1, self.channels)
+        if self.sample_rate == self.model_rate:
+            return frames
+        return self.resampler('input', self.sample_rate, self.model_rate).process(frames.T).T
+
+    def to_client_rate(self, name, audio, model_rate=None):
+        """[..., frames] model output back at the client's rate, through the output resampler `name`.
+
+        `model_rate` is the rate the window was cut at, if it may predate a model switch.
+        """
+        return self.resampler(name, model_rate or self.model_rate, self.sample_rate).process(audio)
+
+    def deadline_for(self, timestamp_ms, budget_seconds):
+        """Server monotonic time by which output for a chunk stamped `timestamp_ms` must be sent"""
+        now = time.monotonic()
+        if not timestamp_ms:
+            return now + budget_seconds
+        offset = now - timestamp_ms / 1000.0
+        # The smallest offset seen had the least transport delay, so it is the best clock estimate
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        return timestamp_ms / 1000.0 + self.clock_offset + budget_seconds
+
+    def record_separation_time(self, seconds):
+        self.separation_seconds = seconds if not self.separation_seconds else 0.8 * self.separation_seconds + 0.2 * seconds
+
+    def set_subscription(self, stems):
+        """Limit output to the named stems ('instrumental' is everything but vocals); None means all"""
+        if stems is None:
+            self.stems = None
+        else:
+            unknown = [stem for stem in stems if stem not in STEM_IDS or stem in ('mix', 'remix')]
+            if unknown:
+                raise ValueError(f"Unknown stems in subscription: {', '.join(map(str, unknown))}")
+            self.stems = frozenset(stems)
+        self._selection_cache = {}
+        if self.stream is not None:
+            self.stream.reset()  # The carried crossfade tail was for the old set of stems
+
+    def set_output(self, output):
+        """'stems' sends every subscribed stem on its own; 'remix' sends one stream mixed with the gains"""
+        if output not in ('stems', 'remix'):
+            raise ValueError(f"Unknown output mode '{output}', expected 'stems' or 'remix'")
+        remix = output == 'remix'
+        if remix != self.remix and self.stream is not None:
+            self.stream.reset()  # The carried tail has the other mode's shape
+        self.remix = remix
+
+    def set_gains(self, gains):
+        """Update remix gains by stem name; 'instrumental' also applies to non-vocal stems without their own gain"""
+        if not isinstance(gains, dict):
+            raise ValueError("gains must be an object mapping stem names to numbers")
+        for stem, gain in gains.items():
+            if stem not in STEM_IDS or stem in ('mix', 'remix'):
+                raise ValueError(f"Unknown stem in gains: {stem}")
+            if isinstance(gain, bool) or not isinstance(gain, (int, float)) or not math.isfinite(gain) or gain < 0:
+                raise ValueError(f"Gain for {stem} must be a finite non-negative number, got {gain!r}")
+        self.gains.update({stem: float(gain) for stem, gain in gains.items()})
+        self._remix_cache = {}
+
+    def remix_weights(self, produced):
+        """Gain for each of the model's stems, in the order the model produced them"""
+        produced = tuple(produced)
+        weights = self._remix_cache.get(produced)
+        if weights is None:
+            default = self.gains.get('instrumental', 1.0)
+            weights = np.array([
+                self.gains.get(stem, 1.0 if stem == 'vocals' else default) for stem in produced
+            ], dtype=np.float32)
+            self._remix_cache[produced] = weights
+        return weights
+
+    def wants(self, stem):
+        return self.stems is None or stem in self.stems
+
+    def stem_selection(self, produced):
+        """Names of the stems to send, and the [sent, produced] matrix that builds them from the model's stems"""
+        produced = tuple(produced)
+        cached = self._selection_cache.get(produced)
+        if cached is None:
+            cached = self._selection_cache[produced] = stem_selection(produced, self.stems)
+        return cached
+
+    def ensure_postprocessor(self):
+        """Post-processor for the session's output options ('keep_stereo', 'output_dtype'), rebuilt if they change"""
+        keep_stereo = bool(self.model_config.get('keep_stereo', False))
+        # JSON clients get plain float lists, so compact dtypes only apply to binary frames
+        dtype = self.model_config.get('output_dtype', 'float32') if self.protocol == PROTOCOL_BINARY else 'float32'
+        postprocessor = self.postprocessor
+        if (postprocessor is None or postprocessor.keep_stereo != keep_stereo or postprocessor.dtype != dtype
+                or postprocessor.sample_rate != self.sample_rate):
+            self.postprocessor = StemPostProcessor(self.sample_rate, keep_stereo=keep_stereo, dtype=dtype)
+        return self.postprocessor
+
+    def start_processing(self, worker):
+        """Start worker(session) draining the queue unless it is already running"""
+        if not self.is_processing:
+            self.processing_task = asyncio.create_task(worker(self))
+
+    async def close(self):
+        """Tear down the session: stop processing, wait out a running separation call, and drop buffers.
+
+        Its engine takes back the model handle afterwards, which is only safe
+        once no executor thread is using it.
+        """
+        if self.is_processing:
+            self.processing_task.cancel()
+            try:
+                await self.processing_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.warning(f"Session {self.id} processing task ended with error during close: {e}")
+        self.processing_task = None
+
+        if self.inflight is not None:
+            if not self.inflight.done():
+                logger.info(f"Session {self.id} waiting for its running separation call before closing")
+                await asyncio.wait({self.inflight})
+            if not self.inflight.cancelled():
+                self.inflight.exception()  # Already reported (or moot) for a cancelled chunk
+            self.inflight = None
+
+        while not self.processing_queue.empty():
+            self.processing_queue.get_nowait()
+
+        self.ring_buffer = None
+        self.carried_frames = None
+        self.stream = None
+        self.postprocessor = None
+        self.resamplers = {}
+        logger.info(f"Session {self.id} closed. Stats: {self.stats}")
+
+    def describe(self):
+        """JSON-serialisable summary for the HTTP API"""
+        return {
+            'id': self.id,
+            'path': self.path,
+            'protocol': self.protocol,
+            'engine': self.engine.name if self.engine is not None else None,
+            'model': self.model_name,
+            'model_loaded': self.model is not None,
+            'model_loading': self.is_loading,
+            'worker': self.worker_index,
+            'sample_rate': self.sample_rate,
+            'model_rate': self.model_rate,
+            'resamplers': {name: resampler.describe() for name, resampler in self.resamplers.items()
+                           if not resampler.passthrough},
+            'channels': self.channels,
+            'stems': sorted(self.stems) if self.stems is not None else None,
+            'output': 'remix' if self.remix else 'stems',
+            'gains': dict(self.gains),
+            'ring_buffer': self.ring_buffer.stats() if self.ring_buffer is not None else None,
+            'stream': self.stream.describe() if self.stream is not None else None,
+            'postprocessor': self.postprocessor.describe() if self.postprocessor is not None else None,
+            'queue_depth': self.processing_queue.qsize(),
+            'separation_ms': round(1000.0 * self.separation_seconds, 1),
+            'stats': dict(self.stats),
+        }
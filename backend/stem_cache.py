@@ -0,0 +1,180 @@
+"""
+Disk-backed, content-addressed cache of separated stems
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STEM_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'music-separator-stem-cache')
+
+# Audio is rounded to this many bits before hashing, so float noise far below audibility
+# (a different decode or resampling path producing the last bits differently) still hits
+HASH_BITS = 14
+
+
+class _Entry:
+    def __init__(self, size_bytes, separation_seconds=0.0):
+        self.size_bytes = size_bytes
+        self.separation_seconds = separation_seconds
+
+
+class StemCache:
+    """Stems of previously separated windows, keyed by a hash of the audio and model.
+
+    Each entry is a .npy file of stacked [stems, ...] float32 output, opened as a
+    read-only memory map on a hit, plus a small JSON file with the stem names
+    and how long the separation took. Entries are evicted least recently used
+    first once the files exceed `max_bytes`; entries already on disk are picked
+    up again (oldest first) when the cache is reopened.
+
+    Keys include the model spec and sample rate, so different models or
+    settings never share stems. Replayed audio only hits when the server's
+    windows line up with the earlier ones, as they do when a track is played
+    again from the start.
+    """
+
+    def __init__(self, max_bytes, directory=STEM_CACHE_DIR):
+        self.max_bytes = int(max_bytes)
+        self.directory = directory
+        self._entries = OrderedDict()  # key -> _Entry, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self.seconds_saved = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + '.npy'), os.path.join(self.directory, key + '.json')
+
+    def _load_index(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            key = name[:-4]
+            data_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path) as meta_file:
+                    meta = json.load(meta_file)
+                found.append((os.path.getmtime(data_path), key, _Entry(os.path.getsize(data_path), meta.get('seconds', 0.0))))
+            except (OSError, ValueError):
+                self._remove_files(key)
+        for _, key, entry in sorted(found):
+            self._entries[key] = entry
+        if found:
+            logger.info(f"Stem cache: {len(found)} entries ({self.total_bytes / 1e6:.1f} MB) in {self.directory}")
+        with self._lock:
+            self._evict_locked()
+
+    @property
+    def total_bytes(self):
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    @staticmethod
+    def key(audio, sample_rate, model_spec):
+        """Content hash of [channels, frames] audio for one model spec and sample rate"""
+        scale = float(2 ** (HASH_BITS - 1))
+        quantized = np.clip(np.rint(np.asarray(audio, dtype=np.float32) * scale), -scale, scale - 1).astype('<i2')
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr((model_spec, int(sample_rate), quantized.shape)).encode('utf-8'))
+        digest.update(np.ascontiguousarray(quantized).data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Dict of memory-mapped stems for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                names = json.load(meta_file)['names']
+            stacked = np.load(data_path, mmap_mode='r')
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Dropping unreadable stem cache entry {key}: {e}")
+            with self._lock:
+                self._entries.pop(key, None)
+                self.misses += 1
+            self._remove_files(key)
+            return None
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += entry.size_bytes
+            self.seconds_saved += entry.separation_seconds
+        return dict(zip(names, stacked))
+
+    def put(self, key, stems, separation_seconds=0.0):
+        """Store a dict of equally shaped stems under key (blocking: writes to disk)"""
+        names = list(stems.keys())
+        arrays = [stem.cpu().numpy() if hasattr(stem, 'cpu') else np.asarray(stem, dtype=np.float32)
+                  for stem in stems.values()]
+        data_path, meta_path = self._paths(key)
+        try:
+            stacked = np.lib.format.open_memmap(data_path + '.tmp', mode='w+', dtype=np.float32,
+                                                shape=(len(arrays),) + arrays[0].shape)
+            for index, array in enumerate(arrays):
+                stacked[index] = array
+            stacked.flush()
+            del stacked
+            with open(meta_path + '.tmp', 'w') as meta_file:
+                json.dump({'names': names, 'seconds': separation_seconds}, meta_file)
+            os.replace(meta_path + '.tmp', meta_path)
+            os.replace(data_path + '.tmp', data_path)  # Last: a .npy without its names is never indexed
+        except OSError as e:
+            logger.warning(f"Could not store stems in the cache: {e}")
+            return
+
+        with self._lock:
+            self._entries[key] = _Entry(os.path.getsize(data_path), separation_seconds)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            self._evict_locked()
+
+    def _evict_locked(self):
+        total = self.total_bytes
+        while total > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            total -= entry.size_bytes
+            self.evictions += 1
+            self._remove_files(key)
+
+    def _remove_files(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'directory': self.directory,
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'bytes_served': self.bytes_served,
+                # Inference time the hits would have cost, as measured when each entry was stored
+                'separation_seconds_saved': round(self.seconds_saved, 3),
+            }
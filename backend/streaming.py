@@ -0,0 +1,99 @@
+"""
+Overlap-add streaming separation with carried context
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class OverlapAddStream:
+    """Stitches model outputs for overlapping windows into one continuous stream.
+
+    Each model window is laid out as [left context | hop | right context]. The
+    ring buffer advances by `hop` frames between windows, so window k+1 starts
+    exactly `hop` frames after window k. For every window we keep the hop
+    region plus the first `crossfade` frames of the right context; that tail is
+    faded out and overlap-added onto the faded-in start of the next window's
+    hop, so the emitted audio has no seams.
+
+    Emitted frames are final and contiguous: hop k covers input frames
+    [k * hop, (k + 1) * hop) once `left_context` frames of silence are primed
+    into the ring buffer ahead of the real audio.
+    """
+
+    def __init__(self, sample_rate, hop_frames, left_context, right_context, crossfade=None):
+        if hop_frames <= 0:
+            raise ValueError(f"Hop must be positive, got {hop_frames} frames")
+        if crossfade is None:
+            crossfade = right_context
+        self.sample_rate = int(sample_rate)
+        self.hop_frames = int(hop_frames)
+        self.left_context = int(left_context)
+        self.right_context = int(right_context)
+        self.crossfade = int(min(crossfade, right_context, hop_frames))
+        self.window_frames = self.left_context + self.hop_frames + self.right_context
+
+        # Linear, amplitude-complementary fades: fade_in + fade_out == 1 everywhere
+        self._fade_in = ((np.arange(self.crossfade, dtype=np.float32) + 0.5) / max(self.crossfade, 1))
+        self._fade_out = 1.0 - self._fade_in
+        self._tail = None
+        self.windows_processed = 0
+
+    @classmethod
+    def from_seconds(cls, sample_rate, window_seconds, context_seconds, crossfade_seconds=None):
+        """Build a stream whose model window is `window_seconds` long with symmetric context"""
+        window = int(round(sample_rate * window_seconds))
+        context = int(round(sample_rate * context_seconds))
+        crossfade = None if crossfade_seconds is None else int(round(sample_rate * crossfade_seconds))
+        return cls(sample_rate, window - 2 * context, context, context, crossfade)
+
+    @property
+    def latency_frames(self):
+        """Frames between a sample arriving and its separated output becoming available.
+
+        A whole hop has to be buffered, plus the right context that follows it.
+        """
+        return self.hop_frames + self.right_context
+
+    @property
+    def latency_ms(self):
+        return 1000.0 * self.latency_frames / self.sample_rate
+
+    def reset(self):
+        """Forget the carried crossfade tail, e.g. after a dropped window"""
+        self._tail = None
+
+    def process(self, window_output):
+        """Take model output [..., window_frames] and return the next finished [..., hop_frames]"""
+        needed = self.left_context + self.hop_frames + self.crossfade
+        if window_output.shape[-1] < needed:
+            logger.warning(f"Model returned {window_output.shape[-1]} frames, expected {self.window_frames}; zero padding")
+            pad = [(0, 0)] * (window_output.ndim - 1) + [(0, needed - window_output.shape[-1])]
+            window_output = np.pad(window_output, pad)
+
+        segment = window_output[..., self.left_context:needed]
+        emitted = np.array(segment[..., :self.hop_frames], dtype=np.float32)
+
+        if self.crossfade:
+            if self._tail is not None and self._tail.shape == emitted[..., :self.crossfade].shape:
+                emitted[..., :self.crossfade] *= self._fade_in
+                emitted[..., :self.crossfade] += self._tail
+            tail = segment[..., self.hop_frames:]
+            if self._tail is None or self._tail.shape != tail.shape:
+                self._tail = np.empty(tail.shape, dtype=np.float32)
+            np.multiply(tail, self._fade_out, out=self._tail)
+
+        self.windows_processed += 1
+        return emitted
+
+    def describe(self):
+        return {
+            'window_ms': 1000.0 * self.window_frames / self.sample_rate,
+            'hop_ms': 1000.0 * self.hop_frames / self.sample_rate,
+            'context_ms': 1000.0 * self.left_context / self.sample_rate,
+            'crossfade_ms': 1000.0 * self.crossfade / self.sample_rate,
+            'latency_ms': self.latency_ms,
+        }
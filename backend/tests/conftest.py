@@ -0,0 +1,31 @@
+"""
+Backend modules import each other as siblings, so tests run with backend/ on the path
+"""
+
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture
+def make_server():
+    """Server core without listening sockets, by default on the mock engine without batching or stem cache"""
+    from server import AudioSeparationServer
+
+    servers = []
+
+    def make(**options):
+        server = AudioSeparationServer(**dict(dict(batch_window_ms=0, stem_cache_bytes=0, default_engine='mock'),
+                                              **options))
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.offline_jobs.shutdown()
+        server.model_loader.shutdown()
@@ -0,0 +1,61 @@
+"""
+Shared pieces for tests that drive the server core without a network
+"""
+
+import json
+
+import numpy as np
+
+from session import Session
+
+
+class FakeWebSocket:
+    """Stands in for a client connection: records what the server sends and replays scripted messages"""
+
+    def __init__(self, incoming=()):
+        self.sent = []
+        self.incoming = list(incoming)
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.incoming:
+            raise StopAsyncIteration
+        return self.incoming.pop(0)
+
+    def json_messages(self, message_type=None):
+        messages = [json.loads(message) for message in self.sent if isinstance(message, str)]
+        return [message for message in messages if message_type is None or message.get('type') == message_type]
+
+    def stems(self):
+        """Names of the stems sent so far, in order (JSON protocol)"""
+        return [message['stem'] for message in self.json_messages('separated_audio')]
+
+
+def connect(server):
+    """A session registered with the server the way register_client() does it"""
+    session = Session(FakeWebSocket(), max_queue=server.max_queue_chunks)
+    session.model_config = {'engine': server.default_engine, 'model': server.engines[server.default_engine].default_model}
+    server.sessions[session.websocket] = session
+    return session
+
+
+async def configure(server, session, **config):
+    """Send a configure and wait until its model has taken over (or failed to load)"""
+    await server.configure_model(session, dict(dict(engine='mock', realtime_factor=0), **config))
+    await session.loading_task
+
+
+def stereo(frames, seed=0):
+    """Interleaved stereo test audio"""
+    return (np.random.default_rng(seed).standard_normal(2 * frames) * 0.1).astype(np.float32)
+
+
+async def drain(session):
+    """Wait until the session has worked through its queue"""
+    if session.processing_task is not None:
+        await session.processing_task
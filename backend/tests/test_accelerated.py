@@ -0,0 +1,121 @@
+import os
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+import accelerated
+from accelerated import (BACKEND_EAGER, BACKEND_ONNX, BACKEND_TORCHSCRIPT, EXPORT_CHANNELS, EXPORT_FRAMES,
+                         AcceleratedModel, private_cache_dir, spec_digest)
+
+
+class _Net(torch.nn.Module):
+    sources = ['vocals', 'other']
+
+    def forward(self, x):
+        return torch.stack([x * 0.5, x * 0.25], dim=1)
+
+
+class FakeModel:
+    """Demucs-like: predict() normalises around the network, unless it is told to be off by a little"""
+
+    def __init__(self, offset=0.0):
+        self.model = _Net()
+        self.offset = offset
+        self.calls = 0
+
+    def predict(self, audio, sampling_rate=44100):
+        self.calls += 1
+        reference = audio.mean(0)
+        mean, std = reference.mean(), reference.std() + 1e-8
+        with torch.no_grad():
+            stems = self.model(torch.from_numpy(((audio - mean) / std)[None].astype(np.float32)))[0].numpy()
+        return {name: stem * std + mean + self.offset for name, stem in zip(self.model.sources, stems)}
+
+
+def _spec(backend, name='fake', metadata=()):
+    return SimpleNamespace(backend=backend, name=name, model_class='Demucs', metadata=metadata, quantize=None)
+
+
+def _window(seed=0):
+    return (np.random.default_rng(seed).standard_normal((EXPORT_CHANNELS, EXPORT_FRAMES)) * 0.1).astype(np.float32)
+
+
+@pytest.fixture
+def temp_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return tmp_path
+
+
+def test_an_exported_graph_with_parity_serves_streaming_windows():
+    eager = FakeModel()
+    model = AcceleratedModel(eager, _spec(BACKEND_TORCHSCRIPT))
+    assert model.backend == BACKEND_TORCHSCRIPT and model.report['backend'] == BACKEND_TORCHSCRIPT
+    assert model.report['parity']['max_abs_error'] <= accelerated.PARITY_TOLERANCE
+
+    audio = _window()
+    calls = eager.calls
+    stems = model.predict(audio)
+    assert eager.calls == calls  # The window went through the graph
+    for name, stem in eager.predict(audio).items():
+        np.testing.assert_allclose(stems[name], stem, atol=1e-5)
+
+    model.predict(audio[:, :1000])
+    model.predict(audio, sampling_rate=48000)
+    assert eager.calls == calls + 3  # Other shapes and rates stay on predict()
+
+
+def test_a_graph_that_differs_from_predict_falls_back_to_eager():
+    eager = FakeModel(offset=0.01)
+    model = AcceleratedModel(eager, _spec(BACKEND_TORCHSCRIPT))
+    assert model.backend == BACKEND_EAGER
+    assert 'parity error' in model.report['fallback_reason']
+
+    calls = eager.calls
+    model.predict(_window())
+    assert eager.calls == calls + 1
+
+
+def test_models_without_a_single_network_stay_eager():
+    class PredictOnly:
+        def predict(self, audio, sampling_rate=44100):
+            return {'vocals': audio}
+
+    model = AcceleratedModel(PredictOnly(), _spec(BACKEND_TORCHSCRIPT))
+    assert model.backend == BACKEND_EAGER and 'no single torch network' in model.report['fallback_reason']
+    assert model.model is None
+
+
+def test_eager_specs_do_not_export():
+    model = AcceleratedModel(FakeModel(), _spec(BACKEND_EAGER))
+    assert model.report == {'requested_backend': BACKEND_EAGER, 'backend': BACKEND_EAGER}
+
+
+@pytest.mark.skipif(accelerated.onnxruntime is None, reason="onnxruntime is not installed")
+def test_onnx_graphs_are_cached_in_the_private_directory(temp_dir):
+    model = AcceleratedModel(FakeModel(), _spec(BACKEND_ONNX))
+    assert model.backend == BACKEND_ONNX, model.report
+
+    cache = private_cache_dir(accelerated.ONNX_CACHE_NAME)
+    files = os.listdir(cache)
+    assert files == [f"fake-{spec_digest(_spec(BACKEND_ONNX))}-{EXPORT_CHANNELS}x{EXPORT_FRAMES}.onnx"]
+    assert AcceleratedModel(FakeModel(), _spec(BACKEND_ONNX)).backend == BACKEND_ONNX  # Loaded from the cache
+
+
+def test_the_cache_directory_must_be_private(temp_dir):
+    path = private_cache_dir('cache')
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert private_cache_dir('cache') == path
+
+    os.chmod(path, 0o755)
+    with pytest.raises(PermissionError):
+        private_cache_dir('cache')
+
+
+def test_spec_digests_follow_the_network_not_the_backend():
+    digest = spec_digest(_spec(BACKEND_ONNX))
+    assert digest == spec_digest(_spec(BACKEND_TORCHSCRIPT)) and len(digest) == 16
+    assert digest != spec_digest(_spec(BACKEND_ONNX, name='other'))
+    assert digest != spec_digest(_spec(BACKEND_ONNX, metadata=(('segment', 4),)))
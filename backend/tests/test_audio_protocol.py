@@ -0,0 +1,95 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import audio_protocol as ap
+from helpers import configure, connect, stereo
+
+
+def test_float32_frame_round_trip():
+    samples = np.linspace(-1.0, 1.0, 64, dtype=np.float32)
+    frame = ap.encode_frame(ap.MSG_SEPARATED_AUDIO, samples, seq=7, sample_rate=48000, channels=2,
+                            stem='vocals', timestamp=1234.5)
+    assert len(frame) == ap.HEADER_SIZE + samples.nbytes
+
+    decoded = ap.decode_frame(bytes(frame))
+    assert decoded.msg_type == ap.MSG_SEPARATED_AUDIO
+    assert decoded.seq == 7
+    assert decoded.sample_rate == 48000
+    assert decoded.channels == 2
+    assert decoded.dtype == ap.DTYPE_FLOAT32
+    assert decoded.stem == 'vocals'
+    assert decoded.timestamp == 1234.5
+    np.testing.assert_array_equal(decoded.samples, samples)
+
+
+# int16 is written at 32767 per unit and truncated, and read back at 32768 per unit
+@pytest.mark.parametrize('dtype, tolerance', [('float16', 1e-3), ('int16', 2.0 / 32767)])
+def test_narrow_dtypes_round_trip_within_their_precision(dtype, tolerance):
+    samples = np.linspace(-1.0, 1.0, 101, dtype=np.float32)
+    decoded = ap.decode_frame(bytes(ap.encode_frame(ap.MSG_SEPARATED_AUDIO, samples, dtype=dtype)))
+    assert decoded.dtype == ap.DTYPE_CODES[dtype]
+    np.testing.assert_allclose(ap.as_float32(decoded.samples), samples, atol=tolerance)
+
+
+def test_every_stem_name_survives_the_header():
+    for stem in ap.STEM_IDS:
+        frame = ap.encode_frame(ap.MSG_SEPARATED_AUDIO, np.zeros(4, dtype=np.float32), stem=stem)
+        assert ap.decode_frame(bytes(frame)).stem == stem
+
+
+def test_sequence_numbers_wrap_at_32_bits():
+    frame = ap.encode_frame(ap.MSG_AUDIO_DATA, np.zeros(2, dtype=np.float32), seq=2 ** 32 + 5)
+    assert ap.decode_frame(bytes(frame)).seq == 5
+
+
+@pytest.mark.parametrize('mutate', [
+    lambda frame: frame[:ap.HEADER_SIZE - 1],           # Truncated header
+    lambda frame: b'XX' + frame[2:],                     # Bad magic
+    lambda frame: frame[:2] + b'\x09' + frame[3:],       # Unknown version
+    lambda frame: frame[:13] + b'\x09' + frame[14:],     # Unknown dtype
+    lambda frame: frame + b'\x00',                       # Partial sample
+])
+def test_malformed_frames_are_rejected(mutate):
+    frame = bytes(ap.encode_frame(ap.MSG_AUDIO_DATA, np.zeros(4, dtype=np.float32), channels=2))
+    with pytest.raises(ap.ProtocolError):
+        ap.decode_frame(mutate(frame))
+
+
+def test_negotiation_prefers_the_clients_first_supported_protocol():
+    assert ap.negotiate_protocol(['opus', 'binary', 'json']) == ap.PROTOCOL_BINARY
+    assert ap.negotiate_protocol('binary') == ap.PROTOCOL_BINARY
+    assert ap.negotiate_protocol(['opus']) == ap.PROTOCOL_JSON
+    assert ap.negotiate_protocol(None) == ap.PROTOCOL_JSON
+
+
+def test_binary_clients_get_binary_stems_back(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await server.process_message(session, {'type': 'hello', 'protocols': ['binary', 'json']})
+        assert session.websocket.json_messages('protocol')[0]['protocol'] == ap.PROTOCOL_BINARY
+        await configure(server, session, latency_budget_ms=60000)
+
+        samples = stereo(44100)
+        frame = ap.encode_frame(ap.MSG_AUDIO_DATA, samples, seq=3, sample_rate=44100, channels=2, timestamp=0)
+        await server.process_binary_message(session, bytes(frame))
+        await session.processing_task
+
+        stems = [ap.decode_frame(message) for message in session.websocket.sent if isinstance(message, bytearray)]
+        assert {stem.stem for stem in stems} == set(server.engines['mock'].stems)
+        assert all(stem.msg_type == ap.MSG_SEPARATED_AUDIO and stem.seq == 3 for stem in stems)
+
+    asyncio.run(scenario())
+
+
+def test_audio_frames_from_the_client_must_be_audio_data(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        frame = ap.encode_frame(ap.MSG_SEPARATED_AUDIO, np.zeros(4, dtype=np.float32))
+        with pytest.raises(ap.ProtocolError):
+            await server.process_binary_message(session, bytes(frame))
+
+    asyncio.run(scenario())
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+import uvr_models
+from batching import BatchScheduler
+from helpers import configure, connect, drain, stereo
+
+
+class RecordingBatch:
+    """run_batch callback that scales each input by its model and records the batch sizes"""
+
+    def __init__(self, error=None):
+        self.sizes = []
+        self.threads = set()
+        self.error = error
+
+    def __call__(self, model, audios, sample_rate):
+        self.sizes.append(len(audios))
+        self.threads.add(threading.get_ident())
+        if self.error is not None:
+            raise self.error
+        return [{'scaled': audio * model} for audio in audios]
+
+
+def test_chunks_within_the_window_share_one_call():
+    async def scenario():
+        run = RecordingBatch()
+        scheduler = BatchScheduler(run, window_ms=50, max_batch=8)
+        audios = [np.full((2, 8), index, dtype=np.float32) for index in range(3)]
+        results = await asyncio.gather(*(scheduler.submit('model', 2.0, audio, 44100) for audio in audios))
+
+        assert run.sizes == [3]
+        assert threading.get_ident() not in run.threads  # Ran in the executor
+        for audio, result in zip(audios, results):
+            np.testing.assert_array_equal(result['scaled'], audio * 2.0)
+        stats = scheduler.stats()
+        assert (stats['batches'], stats['items'], stats['largest_batch'], stats['pending_groups']) == (1, 3, 3, 0)
+
+    asyncio.run(scenario())
+
+
+def test_a_full_batch_does_not_wait_for_the_window():
+    async def scenario():
+        run = RecordingBatch()
+        scheduler = BatchScheduler(run, window_ms=60000, max_batch=2)
+        audio = np.zeros((2, 8), dtype=np.float32)
+        await asyncio.wait_for(asyncio.gather(scheduler.submit('model', 1.0, audio, 44100),
+                                              scheduler.submit('model', 1.0, audio, 44100)), 5)
+        assert run.sizes == [2]
+
+    asyncio.run(scenario())
+
+
+def test_models_rates_and_shapes_are_batched_separately():
+    async def scenario():
+        run = RecordingBatch()
+        scheduler = BatchScheduler(run, window_ms=20, max_batch=8)
+        await asyncio.gather(
+            scheduler.submit('a', 1.0, np.zeros((2, 8), dtype=np.float32), 44100),
+            scheduler.submit('b', 1.0, np.zeros((2, 8), dtype=np.float32), 44100),
+            scheduler.submit('a', 1.0, np.zeros((2, 8), dtype=np.float32), 48000),
+            scheduler.submit('a', 1.0, np.zeros((2, 16), dtype=np.float32), 44100),
+            scheduler.submit('a', 1.0, np.zeros((2, 8), dtype=np.float32), 44100),
+        )
+        assert sorted(run.sizes) == [1, 1, 1, 2]
+
+    asyncio.run(scenario())
+
+
+def test_a_failed_batch_fails_every_chunk_in_it():
+    async def scenario():
+        scheduler = BatchScheduler(RecordingBatch(error=RuntimeError('out of memory')), window_ms=20)
+        audio = np.zeros((2, 8), dtype=np.float32)
+        results = await asyncio.gather(scheduler.submit('model', 1.0, audio, 44100),
+                                       scheduler.submit('model', 1.0, audio, 44100), return_exceptions=True)
+        assert [str(result) for result in results] == ['out of memory', 'out of memory']
+
+    asyncio.run(scenario())
+
+
+class _Net(torch.nn.Module):
+    sources = ['vocals', 'other']
+
+    def forward(self, x):
+        return torch.stack([x * 0.5, x * 0.25], dim=1)
+
+
+class FakeModel:
+    """A Demucs-like model whose predict() either matches its normalised forward pass or does not"""
+
+    def __init__(self, matches):
+        self.model = _Net()
+        self.name = 'fake'
+        self.matches = matches
+        self.calls = 0
+
+    def predict(self, audio, sampling_rate=44100):
+        self.calls += 1
+        if not self.matches:
+            return {'vocals': audio * 0.5 + 0.01, 'other': audio * 0.25}
+        reference = audio.mean(0)
+        mean, std = reference.mean(), reference.std() + 1e-8
+        normalised = (audio - mean) / std
+        return {'vocals': normalised * 0.5 * std + mean, 'other': normalised * 0.25 * std + mean}
+
+
+def _batch(seed, frames=44100 + 500):
+    rng = np.random.default_rng(seed)
+    return [rng.standard_normal((2, frames)).astype(np.float32) for _ in range(3)]
+
+
+@pytest.mark.parametrize('matches', [True, False])
+def test_batches_match_predict_whether_or_not_the_forward_pass_is_used(matches):
+    model = FakeModel(matches)
+    for seed in range(3):
+        batch = _batch(seed)
+        calls = model.calls
+        stems = uvr_models.separate_batch(model, batch, 44100, max_seconds=1.0)
+        predict_calls = model.calls - calls
+
+        expected = [model.predict(audio[..., :44100]) for audio in batch]
+        for got, want in zip(stems, expected):
+            assert got['vocals'].shape == (2, 44100)  # Capped at max_seconds
+            for name in want:
+                np.testing.assert_allclose(got[name], want[name], atol=1e-4)
+
+        if seed == 0 or not matches:
+            assert predict_calls == len(batch)  # Unproven (or failed) models answer through predict
+        else:
+            assert predict_calls == 0
+    assert model.batch_report['batched'] is matches
+
+
+def test_models_without_a_torch_module_are_separated_one_chunk_at_a_time():
+    class PredictOnly:
+        def predict(self, audio, sampling_rate=44100):
+            return {'vocals': audio * 2}
+
+    stems = uvr_models.separate_batch(PredictOnly(), _batch(0, frames=100), 44100)
+    assert len(stems) == 3 and not hasattr(PredictOnly, 'batch_report')
+
+
+def test_sessions_on_the_same_model_share_batches(make_server):
+    async def scenario():
+        server = make_server(mock_realtime_factor=1000, batch_window_ms=100, max_batch=2)
+        sessions = [connect(server), connect(server)]
+        for session in sessions:
+            await configure(server, session, engine='uvr', model='htdemucs', latency_budget_ms=60000)
+        assert all(server.batches(session) for session in sessions)
+
+        await asyncio.gather(*(server.queue_audio_processing(session, stereo(2 * 44100, seed=index), 44100, 2, 0)
+                               for index, session in enumerate(sessions)))
+        for session in sessions:
+            await drain(session)
+
+        stats = server.batch_scheduler.stats()
+        assert stats['items'] == sum(session.stats['chunks_processed'] for session in sessions) > 0
+        assert stats['largest_batch'] == 2
+        for session in sessions:
+            assert session.stats['errors'] == 0 and session.websocket.stems()
+
+    asyncio.run(scenario())
+
+
+def test_sessions_on_the_mock_engine_are_not_batched(make_server):
+    async def scenario():
+        server = make_server(mock_realtime_factor=1000, batch_window_ms=100)
+        session = connect(server)
+        await configure(server, session)
+        assert server.batch_scheduler is not None and not server.batches(session)
+
+    asyncio.run(scenario())
@@ -0,0 +1,115 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from inference_pool import InferencePool, WorkerCrashedError, _WorkerSlot
+
+
+# Worker processes are spawned, so everything they run must be importable module-level functions
+
+def load_gain(spec):
+    return {'gain': float(spec), 'pid': os.getpid()}
+
+
+def describe_gain(model):
+    return {'gain': model['gain'], 'pid': model['pid']}
+
+
+def separate_gain(model, audio, sample_rate, memory_manager=None, fail=None, sleep=0.0):
+    if fail == 'raise':
+        raise ValueError("bad chunk")
+    if fail == 'exit':
+        os._exit(3)
+    time.sleep(sleep)
+    return {'scaled': audio * model['gain'], 'rest': audio * (1 - model['gain'])}
+
+
+@pytest.fixture(scope='module')
+def pool():
+    # Spawning a worker imports torch, so the tests share one pool
+    pool = InferencePool(2, load_gain, separate_gain, describe_fn=describe_gain, max_frames=4096, max_stems=2,
+                         job_timeout=30)
+    pool.start()
+    yield pool
+    pool.close()
+
+
+def test_run_moves_audio_through_shared_memory(pool):
+    audio = np.random.default_rng(0).standard_normal((2, 4096)).astype(np.float32)
+    stems = pool.run(0, 0.25, audio, 44100)
+
+    jobs = pool.stats()['workers'][0]['jobs']
+    assert list(stems) == ['scaled', 'rest']
+    np.testing.assert_allclose(stems['scaled'], audio * 0.25, rtol=1e-6)
+    np.testing.assert_allclose(stems['rest'], audio * 0.75, rtol=1e-6)
+
+    # Results are copies: the next job reuses the output block
+    pool.run(0, 0.5, np.zeros((2, 4096), dtype=np.float32), 44100)
+    np.testing.assert_allclose(stems['scaled'], audio * 0.25, rtol=1e-6)
+    assert pool.stats()['workers'][0]['jobs'] == jobs + 1
+
+
+def test_load_reports_the_model_from_the_worker_process(pool):
+    report = pool.load(1, 0.5)
+    assert report['gain'] == 0.5
+    assert report['pid'] == pool.stats()['workers'][1]['pid'] != os.getpid()
+
+
+def test_sessions_are_pinned_to_the_least_loaded_worker(pool):
+    first, second, third = pool.assign(), pool.assign(), pool.assign()
+    assert {first, second} == {0, 1}
+    assert third in (0, 1)
+
+    pool.unassign(third)
+    pool.unassign(None)
+    assert [worker['sessions'] for worker in pool.stats()['workers']] == [1, 1]
+    pool.unassign(first)
+    pool.unassign(second)
+
+
+@pytest.mark.parametrize('offline_workers', [0, 1])
+def test_offline_jobs_get_their_own_workers_when_there_are_any(offline_workers):
+    pool = InferencePool(2, load_gain, separate_gain, offline_workers=offline_workers)
+    pool._slots = [_WorkerSlot(index, None, None) for index in range(2 + offline_workers)]  # Not started
+
+    live = [pool.assign() for _ in range(4)]
+    offline = [pool.assign(offline=True) for _ in range(2)]
+    assert sorted(live) == [0, 0, 1, 1]
+    assert offline == ([2, 2] if offline_workers else [0, 1])
+
+
+def test_audio_larger_than_the_worker_buffers_is_refused(pool):
+    with pytest.raises(ValueError):
+        pool.run(0, 1.0, np.zeros((2, 4097), dtype=np.float32), 44100)
+    with pytest.raises(ValueError):
+        pool.run(0, 1.0, np.zeros((3, 16), dtype=np.float32), 44100)
+
+
+def test_a_failing_job_leaves_the_worker_running(pool):
+    restarts = pool.stats()['workers'][0]['restarts']
+    with pytest.raises(RuntimeError, match='bad chunk'):
+        pool.run(0, 1.0, np.ones((2, 16), dtype=np.float32), 44100, fail='raise')
+
+    stems = pool.run(0, 1.0, np.ones((2, 16), dtype=np.float32), 44100)
+    np.testing.assert_array_equal(stems['scaled'], np.ones((2, 16)))
+    assert pool.stats()['workers'][0]['restarts'] == restarts
+
+
+def test_a_crashed_worker_is_restarted(pool):
+    before = pool.stats()['workers'][0]
+    with pytest.raises(WorkerCrashedError):
+        pool.run(0, 1.0, np.ones((2, 16), dtype=np.float32), 44100, fail='exit')
+
+    worker = pool.stats()['workers'][0]
+    assert worker['restarts'] == before['restarts'] + 1 and worker['alive'] and worker['pid'] != before['pid']
+    stems = pool.run(0, 1.0, np.ones((2, 16), dtype=np.float32), 44100)
+    np.testing.assert_array_equal(stems['scaled'], np.ones((2, 16)))
+
+
+def test_a_job_past_its_timeout_restarts_the_worker(pool):
+    restarts = pool.stats()['workers'][1]['restarts']
+    with pytest.raises(WorkerCrashedError, match='timed out'):
+        pool.run(1, 1.0, np.ones((2, 16), dtype=np.float32), 44100, timeout=0.3, sleep=30)
+    assert pool.stats()['workers'][1]['restarts'] == restarts + 1
@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+
+import memory_manager as memory_module
+import uvr_models
+from memory_manager import MemoryManager
+
+
+def test_workspaces_are_reused_per_thread_name_and_shape():
+    manager = MemoryManager(1024 ** 3)
+    buffer = manager.workspace('chunk_input', (2, 100))
+    assert manager.workspace('chunk_input', [2, 100]) is buffer
+    assert buffer.dtype == np.float32 and buffer.shape == (2, 100)
+
+    assert manager.workspace('stacked_stems', (2, 100)) is not buffer
+    resized = manager.workspace('chunk_input', (2, 50))
+    assert resized is not buffer and manager.workspace('chunk_input', (2, 50)) is resized
+    assert manager.workspace('chunk_input', (2, 50), dtype=np.int16).dtype == np.int16
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(manager.workspace('chunk_input', (2, 50))))
+    thread.start()
+    thread.join()
+    assert other[0] is not manager.workspace('chunk_input', (2, 50))
+
+
+def test_collection_waits_for_the_threshold_and_the_interval(monkeypatch):
+    manager = MemoryManager(1000, collect_fraction=0.5, min_interval=5.0)
+    usage, now = [400], [100.0]
+    monkeypatch.setattr(manager, 'usage_bytes', lambda: usage[0])
+    monkeypatch.setattr(memory_module.time, 'monotonic', lambda: now[0])
+    collected = []
+    monkeypatch.setattr(manager, 'collect', lambda reason: collected.append(reason))
+
+    assert not manager.check()  # Under the 500 byte threshold
+    usage[0] = 600
+    assert manager.check()
+    now[0] += 1.0
+    assert not manager.check()  # Still over, but collected a second ago
+    now[0] += 5.0
+    assert manager.check()
+
+    stats = manager.stats()
+    assert len(collected) == 2
+    assert (stats['checks'], stats['peak_bytes'], stats['threshold_bytes'], stats['over_budget']) == (4, 600, 500, 0)
+
+
+def test_usage_left_over_the_budget_after_collecting_is_counted(monkeypatch):
+    manager = MemoryManager(1000, collect_fraction=0.5)
+    monkeypatch.setattr(manager, 'usage_bytes', lambda: 1200)
+    assert manager.check()
+    assert manager.collections == 1 and manager.over_budget == 1
+
+
+def test_separate_chunk_copies_into_the_reused_input_workspace():
+    seen = []
+
+    class Model:
+        def predict(self, audio, sampling_rate=44100):
+            seen.append(audio)
+            return {'vocals': audio * 0.5}
+
+    manager = MemoryManager(1024 ** 3)
+    view = np.random.default_rng(0).standard_normal((100, 2)).astype(np.float32).T  # Not contiguous
+    first = uvr_models.separate_chunk(Model(), view, 44100, memory_manager=manager)
+    uvr_models.separate_chunk(Model(), view * 2, 44100, memory_manager=manager)
+
+    assert seen[0] is seen[1] is manager.workspace('chunk_input', (2, 100))
+    assert seen[0].flags['C_CONTIGUOUS']
+    np.testing.assert_allclose(first['vocals'], view * 0.5)  # Stems are the model's own arrays
+    assert manager.checks == 2
@@ -0,0 +1,123 @@
+import asyncio
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from helpers import configure, connect, drain, stereo
+from metrics import LATENCY_BUCKETS, Counter, Gauge, Histogram, PipelineMetrics
+
+
+def sample(text, name, **labels):
+    """Value of one series in an exposition, or None"""
+    for line in text.splitlines():
+        match = re.fullmatch(r'([a-z_]+)(?:\{(.*)\})? (\S+)', line)
+        if match is None or match.group(1) != name:
+            continue
+        found = dict(re.findall(r'([a-z_]+)="((?:[^"\\]|\\.)*)"', match.group(2) or ''))
+        if all(found.get(key) == str(value) for key, value in labels.items()):
+            return float(match.group(3))
+    return None
+
+
+def test_counters_and_gauges_render_per_label_set():
+    counter = Counter('requests_total', 'Requests.', ('route',))
+    counter.inc(route='/a')
+    counter.inc(2, route='/a')
+    counter.inc(route='/b "quoted"')
+    gauge = Gauge('temperature', 'Degrees.', const_labels={'site': 'lab'})
+    gauge.set(21.5)
+
+    text = '\n'.join(counter.render() + gauge.render())
+    assert '# TYPE requests_total counter' in text and '# TYPE temperature gauge' in text
+    assert sample(text, 'requests_total', route='/a') == 3
+    assert 'requests_total{route="/b \\"quoted\\""} 1' in text
+    assert 'temperature{site="lab"} 21.5' in text
+
+
+def test_labels_must_match_the_metric():
+    counter = Counter('requests_total', 'Requests.', ('route',))
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(route='/a', method='GET')
+
+
+def test_histograms_count_cumulatively_into_their_buckets():
+    histogram = Histogram('wait_seconds', 'Waits.', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+
+    text = '\n'.join(histogram.render())
+    assert sample(text, 'wait_seconds_bucket', le='0.1') == 2  # Upper bounds are inclusive
+    assert sample(text, 'wait_seconds_bucket', le='1.0') == 3
+    assert sample(text, 'wait_seconds_bucket', le='+Inf') == 4
+    assert sample(text, 'wait_seconds_count') == 4
+    assert sample(text, 'wait_seconds_sum') == pytest.approx(3.65)
+
+
+def _session(queued=0, latency_ms=None, model='htdemucs'):
+    return SimpleNamespace(engine=SimpleNamespace(name='uvr'), model_name=model,
+                           processing_queue=SimpleNamespace(qsize=lambda: queued),
+                           chunking=None if latency_ms is None else {'latency_ms': latency_ms})
+
+
+def test_the_realtime_factor_is_smoothed_per_model():
+    metrics = PipelineMetrics(smoothing=0.5)
+    session = _session()
+    metrics.record_chunk(session, 1.0, 0.5)  # 2x real time
+    metrics.record_chunk(session, 1.0, 0.25)  # 4x
+    metrics.record_chunk(_session(model='other'), 1.0, 1.0)
+
+    text = metrics.render([])
+    assert sample(text, 'separator_realtime_factor', engine='uvr', model='htdemucs') == 3.0
+    assert sample(text, 'separator_realtime_factor', model='other') == 1.0
+    assert sample(text, 'separator_audio_seconds_total', model='htdemucs') == 2.0
+    assert sample(text, 'separator_processing_seconds_total', model='htdemucs') == 0.75
+
+
+def test_session_gauges_are_taken_when_rendered():
+    metrics = PipelineMetrics()
+    sessions = [_session(queued=2, latency_ms=500), _session(queued=1, latency_ms=1200), _session(model='other')]
+    text = metrics.render(sessions)
+    assert sample(text, 'separator_queue_depth', model='htdemucs') == 3
+    assert sample(text, 'separator_sessions', model='htdemucs') == 2
+    assert sample(text, 'separator_latency_seconds', model='htdemucs') == 1.2
+    assert sample(text, 'separator_latency_seconds', model='other') is None  # No chunk plan yet
+    assert sample(text, 'separator_process_resident_memory_bytes') > 0
+
+    text = metrics.render(sessions[2:])
+    assert sample(text, 'separator_sessions', model='htdemucs') is None  # Gone with its sessions
+
+
+def test_the_metrics_route_counts_the_pipeline(make_server):
+    server = make_server()
+
+    async def scenario():
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        await server.queue_audio_processing(session, stereo(44100), 44100, 2, 0)
+        await drain(session)
+
+        dropped = connect(server)
+        await configure(server, dropped)
+        dropped.separation_seconds = 10.0
+        await server.queue_audio_processing(dropped, stereo(44100), 44100, 2, 0)
+        await drain(dropped)
+        return session, dropped
+
+    session, dropped = asyncio.run(scenario())
+    response = server.app.test_client().get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    labels = {'engine': 'mock', 'model': session.model_name}
+
+    processed = session.stats['chunks_processed']
+    assert processed > 0 and sample(text, 'separator_chunks_processed_total', **labels) == processed
+    assert sample(text, 'separator_chunks_dropped_total', **labels) == dropped.stats['dropped_chunks'] > 0
+    assert sample(text, 'separator_stage_seconds_count', stage='inference', **labels) == processed
+    assert sample(text, 'separator_stage_seconds_count', stage='queue', **labels) >= processed
+    assert sample(text, 'separator_model_load_seconds_count', **labels) == 2
+    assert sample(text, 'separator_sessions', **labels) == 2
+    assert sample(text, 'separator_latency_seconds', **labels) == session.chunking['latency_ms'] / 1000.0
+    assert len(LATENCY_BUCKETS) + 1 == len(re.findall(r'separator_stage_seconds_bucket\{[^}]*stage="inference"', text))
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from helpers import configure, connect, drain
+from model_loader import ModelLoader
+from resampler import delay_seconds
+
+
+@pytest.fixture
+def loader():
+    loader = ModelLoader()
+    yield loader
+    loader.shutdown()
+
+
+def test_concurrent_loads_of_one_key_share_a_single_call(loader):
+    release = threading.Event()
+    calls = []
+
+    def load_model(name):
+        calls.append(name)
+        release.wait(10)
+        return f'{name} model'
+
+    async def scenario():
+        first = loader.load('htdemucs', load_model, 'htdemucs')
+        second = loader.load('htdemucs', load_model, 'htdemucs')
+        other = loader.load('hdemucs_mmi', load_model, 'hdemucs_mmi')
+        assert second is first and other is not first
+        assert first.waiters == 2 and loader.coalesced == 1 and loader.loads == 2
+        assert {load['key'] for load in loader.stats()['in_flight']} == {'htdemucs', 'hdemucs_mmi'}
+
+        second.leave()
+        assert first.waiters == 1
+        release.set()
+        assert await first.future == 'htdemucs model'
+        await other.future
+        first.leave()
+        other.leave()
+        await asyncio.sleep(0)  # Done callbacks
+        assert first.waiters == 0 and loader.stats()['in_flight'] == []
+
+        # Finished loads are not shared; the next one starts afresh
+        again = loader.load('htdemucs', load_model, 'htdemucs')
+        assert again is not first
+        await again.future
+
+    asyncio.run(scenario())
+    assert calls.count('htdemucs') == 2
+
+
+def test_progress_is_estimated_from_the_last_load_of_the_key(loader):
+    release = threading.Event()
+
+    async def scenario():
+        first = loader.load('htdemucs', lambda: None)
+        assert 'progress' not in first.progress()  # Never loaded before
+        await first.future
+        await asyncio.sleep(0)
+
+        second = loader.load('htdemucs', release.wait, 10)
+        progress = second.progress()
+        assert progress['expected_ms'] == round(loader._seconds['htdemucs'] * 1000.0, 1)
+        assert 0 <= progress['progress'] <= 0.99 and progress['waiters'] == 1
+        release.set()
+        await second.future
+
+    asyncio.run(scenario())
+
+
+def test_failed_loads_are_counted_and_not_remembered(loader):
+    def fail():
+        raise RuntimeError('no such model')
+
+    async def scenario():
+        load = loader.load('missing', fail)
+        with pytest.raises(RuntimeError):
+            await load.future
+        await asyncio.sleep(0)
+        assert loader.failures == 1
+        assert 'expected_ms' not in loader.load('missing', lambda: None).progress()
+
+    asyncio.run(scenario())
+
+
+def test_sessions_configuring_one_model_together_share_its_load(make_server):
+    async def scenario():
+        server = make_server()
+        first, second = connect(server), connect(server)
+        config = {'engine': 'mock', 'model': 'shared', 'realtime_factor': 0}
+        await server.configure_model(first, dict(config))
+        await server.configure_model(second, dict(config))
+        await asyncio.gather(first.loading_task, second.loading_task)
+
+        assert server.model_loader.loads == 1 and server.model_loader.coalesced == 1
+        assert first.model_name == second.model_name == 'shared'
+
+    asyncio.run(scenario())
+
+
+def test_only_the_latest_configure_takes_over(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await server.configure_model(session, {'engine': 'mock', 'model': 'first', 'realtime_factor': 0})
+        superseded = session.loading_task
+        await configure(server, session, model='second')
+        await superseded
+
+        assert session.model_name == 'second' and session.pending_swap is None and session.swaps == {}
+        active = [message['loading'] for message in session.websocket.json_messages('status')
+                  if message.get('loading', {}).get('state') == 'active']
+        assert [loading['model'] for loading in active] == ['second']
+
+    asyncio.run(scenario())
+
+
+def _tone(frames, sample_rate, frequency=220.0):
+    mono = 0.5 * np.sin(2 * np.pi * frequency * np.arange(frames) / sample_rate)
+    return np.repeat(mono[:, None], 2, axis=1).astype(np.float32)
+
+
+def test_audio_carried_over_a_rate_change_is_resampled(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        # 48 kHz input separated at the mock's native 44.1 kHz
+        await configure(server, session, sample_rate=48000)
+        await server.queue_audio_processing(session, _tone(20000, 48000).ravel(), 48000, 2, 0)
+        assert session.model_rate == 44100 and session.window_index == 0
+
+        # Without resampling the new model runs at 48 kHz; the switch happens at once on an idle session
+        await configure(server, session, resample=False, sample_rate=48000)
+        carried = len(session.carried_frames)
+        await server.queue_audio_processing(session, np.zeros(20, dtype=np.float32), 48000, 2, 0)
+        assert session.model_rate == 48000
+
+        ring = session.ring_buffer
+        audio = np.array(ring.read_window(ring.readable, advance=0))[session.stream.left_context:]
+        assert len(audio) == round(carried * 48000 / 44100) + 10
+        # The same tone, only delayed by the filters on the way to 44.1 kHz and back
+        delay = delay_seconds(48000, 44100) + delay_seconds(44100, 48000)
+        expected = 0.5 * np.sin(2 * np.pi * 220.0 * (np.arange(len(audio)) / 48000 - delay))
+        np.testing.assert_allclose(audio[200:-200, 0], expected[200:-200], atol=1e-4)
+
+    asyncio.run(scenario())
+
+
+def test_the_queue_makes_room_for_a_carried_backlog_until_it_drains(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        await server.queue_audio_processing(session, _tone(15000, 44100).ravel(), 44100, 2, 0)
+        assert session.window_index == 0 and session.queue_limit == session.max_queue
+
+        await configure(server, session, latency_budget_ms=60000, realtime_factor=1000)
+        await server.queue_audio_processing(session, _tone(4 * 44100, 44100).ravel(), 44100, 2, 0)
+        # The windows cut from the carried backlog all get room on top of the usual bound
+        backlog = (session.stream.left_context + 15000 + 4 * 44100) // session.stream.hop_frames
+        assert session.queue_limit == session.max_queue + backlog > session.window_index
+        assert session.stats['dropped_chunks'] == 0
+        await drain(session)
+
+        await server.queue_audio_processing(session, _tone(10, 44100).ravel(), 44100, 2, 0)
+        assert session.queue_limit == session.max_queue
+        assert session.stats['dropped_chunks'] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+import model_registry
+from model_registry import ModelRegistry
+from helpers import FakeWebSocket
+from session import Session
+from uvr_models import resolve_model_spec
+
+
+class Loader:
+    """Counts loads; every model is a dict naming its key"""
+
+    def __init__(self):
+        self.loads = []
+
+    def __call__(self, key):
+        self.loads.append(key)
+        return {'key': key}
+
+
+def registry(budget, loader=None):
+    return ModelRegistry(loader or Loader(), budget, size_fn=lambda model: 10)
+
+
+def test_acquire_loads_once_and_counts_hits():
+    loader = Loader()
+    models = registry(100, loader)
+    first = models.acquire('a')
+    assert models.acquire('a') is first
+    assert loader.loads == ['a']
+    assert (models.hits, models.misses) == (1, 1)
+
+
+def test_least_recently_used_idle_model_is_evicted():
+    models = registry(20)
+    for key in 'abc':
+        models.acquire(key)
+    models.release('a')
+    models.release('b')
+    models.release('c')
+
+    assert models.evictions == 1
+    assert [entry['key'] for entry in models.stats()['entries']] == ['b', 'c']
+
+
+def test_models_in_use_are_kept_over_the_budget():
+    models = registry(10)
+    models.acquire('a')
+    models.acquire('b')
+    assert models.evictions == 0
+    assert models.total_bytes == 20
+
+    models.release('a')
+    assert models.evictions == 1
+    assert [entry['key'] for entry in models.stats()['entries']] == ['b']
+
+
+def test_a_warmed_model_waits_for_its_acquire_even_over_the_budget():
+    loader = Loader()
+    models = registry(5, loader)  # Smaller than one model
+    models.warm('a')
+    assert models.stats()['entries'][0]['warm']
+
+    models.acquire('a')
+    assert loader.loads == ['a']  # prepare() took over the warmed copy instead of loading it again
+    models.release('a')
+    assert models.evictions == 1
+
+
+def test_a_warmed_model_nobody_takes_is_evicted_after_the_hold(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(model_registry.time, 'monotonic', lambda: now[0])
+    models = registry(5)
+    models.warm('a')
+    models.acquire('b')
+    models.release('b')
+    assert [entry['key'] for entry in models.stats()['entries']] == ['a']  # b went, a is still held
+
+    now[0] += model_registry.WARM_HOLD_SECONDS + 1
+    models.acquire('c')
+    assert [entry['key'] for entry in models.stats()['entries']] == ['c']
+
+
+def test_concurrent_loads_of_one_key_keep_the_first_model():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader(key):
+        started.set()
+        release.wait(5)
+        return object()
+
+    models = registry(100, slow_loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(models.acquire('a'))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results[0] is results[1]
+    assert models.stats()['entries'][0]['refcount'] == 2
+
+
+def test_uvr_engine_warm_keeps_an_oversized_model_for_prepare(make_server):
+    server = make_server(mock_realtime_factor=1000)
+    uvr = server.uvr
+    uvr.model_registry.memory_budget_bytes = -1  # Every model is too big for the cache on its own
+    loads = []
+    loader = uvr.model_registry.loader
+    uvr.model_registry.loader = lambda spec: loads.append(spec) or loader(spec)
+
+    uvr.warm({'model': 'htdemucs'})
+    uvr.prepare(Session(FakeWebSocket()), {'model': 'htdemucs'})
+    assert len(loads) == 1
+
+
+@pytest.mark.parametrize('aggressiveness', [[0.1], {'x': 1}, '0.1', True, float('nan'), float('inf')])
+def test_model_options_that_cannot_key_the_cache_are_rejected(aggressiveness):
+    with pytest.raises(ValueError, match='aggressiveness'):
+        resolve_model_spec({'model': 'UVR-MDX-NET-Inst_1', 'aggressiveness': aggressiveness})
+
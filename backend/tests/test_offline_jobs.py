@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+import pytest
+
+import offline_jobs
+from offline_jobs import JOB_CANCELLED, JOB_DONE, JOB_FAILED, OfflineJobManager, open_reader
+from uvr_models import ModelSpec
+
+SPEC = ModelSpec('Demucs', 'fake', (), 'cpu', 'eager', 'none')
+
+
+def write_wav(path, audio, sample_rate):
+    """[frames, channels] float audio as 16-bit PCM"""
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(audio.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((np.clip(audio, -1, 1) * 32767).astype('<i2').tobytes())
+
+
+def read_wav(path):
+    reader = open_reader(str(path))
+    try:
+        return reader.read(reader.frames), reader.sample_rate
+    finally:
+        reader.close()
+
+
+def tone(seconds, sample_rate, channels=2, frequency=440.0):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return np.stack([0.5 * np.sin(2 * np.pi * frequency * (1 + channel) * t) for channel in range(channels)],
+                    axis=1).astype(np.float32)
+
+
+class FakeModel:
+    """Splits a window into fixed fractions, like a separator whose stems add up to the input"""
+
+    def __init__(self, stems=('vocals', 'drums', 'bass', 'other')):
+        self.stems = stems
+        self.opened = []
+        self.closed = []
+        self.windows = []
+
+    def open(self, spec):
+        self.opened.append(spec)
+        return 'handle'
+
+    def separate(self, handle, audio, sample_rate):
+        self.windows.append(audio.shape)
+        shares = {'vocals': 0.5, 'drums': 0.25, 'bass': 0.25, 'other': 0.0, 'instrumental': 0.5}
+        return {name: audio * shares[name] for name in self.stems}
+
+    def close(self, handle):
+        self.closed.append(handle)
+
+
+@pytest.fixture
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(offline_jobs, 'JOBS_DIR', str(tmp_path / 'jobs'))
+    return tmp_path
+
+
+def run_job(manager, source, stems=None, output_dir=None):
+    job = manager.submit(str(source), SPEC, output_dir, stems)
+    deadline = time.monotonic() + 30
+    while job.status not in (JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return job
+
+
+def make_manager(model, **options):
+    return OfflineJobManager(model.open, model.separate, model.close, **options)
+
+
+def test_a_file_is_separated_window_by_window_into_one_wav_per_stem(jobs_dir):
+    model = FakeModel()
+    manager = make_manager(model, max_window_frames=44100)
+    audio = tone(3.3, 44100)
+    write_wav(jobs_dir / 'song.wav', audio, 44100)
+    job = run_job(manager, jobs_dir / 'song.wav')
+
+    assert job.status == JOB_DONE, job.error
+    assert set(job.outputs) == {'vocals', 'drums', 'bass', 'other'}
+    assert job.windows == len(model.windows) > 3 and set(model.windows) == {(2, 44100)}
+    assert model.closed == ['handle'] and job.done_frames == job.total_frames == len(audio)
+    vocals, rate = read_wav(job.outputs['vocals'])
+    assert rate == 44100 and vocals.shape == audio.shape
+    np.testing.assert_allclose(vocals, 0.5 * audio, atol=2e-4)
+    manager.shutdown()
+
+
+@pytest.mark.parametrize('produced', [('vocals', 'drums', 'bass', 'other'), ('vocals', 'instrumental')])
+def test_instrumental_is_derived_from_the_non_vocal_stems(jobs_dir, produced):
+    manager = make_manager(FakeModel(produced))
+    audio = tone(1.0, 44100)
+    write_wav(jobs_dir / 'song.wav', audio, 44100)
+    job = run_job(manager, jobs_dir / 'song.wav', stems=['instrumental', 'vocals'])
+
+    assert job.status == JOB_DONE, job.error
+    assert set(job.outputs) == {'instrumental', 'vocals'}
+    instrumental, _ = read_wav(job.outputs['instrumental'])
+    np.testing.assert_allclose(instrumental, 0.5 * audio, atol=2e-4)
+    manager.shutdown()
+
+
+def test_stems_the_model_cannot_give_fail_the_job(jobs_dir):
+    manager = make_manager(FakeModel(('vocals',)))
+    write_wav(jobs_dir / 'song.wav', tone(0.5, 44100), 44100)
+    job = run_job(manager, jobs_dir / 'song.wav', stems=['drums', 'instrumental'])
+    assert job.status == JOB_FAILED and 'none of the requested stems' in job.error
+    manager.shutdown()
+
+
+@pytest.mark.parametrize('file_rate', [48000, 22050])
+def test_resampled_stems_line_up_with_the_file(jobs_dir, file_rate):
+    manager = make_manager(FakeModel(), max_window_frames=44100)
+    audio = tone(2.0, file_rate, frequency=220.0)
+    write_wav(jobs_dir / 'song.wav', audio, file_rate)
+    job = run_job(manager, jobs_dir / 'song.wav', stems=['vocals'])
+
+    assert job.status == JOB_DONE, job.error
+    vocals, rate = read_wav(job.outputs['vocals'])
+    assert rate == file_rate and vocals.shape == audio.shape
+    # No delay left at the start, and the end of the file is flushed out of both filters
+    np.testing.assert_allclose(vocals[100:], 0.5 * audio[100:], atol=2e-3)
+    manager.shutdown()
+
+
+def test_a_cancelled_job_stops_between_windows(jobs_dir):
+    entered, release = threading.Event(), threading.Event()
+    model = FakeModel()
+    separate = model.separate
+
+    def blocking_separate(*args):
+        entered.set()
+        release.wait(10)
+        return separate(*args)
+
+    manager = OfflineJobManager(model.open, blocking_separate, model.close, max_window_frames=44100)
+    write_wav(jobs_dir / 'song.wav', tone(5.0, 44100), 44100)
+    job = manager.submit(str(jobs_dir / 'song.wav'), SPEC)
+    try:
+        assert entered.wait(10)
+        manager.cancel(job.id)
+    finally:
+        release.set()
+    deadline = time.monotonic() + 10
+    while job.status != JOB_CANCELLED:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert job.windows <= 1 and model.closed == ['handle']
+    manager.shutdown()
+
+
+def test_output_dirs_must_stay_inside_the_jobs_dir(jobs_dir):
+    manager = make_manager(FakeModel())
+    write_wav(jobs_dir / 'song.wav', tone(0.1, 44100), 44100)
+    for output_dir in ('../escape', str(jobs_dir), '.'):
+        with pytest.raises(ValueError):
+            manager.submit(str(jobs_dir / 'song.wav'), SPEC, output_dir)
+    with pytest.raises(FileNotFoundError):
+        manager.submit(str(jobs_dir / 'missing.wav'), SPEC)
+
+    job = run_job(manager, jobs_dir / 'song.wav', output_dir='mine')
+    assert job.output_dir == os.path.realpath(os.path.join(offline_jobs.JOBS_DIR, 'mine'))
+    manager.shutdown()
+
+
+def test_the_separate_route_runs_jobs_with_derived_stems(make_server, jobs_dir):
+    server = make_server(mock_realtime_factor=1000)
+    client = server.app.test_client()
+    audio = tone(1.0, 48000)
+    write_wav(jobs_dir / 'song.wav', audio, 48000)
+
+    response = client.post('/separate', json={'path': str(jobs_dir / 'song.wav'), 'stems': 'kazoo'})
+    assert response.status_code == 400 and 'kazoo' in response.get_json()['error']
+
+    response = client.post('/separate', json={'path': str(jobs_dir / 'song.wav'), 'stems': 'vocals,instrumental'})
+    assert response.status_code in (200, 202)
+    job = server.offline_jobs.get(response.get_json()['id'])
+    deadline = time.monotonic() + 30
+    while job.status not in (JOB_DONE, JOB_FAILED):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert job.status == JOB_DONE, job.error
+    vocals, _ = read_wav(job.outputs['vocals'])
+    instrumental, _ = read_wav(job.outputs['instrumental'])
+    # The mock's bands add up to the input
+    np.testing.assert_allclose(vocals + instrumental, audio, atol=5e-3)
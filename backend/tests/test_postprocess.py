@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from postprocess import StemPostProcessor
+
+
+def _constant(level, stems=1, channels=1, frames=1000):
+    return np.full((stems, channels, frames), level, dtype=np.float32)
+
+
+def test_quiet_stems_are_downmixed_and_interleaved_unchanged():
+    stacked = (np.random.default_rng(0).uniform(-0.5, 0.5, (3, 2, 100))).astype(np.float32)
+    mono = StemPostProcessor(44100).process(stacked)
+    assert mono.shape == (3, 100, 1)
+    np.testing.assert_allclose(mono[..., 0], stacked.mean(axis=1), rtol=1e-6)
+
+    stereo = StemPostProcessor(44100).process(stacked, keep_stereo=True)
+    assert stereo.shape == (3, 100, 2)
+    np.testing.assert_array_equal(stereo, stacked.transpose(0, 2, 1))
+
+
+def test_a_clipping_chunk_is_limited_from_its_first_frame():
+    processor = StemPostProcessor(44100)
+    stacked = _constant(0.5, stems=2)
+    stacked[0] *= 4  # Only the first stem clips
+    out = processor.process(stacked)
+
+    np.testing.assert_allclose(out[0], 0.98, rtol=1e-6)
+    np.testing.assert_allclose(out[1], 0.5, rtol=1e-6)
+    assert processor.limited_chunks == 1
+    np.testing.assert_allclose(processor.describe()['limiter_gain'], [0.49, 1.0], rtol=1e-6)
+
+
+def test_the_gain_recovers_smoothly_across_chunks():
+    processor = StemPostProcessor(1000, release_seconds=1.0)
+    processor.process(_constant(1.96))  # Gain 0.5
+    first = processor.process(_constant(0.5))[0, :, 0] / 0.5
+    second = processor.process(_constant(0.5))[0, :, 0] / 0.5
+
+    assert (np.diff(first) > 0).all() and (np.diff(second) > 0).all()
+    release = 1 - np.exp(-1.0)  # One 1000 frame chunk is one time constant
+    assert first[-1] == pytest.approx(0.5 + 0.5 * release, rel=1e-5)
+    assert 0 < second[0] - first[-1] <= first[-1] - first[-2]  # No step at the boundary, only a gentler slope
+    assert second[-1] < 1.0
+
+
+def test_output_dtypes():
+    stacked = _constant(0.5, channels=2, frames=10)
+    assert StemPostProcessor(44100, dtype='float16').process(stacked).dtype == np.float16
+    int16 = StemPostProcessor(44100, dtype='int16').process(stacked)
+    assert int16.dtype == np.int16 and (int16 == 16383).all()
+    with pytest.raises(ValueError):
+        StemPostProcessor(44100, dtype='int8')
+
+
+def test_output_buffers_are_reused_while_the_shape_stays():
+    processor = StemPostProcessor(44100)
+    out = processor.process(_constant(0.1, channels=2))
+    assert processor.process(_constant(0.2, channels=2)) is out
+    assert processor.process(_constant(0.2, channels=2, frames=500)) is not out
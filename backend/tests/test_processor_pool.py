@@ -0,0 +1,156 @@
+import threading
+
+import numpy as np
+import pytest
+
+from processor_pool import (DEFAULT_BLOCK_SECONDS, HANCE_STEMS, RESIDUAL_SCALE, HanceProcessorPool,
+                            block_seconds_from_name, build_routing, sample_rate_from_name)
+
+
+class FakeProcessor:
+    def __init__(self, engine, block_frames=None):
+        self.engine = engine
+        self.resets = 0
+        if block_frames is not None:
+            self.get_block_size = lambda: self.engine.measured(block_frames)
+            self.get_latency = lambda: 2 * block_frames
+
+    def get_number_of_output_buses(self):
+        return 2
+
+    def get_output_bus_name(self, bus):
+        return ['Vocals', 'Instrumental'][bus]
+
+    def set_output_bus_sensitivity(self, bus, value):
+        pass
+
+    def set_output_bus_volume(self, bus, value):
+        pass
+
+    def reset(self):
+        self.resets += 1
+
+
+class FakeEngine:
+    def __init__(self, block_frames=None):
+        self.block_frames = block_frames
+        self.measurements = 0
+        self.pool = None
+        self.lock_free = []
+
+    def measured(self, frames):
+        self.measurements += 1
+        # Another thread could take the pool's lock while the processor is being asked
+        lock = self.pool._lock
+        self.lock_free.append(lock.acquire(blocking=False))
+        if self.lock_free[-1]:
+            lock.release()
+        return frames
+
+    def create_processor(self, model_path, channels, sample_rate):
+        return FakeProcessor(self, self.block_frames)
+
+
+def make_pool(block_frames=None, **options):
+    engine = FakeEngine(block_frames)
+    pool = HanceProcessorPool(lambda: engine, **options)
+    engine.pool = pool
+    return pool, engine
+
+
+def test_idle_processors_are_reset_and_reused_per_stream_format():
+    pool, _ = make_pool(max_idle_per_key=1)
+    key, processor = pool.acquire('model.hance', 2, 44100)
+    pool.release(key, processor)
+    assert processor.resets == 1
+    assert pool.acquire('model.hance', 2, 44100)[1] is processor
+    assert pool.acquire('model.hance', 1, 44100)[1] is not processor
+
+    other_key, other = pool.acquire('model.hance', 2, 44100)
+    pool.release(key, processor)
+    pool.release(other_key, other)  # Over max_idle_per_key
+    stats = pool.stats()
+    assert (stats['created'], stats['reused'], stats['discarded'], stats['in_use']) == (3, 1, 1, 1)
+
+
+def test_timing_is_asked_of_the_processor_once_and_outside_the_lock():
+    pool, engine = make_pool(block_frames=4410)
+    timing = pool.timing('model.hance', 2, 44100)
+    assert timing == {'block_seconds': 0.1, 'latency_seconds': 0.2, 'source': 'processor'}
+
+    key, processor = pool.acquire('model.hance', 2, 48000)
+    pool.release(key, processor)
+    assert engine.measurements == 1
+    assert engine.lock_free == [True]
+
+
+def test_concurrent_first_acquires_keep_one_timing():
+    pool, engine = make_pool(block_frames=4410)
+    threads = [threading.Thread(target=pool.acquire, args=('model.hance', 2, 44100)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 1 <= engine.measurements <= 4
+    assert pool.timing('model.hance')['block_seconds'] == 0.1
+
+
+def test_routing_is_built_once_per_model_from_its_buses():
+    pool, _ = make_pool()
+    routing = pool.routing('model.hance')
+    assert pool.routing('model.hance', channels=1) is routing
+    np.testing.assert_array_equal(routing, build_routing(['Vocals', 'Instrumental']))
+    assert pool.bus_names('model.hance') == ['Vocals', 'Instrumental']
+
+
+@pytest.mark.parametrize('name, block, source', [
+    ('music-stem-separation-44.1kHz-209ms-large.hance', 0.209, 'file name'),
+    ('speech.hance', DEFAULT_BLOCK_SECONDS, 'default'),
+])
+def test_timing_without_the_processor_api_falls_back_to_the_name(name, block, source):
+    pool, _ = make_pool()
+    timing = pool.timing(name)
+    assert timing['block_seconds'] == block and timing['source'] == source
+
+
+def test_model_names_carry_block_length_and_rate():
+    assert block_seconds_from_name('music-stem-separation-44.1kHz-209ms-large.hance') == 0.209
+    assert block_seconds_from_name('speech.hance') is None
+    assert sample_rate_from_name('music-stem-separation-48kHz-209ms.hance') == 48000
+    assert sample_rate_from_name('speech.hance') == 44100
+
+
+def stem_column(routing, stem):
+    return routing[:, HANCE_STEMS.index(stem)]
+
+
+def test_routing_maps_buses_plus_mix_onto_every_stem():
+    routing = build_routing(['Vocals', 'Instrumental'])
+    assert routing.shape == (3, len(HANCE_STEMS))
+    assert routing.dtype == np.float32
+    np.testing.assert_array_equal(stem_column(routing, 'vocals'), [1, 0, 0])
+    np.testing.assert_array_equal(stem_column(routing, 'instrumental'), [0, 1, 0])
+
+
+def test_missing_vocal_bus_is_derived_from_the_instrumental_buses():
+    routing = build_routing(['Drums', 'Bass', 'Other'])
+    assert routing.shape == (4, len(HANCE_STEMS))
+    np.testing.assert_array_equal(stem_column(routing, 'drums'), [1, 0, 0, 0])
+    np.testing.assert_array_equal(stem_column(routing, 'bass'), [0, 1, 0, 0])
+    np.testing.assert_array_equal(stem_column(routing, 'instrumental'), [1, 1, 1, 0])
+    np.testing.assert_allclose(stem_column(routing, 'vocals'), [-RESIDUAL_SCALE] * 3 + [1.0])
+
+
+def test_model_without_buses_passes_the_mix_as_instrumental():
+    routing = build_routing([])
+    assert routing.shape == (1, len(HANCE_STEMS))
+    assert stem_column(routing, 'vocals')[0] == 0.0
+    assert stem_column(routing, 'instrumental')[0] == 1.0
+
+
+def test_routing_a_chunk_gives_every_stem_at_once():
+    routing = build_routing(['Vocals', 'Instrumental'])
+    chunk = np.random.default_rng(0).standard_normal((256, 3)).astype(np.float32)  # [frames, buses + mix]
+    stems = chunk @ routing
+    assert stems.shape == (256, len(HANCE_STEMS))
+    np.testing.assert_array_equal(stems[:, HANCE_STEMS.index('vocals')], chunk[:, 0])
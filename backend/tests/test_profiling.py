@@ -0,0 +1,81 @@
+import asyncio
+import os
+
+import pytest
+
+from helpers import configure, connect, drain, stereo
+from profiling import MAX_PROFILE_SECONDS, Profiler
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = Profiler('mock', directory=str(tmp_path))
+    yield profiler
+    profiler.stop()
+
+
+def test_calls_outside_a_window_run_unprofiled(profiler):
+    assert profiler.call(1, 'model', lambda x: x + 1, 1) == 2
+    assert profiler.runs() == []
+
+
+@pytest.mark.parametrize('session', [3, '3', ' 3'])
+def test_the_session_filter_matches_ids_sent_as_strings(profiler, session):
+    profiler.start(seconds=60, session_id=session)
+    assert profiler.call(3, 'model', sum, [1, 2]) == 3
+    profiler.call(4, 'model', sum, [1, 2])  # Another session is not profiled
+    run = profiler.stop()
+
+    assert run['session'] == 3 and run['id'].split('-')[2] == 'session3'
+    assert run['calls'] + run['skipped_calls'] == 1
+
+
+@pytest.mark.parametrize('options', [{'session_id': 'three'}, {'session_id': 2.5}, {'session_id': True},
+                                     {'session_id': [3]}, {'seconds': 0}, {'seconds': MAX_PROFILE_SECONDS + 1},
+                                     {'torch_trace': True}])
+def test_bad_options_are_refused_before_a_window_opens(profiler, options):
+    with pytest.raises(ValueError):
+        profiler.start(**dict(dict(seconds=60), **options))
+    assert profiler.active is None and profiler.runs() == []
+
+
+def test_one_window_at_a_time_and_its_files_afterwards(profiler):
+    profiler.start(seconds=60, model='htdemucs')
+    with pytest.raises(RuntimeError):
+        profiler.start(seconds=60)
+    profiler.call(1, 'htdemucs', sorted, [3, 1, 2])
+    profiler.call(1, 'other', sorted, [3, 1, 2])
+    run = profiler.stop()
+
+    assert run['state'] == 'done' and run['error'] is None and profiler.stop() is None
+    assert {'summary.txt', 'profile.json'} <= set(run['files'])
+    if run['calls']:
+        assert 'separation-session1-htdemucs.pstats' in run['files']
+    assert os.path.exists(profiler.artifact(run['id'], 'summary.txt'))
+    assert profiler.artifact(run['id'], '../profile.json') is None
+    assert profiler.artifact('nope', 'summary.txt') is None
+
+
+def test_the_profile_routes_filter_by_a_session_sent_as_a_string(make_server, tmp_path):
+    server = make_server()
+    server.profiler.directory = str(tmp_path)
+    client = server.app.test_client()
+
+    assert client.post('/profile/start', json={'session': 'abc'}).status_code == 400
+    assert client.post('/profile/stop').status_code == 404
+
+    async def scenario():
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        response = client.post('/profile/start', json={'seconds': 60, 'session': str(session.id)})
+        assert response.status_code == 202 and response.get_json()['session'] == session.id
+        assert client.post('/profile/start', json={'seconds': 60}).status_code == 409
+        await server.queue_audio_processing(session, stereo(44100), 44100, 2, 0)
+        await drain(session)
+        return session
+
+    session = asyncio.run(scenario())
+    run = client.post('/profile/stop').get_json()
+    assert run['calls'] + run['skipped_calls'] == session.stats['chunks_processed'] > 0
+    assert [listed['id'] for listed in client.get('/profile').get_json()] == [run['id']]
+    assert client.get(f"/profile/{run['id']}/summary.txt").status_code == 200
@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+import torch
+
+import quantization
+from quantization import QUANTIZE_DYNAMIC, QUANTIZE_NONE, normalize_quantize_option, quantize_model
+from uvr_models import ModelSpec
+
+
+class _Net(torch.nn.Module):
+    sources = ['vocals', 'other']
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.mix = torch.nn.Linear(2, 4)
+
+    def forward(self, x):
+        batch, channels, frames = x.shape
+        return self.mix(x.transpose(1, 2)).transpose(1, 2).reshape(batch, 2, channels, frames)
+
+
+class FakeModel:
+    def __init__(self):
+        self.model = _Net()
+
+    def predict(self, audio, sampling_rate=44100):
+        with torch.no_grad():
+            stems = self.model(torch.from_numpy(np.ascontiguousarray(audio, dtype=np.float32))[None])[0].numpy()
+        return dict(zip(self.model.sources, stems))
+
+
+SPEC = ModelSpec('Demucs', 'fake', (), 'cpu', 'eager', QUANTIZE_DYNAMIC)
+
+
+@pytest.fixture(autouse=True)
+def temp_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.parametrize('value, mode', [(None, QUANTIZE_NONE), (False, QUANTIZE_NONE), ('none', QUANTIZE_NONE),
+                                         (True, QUANTIZE_DYNAMIC), ('dynamic', QUANTIZE_DYNAMIC),
+                                         ('int8', QUANTIZE_DYNAMIC)])
+def test_quantize_options(value, mode):
+    assert normalize_quantize_option(value) == mode
+
+
+@pytest.mark.parametrize('value', ['static', 'fp16', 8])
+def test_unsupported_quantize_options_are_refused(value):
+    with pytest.raises(ValueError):
+        normalize_quantize_option(value)
+
+
+def test_linear_layers_are_quantized_and_measured_against_float():
+    model = FakeModel()
+    audio = np.random.default_rng(0).standard_normal((2, 1000)).astype(np.float32)
+    expected = model.predict(audio)
+
+    quantize_model(model, SPEC)
+    assert isinstance(model.model.mix, torch.ao.nn.quantized.dynamic.Linear)
+    report = model.quantization_report
+    assert report['mode'] == QUANTIZE_DYNAMIC and not report['cached']
+    assert set(report['sdr_db']) == {'vocals', 'other'} and report['mean_sdr_db'] > 20
+    for name, stem in model.predict(audio).items():
+        np.testing.assert_allclose(stem, expected[name], atol=0.05)
+
+
+def test_the_report_is_cached_but_the_network_is_quantized_on_every_load():
+    first = quantize_model(FakeModel(), SPEC).quantization_report
+    assert os.path.exists(quantization._report_path(SPEC))
+
+    model = quantize_model(FakeModel(), SPEC)
+    assert isinstance(model.model.mix, torch.ao.nn.quantized.dynamic.Linear)
+    assert model.quantization_report == dict(first, cached=True)
+
+
+def test_an_unreadable_report_is_measured_again():
+    with open(quantization._report_path(SPEC), 'w') as report_file:
+        report_file.write('{not json')
+    model = quantize_model(FakeModel(), SPEC)
+    assert model.quantization_report['cached'] is False
+    assert isinstance(model.model.mix, torch.ao.nn.quantized.dynamic.Linear)
+
+
+def test_models_without_a_torch_network_are_left_alone():
+    class PredictOnly:
+        def predict(self, audio, sampling_rate=44100):
+            return {'vocals': audio}
+
+    model = quantize_model(PredictOnly(), SPEC)
+    assert model.quantization_report['mode'] == QUANTIZE_NONE
+    assert 'no torch network' in model.quantization_report['fallback_reason']
@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+import pytest
+
+from resampler import StreamingResampler, delay_seconds, polyphase_bank
+
+
+def resample_in_chunks(resampler, audio, sizes):
+    pieces, start = [], 0
+    for size in sizes:
+        pieces.append(resampler.process(audio[..., start:start + size]))
+        start += size
+    pieces.append(resampler.process(audio[..., start:]))
+    return np.concatenate(pieces, axis=-1)
+
+
+@pytest.mark.parametrize('from_rate, to_rate', [(44100, 48000), (48000, 44100), (22050, 44100)])
+def test_chunked_output_matches_resampling_at_once(from_rate, to_rate):
+    audio = np.random.default_rng(0).standard_normal((2, 9000)).astype(np.float32)
+    whole = StreamingResampler(from_rate, to_rate).process(audio)
+    chunked = resample_in_chunks(StreamingResampler(from_rate, to_rate), audio, [1, 127, 1000, 3, 4096])
+
+    assert chunked.shape == whole.shape
+    np.testing.assert_allclose(chunked, whole, atol=1e-5)
+
+
+def direct_resample(audio, from_rate, to_rate):
+    """One output at a time straight from the filter bank, as a reference for the vectorised process()"""
+    resampler = StreamingResampler(from_rate, to_rate)
+    up, down, taps = resampler.up, resampler.down, resampler.taps
+    bank = polyphase_bank(up, down, taps)
+    padded = np.concatenate([np.zeros(taps - 1, dtype=np.float64), audio])
+    count = -(-len(audio) * up // down)
+    output = np.empty(count)
+    for index in range(count):
+        step = index * down
+        output[index] = padded[step // up:step // up + taps] @ bank[step % up, ::-1]
+    return output
+
+
+@pytest.mark.parametrize('from_rate, to_rate', [(44100, 48000), (48000, 44100), (8000, 44100), (96000, 44100)])
+def test_output_matches_the_filter_applied_one_frame_at_a_time(from_rate, to_rate):
+    audio = np.random.default_rng(2).standard_normal(3000).astype(np.float32)
+    expected = direct_resample(audio, from_rate, to_rate)
+    output = resample_in_chunks(StreamingResampler(from_rate, to_rate), audio, [7, 0, 500, 1])
+    np.testing.assert_allclose(output, expected, atol=1e-5)
+
+
+def test_output_length_follows_the_rate_ratio():
+    resampler = StreamingResampler(44100, 48000)
+    total = sum(resampler.process(np.zeros(441, dtype=np.float32)).shape[-1] for _ in range(100))
+    assert total == 48000
+
+
+def test_matching_rates_pass_audio_through():
+    resampler = StreamingResampler(48000, 48000)
+    audio = np.ones((2, 10), dtype=np.float32)
+    assert resampler.passthrough
+    assert resampler.process(audio) is audio
+    assert delay_seconds(48000, 48000) == 0.0
+
+
+def test_a_new_channel_layout_starts_the_filter_afresh():
+    audio = np.random.default_rng(1).standard_normal((1, 2000)).astype(np.float32)
+    resampler = StreamingResampler(44100, 48000)
+    resampler.process(np.ones((2, 500), dtype=np.float32))
+    np.testing.assert_allclose(resampler.process(audio), StreamingResampler(44100, 48000).process(audio), atol=1e-6)
+
+
+@pytest.mark.parametrize('from_rate, to_rate', [(44100, 48000), (48000, 44100)])
+def test_a_chunk_resamples_in_a_small_fraction_of_its_duration(from_rate, to_rate):
+    # The extension's 8192 frame chunk is 170-186 ms of audio; one matrix product takes well under a millisecond
+    resampler = StreamingResampler(from_rate, to_rate)
+    chunk = np.random.default_rng(3).standard_normal((2, 8192)).astype(np.float32)
+    timings = []
+    for _ in range(20):
+        started = time.perf_counter()
+        resampler.process(chunk)
+        timings.append(time.perf_counter() - started)
+    assert np.median(timings) < 0.01 * 8192 / from_rate
@@ -0,0 +1,82 @@
+import numpy as np
+
+from helpers import FakeWebSocket
+from ring_buffer import AudioRingBuffer
+from session import Session
+
+
+def frames(start, count, channels=2):
+    """Interleaved samples whose value is the frame index"""
+    return np.repeat(np.arange(start, start + count, dtype=np.float32), channels)
+
+
+def test_window_across_the_wrap_is_a_contiguous_view():
+    ring = AudioRingBuffer(8, channels=2)
+    ring.write(frames(0, 6))
+    ring.read_window(6)
+    ring.release(6)
+
+    assert ring.write(frames(6, 5)) == 5  # Frames 8-10 land at the start of the storage
+    window = ring.read_window(5)
+    assert window.shape == (5, 2)
+    assert window.base is not None  # A view, not a copy
+    np.testing.assert_array_equal(window[:, 0], np.arange(6, 11))
+    np.testing.assert_array_equal(window[:, 1], np.arange(6, 11))
+
+
+def test_overlapping_windows_advance_by_the_hop():
+    ring = AudioRingBuffer(16, channels=1)
+    ring.write(frames(0, 10, channels=1))
+    first = ring.read_window(6, advance=4)
+    second = ring.read_window(6, advance=4)
+    np.testing.assert_array_equal(first[:, 0], np.arange(0, 6))
+    np.testing.assert_array_equal(second[:, 0], np.arange(4, 10))
+    assert ring.read_window(6, advance=4) is None
+    assert ring.readable == 2
+
+
+def test_overflow_drops_and_counts_frames_that_do_not_fit():
+    ring = AudioRingBuffer(4, channels=2)
+    assert ring.write(frames(0, 3)) == 3
+    assert ring.write(frames(3, 3)) == 1
+    assert ring.overflow_count == 1
+    assert ring.overflow_frames == 2
+    assert ring.free == 0
+    assert ring.high_water_mark == 4
+
+    np.testing.assert_array_equal(ring.read_window(4)[:, 0], np.arange(4))
+
+
+def test_unreleased_windows_are_not_overwritten():
+    ring = AudioRingBuffer(4, channels=1)
+    ring.write(frames(0, 4, channels=1))
+    window = ring.read_window(4)
+    assert ring.write(frames(4, 2, channels=1)) == 0  # Handed out but not released: still in use
+    assert ring.overflow_frames == 2
+
+    ring.release(2)
+    assert ring.write(frames(4, 2, channels=1)) == 2
+    np.testing.assert_array_equal(window[2:, 0], [2, 3])
+
+
+def test_reset_clears_cursors_and_counters():
+    ring = AudioRingBuffer(2, channels=1)
+    ring.write(frames(0, 5, channels=1))
+    ring.reset()
+    assert ring.stats() == {
+        'capacity_frames': 2,
+        'channels': 1,
+        'readable_frames': 0,
+        'used_frames': 0,
+        'high_water_mark': 0,
+        'overflow_count': 0,
+        'overflow_frames': 0,
+    }
+
+
+def test_a_sessions_ring_buffer_is_reallocated_when_the_format_changes():
+    session = Session(FakeWebSocket())
+    ring = session.ensure_ring_buffer(2, 1000)
+    assert session.ensure_ring_buffer(2, 1000) is ring
+    assert session.ensure_ring_buffer(1, 1000) is not ring
+    assert session.ring_buffer.channels == 1
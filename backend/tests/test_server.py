@@ -0,0 +1,135 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from helpers import configure, connect, drain, stereo
+
+
+def _mix_audio(session):
+    messages = session.websocket.json_messages('separated_audio')
+    assert {message['stem'] for message in messages} <= {'mix'}
+    return np.concatenate([np.asarray(message['data'], dtype=np.float32) for message in messages])
+
+
+async def _drop_every_window(server, session, fallback):
+    await configure(server, session, drop_fallback=fallback)
+    session.separation_seconds = 10.0  # Far longer than the latency budget
+    audio = stereo(44100)
+    await server.queue_audio_processing(session, audio, 44100, 2, 0)
+    await drain(session)
+    assert session.window_index > 0
+    assert session.stats['dropped_chunks'] == session.window_index
+    assert session.stats['chunks_processed'] == 0
+    return audio.reshape(-1, 2).mean(axis=1)
+
+
+def test_dropped_windows_send_their_own_audio_as_the_mix(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        mono = await _drop_every_window(server, session, 'mix')
+
+        mix = _mix_audio(session)
+        assert len(mix) == session.window_index * session.stream.hop_frames
+        np.testing.assert_allclose(mix, mono[:len(mix)], atol=1e-6)
+
+    asyncio.run(scenario())
+
+
+def test_dropped_windows_can_send_silence_or_nothing(make_server):
+    async def scenario():
+        server = make_server()
+        silent, quiet = connect(server), connect(server)
+        await _drop_every_window(server, silent, 'silence')
+        await _drop_every_window(server, quiet, 'none')
+
+        mix = _mix_audio(silent)
+        assert len(mix) == silent.window_index * silent.stream.hop_frames and not mix.any()
+        assert quiet.websocket.json_messages('separated_audio') == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('fallback', ['mix', 'silence', 'none'])
+def test_audio_sent_while_the_first_model_loads_passes_through(make_server, fallback):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await server.configure_model(session, {'engine': 'mock', 'realtime_factor': 0, 'drop_fallback': fallback})
+        assert session.is_loading and session.chunking is None
+
+        audio = stereo(1000)
+        await server.queue_audio_processing(session, audio, 44100, 2, 0)
+        assert session.stats['chunks_received'] == session.stats['dropped_chunks'] == 1
+        if fallback == 'none':
+            assert session.websocket.json_messages('separated_audio') == []
+        else:
+            expected = audio.reshape(-1, 2).mean(axis=1) if fallback == 'mix' else np.zeros(1000)
+            np.testing.assert_allclose(_mix_audio(session), expected, atol=1e-6)
+        await session.loading_task
+
+    asyncio.run(scenario())
+
+
+def test_audio_without_a_model_is_an_error(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await server.queue_audio_processing(session, stereo(1000), 44100, 2, 0)
+        assert session.websocket.json_messages('error')[0]['error'] == 'No model loaded/configured'
+
+    asyncio.run(scenario())
+
+
+def test_the_default_latency_budget_covers_a_chunk(make_server):
+    async def scenario():
+        server = make_server(mock_realtime_factor=1000)
+        mock, uvr, custom = connect(server), connect(server), connect(server)
+        await configure(server, mock)
+        await configure(server, uvr, engine='uvr', model='htdemucs')
+        await configure(server, custom, latency_budget_ms=2500)
+
+        assert server.latency_budget_seconds(mock) == 0.5  # One 500 ms window, over the 300 ms floor
+        assert server.latency_budget_seconds(uvr) == 1.0
+        assert server.latency_budget_seconds(custom) == 2.5
+
+    asyncio.run(scenario())
+
+
+def test_remix_output_mixes_the_stems_with_their_gains(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        session.set_output('remix')
+        session.set_gains({'vocals': 0.5, 'instrumental': 0.5})
+
+        audio = stereo(44100)
+        await server.queue_audio_processing(session, audio, 44100, 2, 0)
+        await drain(session)
+
+        messages = session.websocket.json_messages('separated_audio')
+        assert messages and {(message['stem'], message['channels']) for message in messages} == {('remix', 2)}
+        remix = np.concatenate([message['data'] for message in messages]).reshape(-1, 2)
+        # The mock's stems add up to the input, so equal gains scale it
+        np.testing.assert_allclose(remix, 0.5 * audio.reshape(-1, 2)[:len(remix)], atol=1e-5)
+
+    asyncio.run(scenario())
+
+
+def test_loud_input_is_limited_below_full_scale(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        await server.queue_audio_processing(session, stereo(44100) * 40, 44100, 2, 0)
+        await drain(session)
+
+        messages = session.websocket.json_messages('separated_audio')
+        assert messages and session.stats['dropped_chunks'] == 0
+        peak = max(np.abs(message['data']).max() for message in messages)
+        assert 0.5 < peak <= 0.98 + 1e-6
+        assert session.postprocessor.describe()['limited_chunks'] == session.stats['chunks_processed']
+
+    asyncio.run(scenario())
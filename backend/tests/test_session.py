@@ -0,0 +1,160 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+import session as session_module
+from helpers import FakeWebSocket, configure, connect, stereo
+from session import Session
+
+
+def test_queue_is_full_at_its_limit():
+    session = Session(FakeWebSocket(), max_queue=2)
+    session.processing_queue.put_nowait('first')
+    assert not session.queue_full
+    session.processing_queue.put_nowait('second')
+    assert session.queue_full
+
+    session.queue_limit = 3  # Raised for a carried backlog
+    assert not session.queue_full
+
+
+def test_a_zero_limit_leaves_the_queue_unbounded():
+    session = Session(FakeWebSocket(), max_queue=0)
+    for index in range(100):
+        session.processing_queue.put_nowait(index)
+    assert not session.queue_full
+
+
+def test_deadlines_follow_the_least_delayed_client_clock_estimate(monkeypatch):
+    session = Session(FakeWebSocket())
+    now = [100.0]
+    monkeypatch.setattr(session_module.time, 'monotonic', lambda: now[0])
+
+    assert session.deadline_for(50_000.0, 1.0) == 101.0  # Server clock runs 50 s ahead
+    now[0] = 101.5
+    assert session.deadline_for(51_000.0, 1.0) == 102.0  # Arrived 0.5 s late: the estimate keeps 50 s
+    assert session.deadline_for(0, 0.25) == 101.75  # Unstamped chunks get the budget from now
+
+
+def test_a_full_queue_drops_its_oldest_window_for_the_newest(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        # 5 s at once: far more windows than the queue holds, cut before processing gets a turn
+        await server.queue_audio_processing(session, stereo(5 * 44100), 44100, 2, 0)
+
+        queued = list(session.processing_queue._queue)
+        windows = session.window_index
+        assert len(queued) == session.max_queue
+        assert [item['window'] for item in queued] == list(range(windows - session.max_queue, windows))
+        assert session.stats['dropped_chunks'] == windows - session.max_queue
+        assert session.websocket.stems().count('mix') == windows - session.max_queue
+        # The dropped windows' hops are released along with the windows that replaced them
+        assert sum(item['release_frames'] for item in queued) == windows * queued[0]['hop_frames']
+
+        await session.processing_task
+        ring = session.ring_buffer
+        assert ring.used == ring.readable  # Every handed-out window was released
+        assert session.stats['chunks_processed'] == session.max_queue
+
+    asyncio.run(scenario())
+
+
+def test_windows_that_cannot_make_their_deadline_are_dropped(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session)
+        session.separation_seconds = 10.0  # Each window is expected to take far longer than the budget
+        await server.queue_audio_processing(session, stereo(44100), 44100, 2, 0)
+        windows = session.window_index
+        await session.processing_task
+
+        assert windows > 0
+        assert session.stats['dropped_chunks'] == windows
+        assert session.stats['chunks_processed'] == 0
+        assert set(session.websocket.stems()) == {'mix'}
+
+    asyncio.run(scenario())
+
+
+def test_close_waits_for_the_running_separation_call(make_server, monkeypatch):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+
+        # The model call blocks on an executor thread until released
+        entered, release = threading.Event(), threading.Event()
+        separate = server.engines['mock'].separate
+
+        def blocking_separate(*args):
+            entered.set()
+            release.wait(10)
+            return separate(*args)
+        monkeypatch.setattr(server.engines['mock'], 'separate', blocking_separate)
+
+        try:
+            await server.queue_audio_processing(session, stereo(44100), 44100, 2, 0)
+            await asyncio.get_running_loop().run_in_executor(None, entered.wait, 10)
+            assert not session.processing_queue.empty()
+
+            closing = asyncio.ensure_future(session.close())
+            await asyncio.sleep(0.05)
+            assert not closing.done()
+        finally:
+            release.set()
+        await closing
+        assert session.inflight is None
+        assert session.processing_queue.empty()
+        assert session.ring_buffer is None and session.stream is None
+
+    asyncio.run(scenario())
+
+
+def test_cut_over_carries_audio_no_window_has_reached(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session)
+        first = stereo(10000)
+        await server.queue_audio_processing(session, first, 44100, 2, 0)
+        assert session.window_index == 0
+
+        await configure(server, session, realtime_factor=1000)  # Idle session: cut over at once
+        assert session.ring_buffer is None
+        np.testing.assert_array_equal(session.carried_frames, first.reshape(-1, 2))
+
+        second = stereo(20000, seed=1)
+        await server.queue_audio_processing(session, second, 44100, 2, 0)
+        assert session.carried_frames is None
+        item = session.processing_queue._queue[0]
+        stream = item['stream']
+        expected = np.concatenate([first, second]).reshape(-1, 2)[:stream.hop_frames]
+        np.testing.assert_array_equal(item['audio_data'][stream.left_context:stream.left_context + stream.hop_frames],
+                                      expected)
+        await session.processing_task
+
+    asyncio.run(scenario())
+
+
+def test_gains_weight_the_stems_the_model_produced():
+    session = Session(FakeWebSocket())
+    session.set_gains({'vocals': 0.5, 'instrumental': 0.25, 'drums': 2})
+    np.testing.assert_array_equal(session.remix_weights(['bass', 'vocals', 'other', 'drums']), [0.25, 0.5, 0.25, 2.0])
+
+    session.set_gains({'vocals': 0})  # Updates, and the cached weights with it
+    np.testing.assert_array_equal(session.remix_weights(['bass', 'vocals', 'other', 'drums']), [0.25, 0.0, 0.25, 2.0])
+
+
+@pytest.mark.parametrize('gains', [{'vocals': True}, {'vocals': float('nan')}, {'vocals': float('inf')},
+                                   {'vocals': -1}, {'vocals': '1'}, {'remix': 1}, {'kazoo': 1}, [1]])
+def test_gains_must_be_finite_non_negative_numbers_for_known_stems(gains):
+    session = Session(FakeWebSocket())
+    session.set_gains({'vocals': 0.5})
+    with pytest.raises(ValueError):
+        session.set_gains(gains)
+    assert session.gains == {'vocals': 0.5}
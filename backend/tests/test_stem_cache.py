@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import numpy as np
+
+from helpers import configure, connect, drain, stereo
+from stem_cache import StemCache
+
+SPEC = ('Demucs', 'htdemucs')
+
+
+def window(seed, frames=1000):
+    return (np.random.default_rng(seed).standard_normal((2, frames)) * 0.1).astype(np.float32)
+
+
+def stems_for(audio):
+    return {'vocals': audio * 0.5, 'other': audio * 0.25}
+
+
+def test_miss_then_hit(tmp_path):
+    cache = StemCache(10 * 1024 ** 2, directory=str(tmp_path))
+    audio = window(0)
+    key = StemCache.key(audio, 44100, SPEC)
+
+    assert cache.get(key) is None
+    cache.put(key, stems_for(audio), separation_seconds=0.5)
+    hit = cache.get(key)
+
+    assert list(hit) == ['vocals', 'other']
+    np.testing.assert_array_equal(hit['vocals'], audio * 0.5)
+    stats = cache.stats()
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+    assert stats['entries'] == 1
+    assert cache.seconds_saved == 0.5
+
+
+def test_key_ignores_noise_below_the_hash_resolution():
+    audio = window(0)
+    assert StemCache.key(audio + 1e-7, 44100, SPEC) == StemCache.key(audio, 44100, SPEC)
+    assert StemCache.key(audio + 1e-2, 44100, SPEC) != StemCache.key(audio, 44100, SPEC)
+
+
+def test_key_separates_models_and_rates():
+    audio = window(0)
+    key = StemCache.key(audio, 44100, SPEC)
+    assert StemCache.key(audio, 48000, SPEC) != key
+    assert StemCache.key(audio, 44100, ('Demucs', 'hdemucs_mmi')) != key
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    audio = [window(seed) for seed in range(3)]
+    keys = [StemCache.key(a, 44100, SPEC) for a in audio]
+    entry_bytes = 2 * audio[0].nbytes
+    cache = StemCache(int(2.5 * entry_bytes), directory=str(tmp_path))
+
+    cache.put(keys[0], stems_for(audio[0]))
+    cache.put(keys[1], stems_for(audio[1]))
+    assert cache.get(keys[0]) is not None  # Now the most recently used
+    cache.put(keys[2], stems_for(audio[2]))
+
+    assert cache.evictions == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+
+
+def test_entries_survive_reopening(tmp_path):
+    audio = window(0)
+    key = StemCache.key(audio, 44100, SPEC)
+    StemCache(10 * 1024 ** 2, directory=str(tmp_path)).put(key, stems_for(audio))
+
+    reopened = StemCache(10 * 1024 ** 2, directory=str(tmp_path))
+    np.testing.assert_array_equal(reopened.get(key)['other'], audio * 0.25)
+
+
+def test_an_unreadable_entry_is_dropped_as_a_miss(tmp_path):
+    audio = window(0)
+    key = StemCache.key(audio, 44100, SPEC)
+    cache = StemCache(10 * 1024 ** 2, directory=str(tmp_path))
+    cache.put(key, stems_for(audio))
+    with open(tmp_path / (key + '.json'), 'w') as meta_file:
+        meta_file.write('{not json')
+
+    assert cache.get(key) is None
+    assert cache.stats()['entries'] == 0 and cache.misses == 1
+    assert not (tmp_path / (key + '.npy')).exists()
+
+
+def test_replayed_audio_is_served_from_the_cache(make_server, tmp_path):
+    async def scenario():
+        server = make_server(stem_cache_bytes=100 * 1024 ** 2, stem_cache_dir=str(tmp_path))
+        audio = stereo(3 * 44100)
+        received = []
+        for _ in range(2):
+            session = connect(server)
+            await configure(server, session, latency_budget_ms=60000)
+            await server.queue_audio_processing(session, audio, 44100, 2, 0)
+            await drain(session)
+            received.append(session.websocket.json_messages('separated_audio'))
+            # Stores are written in the background
+            deadline = time.monotonic() + 10
+            while server.stem_cache.stores < session.stats['chunks_processed']:
+                assert time.monotonic() < deadline
+                await asyncio.sleep(0.01)
+
+        stats = server.stem_cache.stats()
+        assert stats['hits'] == stats['stores'] > 0 and stats['misses'] == stats['stores']
+        assert [message['stem'] for message in received[1]] == [message['stem'] for message in received[0]]
+        for first, replay in zip(*received):
+            np.testing.assert_array_equal(replay['data'], first['data'])
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from helpers import configure, connect, drain, stereo
+from streaming import OverlapAddStream
+
+
+def windows_over(signal, stream):
+    """Model windows the server cuts: left_context frames of silence are primed ahead of the audio"""
+    padded = np.concatenate([np.zeros(signal.shape[:-1] + (stream.left_context,), dtype=np.float32), signal], axis=-1)
+    start = 0
+    while start + stream.window_frames <= padded.shape[-1]:
+        yield padded[..., start:start + stream.window_frames]
+        start += stream.hop_frames
+
+
+def test_identity_windows_reconstruct_the_input():
+    stream = OverlapAddStream(1000, hop_frames=100, left_context=20, right_context=20)
+    signal = np.random.default_rng(0).standard_normal((2, 1500)).astype(np.float32)
+
+    output = np.concatenate([stream.process(window) for window in windows_over(signal, stream)], axis=-1)
+    assert stream.windows_processed == len(range(0, 1500 + 20 - stream.window_frames + 1, 100))
+    np.testing.assert_allclose(output, signal[..., :output.shape[-1]], atol=1e-6)
+
+
+def test_crossfade_is_amplitude_complementary():
+    stream = OverlapAddStream.from_seconds(44100, window_seconds=1.0, context_seconds=0.125)
+    np.testing.assert_allclose(stream._fade_in + stream._fade_out, 1.0)
+    assert stream.crossfade == stream.right_context
+
+
+def test_latency_is_the_hop_plus_the_right_context():
+    stream = OverlapAddStream.from_seconds(48000, window_seconds=1.0, context_seconds=0.125)
+    assert stream.hop_frames == 36000
+    assert stream.latency_frames == 36000 + 6000
+    assert stream.latency_ms == 875.0
+    assert stream.describe()['latency_ms'] == 875.0
+
+
+def test_short_model_output_is_zero_padded():
+    stream = OverlapAddStream(1000, hop_frames=100, left_context=20, right_context=20, crossfade=0)
+    emitted = stream.process(np.ones((1, 60), dtype=np.float32))
+    assert emitted.shape == (1, 100)
+    np.testing.assert_array_equal(emitted[0, :40], 1.0)
+    np.testing.assert_array_equal(emitted[0, 40:], 0.0)
+
+
+def test_streamed_stems_add_back_up_to_the_input(make_server):
+    async def scenario():
+        server = make_server()
+        session = connect(server)
+        await configure(server, session, latency_budget_ms=60000)
+        samples = stereo(2 * 44100)
+        for chunk in np.split(samples, 8):
+            await server.queue_audio_processing(session, chunk, 44100, 2, 0)
+            await drain(session)
+
+        stems = {}
+        for message in session.websocket.json_messages('separated_audio'):
+            stems.setdefault(message['stem'], []).extend(message['data'])
+        assert set(stems) == set(server.engines['mock'].stems)
+        total = np.sum([np.array(stem, dtype=np.float32) for stem in stems.values()], axis=0)
+        # Mock bands sum back to their window, so the stitched stems must give back the (downmixed) input
+        mono = samples.reshape(-1, 2).mean(axis=1)
+        np.testing.assert_allclose(total, mono[:len(total)], atol=1e-5)
+        assert len(total) == session.window_index * session.stream.hop_frames
+
+    asyncio.run(scenario())
+
+
+def test_latency_plan_counts_the_hop_and_right_context(make_server):
+    server = make_server()
+    mock = server.engines['mock']
+    plan = server.plan_chunking(mock, 'mock', {}, 44100)
+    assert plan['chunk_ms'] == 500.0
+    assert plan['buffering_ms'] == 450.0  # 400 ms hop + 50 ms right context
+    assert plan['resampler_ms'] == 0.0
+    assert plan['latency_ms'] == 450.0
+
+    unstreamed = server.plan_chunking(mock, 'mock', {'streaming': False}, 44100)
+    assert unstreamed['buffering_ms'] == unstreamed['latency_ms'] == 500.0
+
+    uvr = server.plan_chunking(server.uvr, 'hdemucs_mmi', {}, 44100)
+    assert uvr['latency_ms'] == 875.0
+
+
+def test_latency_plan_adds_both_resampler_delays(make_server):
+    server = make_server()
+    plan = server.plan_chunking(server.engines['mock'], 'mock', {}, 48000)
+    expected = 1000.0 * (16 / 48000 + 16 / 44100)
+    assert plan['resampler_ms'] == pytest.approx(expected, abs=1e-3)
+    assert plan['latency_ms'] == pytest.approx(450.0 + expected, abs=1e-3)
+    assert server.plan_chunking(server.engines['mock'], 'mock', {'resample': False}, 48000)['resampler_ms'] == 0.0
+
+    # A client that turns out to send at another rate gets the plan redone
+    replanned = server.plan_latency(plan, 44100)
+    assert replanned['client_rate'] == 44100
+    assert replanned['latency_ms'] == 450.0
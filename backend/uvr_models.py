@@ -0,0 +1,295 @@
+"""
+Ultimate Vocal Remover model selection and loading
+"""
+
+import logging
+import math
+import os
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Add ultimatevocalremover_api to path
+PROJECT_ROOT = Path(__file__).parent.parent
+UVR_API_PATH = PROJECT_ROOT / "ultimatevocalremover_api"
+if str(UVR_API_PATH) not in sys.path:
+    sys.path.insert(0, str(UVR_API_PATH))
+
+UVR_SRC_PATH = UVR_API_PATH / "src"
+if str(UVR_SRC_PATH) not in sys.path:
+    sys.path.insert(0, str(UVR_SRC_PATH))
+
+try:
+    from models import Demucs, VrNetwork, MDX, MDXC
+except ImportError:
+    Demucs = VrNetwork = MDX = MDXC = None  # ultimatevocalremover_api missing: only the mock model loads
+
+from accelerated import BACKEND_EAGER, BACKENDS, PARITY_TOLERANCE, AcceleratedModel
+from mock_engine import MockSeparator
+from quantization import QUANTIZE_NONE, normalize_quantize_option, quantize_model
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'hdemucs_mmi'
+
+MODEL_CLASSES = {
+    'Demucs': Demucs,
+    'VrNetwork': VrNetwork,
+    'MDX': MDX,
+    'MDXC': MDXC,
+    'Mock': MockSeparator,
+}
+
+# Everything that determines the weights and behaviour of a loaded model.
+# metadata is a sorted tuple of (key, value) pairs so specs are hashable cache keys.
+ModelSpec = namedtuple('ModelSpec', ['model_class', 'name', 'metadata', 'device', 'backend', 'quantize'],
+                       defaults=(BACKEND_EAGER, QUANTIZE_NONE))
+
+
+def resolve_model_spec(config_data, device='cpu', offline=False, mock_realtime_factor=None):
+    """Map a configure payload onto the model class, name and metadata to load.
+
+    offline=True selects full-quality settings for whole-file jobs instead of
+    the small real-time segments. With mock_realtime_factor every model name
+    resolves to the mock separator running at that speed (see mock_engine.py).
+    """
+    model_name = config_data.get('model', DEFAULT_MODEL)
+    if mock_realtime_factor is not None:
+        return ModelSpec('Mock', model_name, (('realtime_factor', float(mock_realtime_factor)),), device)
+    backend = config_data.get('backend', BACKEND_EAGER)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    quantize = normalize_quantize_option(config_data.get('quantize'))
+    # Goes into the spec, which keys the model caches, so it has to be a plain (hashable) number
+    aggressiveness = config_data.get('aggressiveness', 0.05)
+    if (isinstance(aggressiveness, bool) or not isinstance(aggressiveness, (int, float))
+            or not math.isfinite(aggressiveness)):
+        raise ValueError(f"aggressiveness must be a number, got {aggressiveness!r}")
+
+    # Optimized metadata for memory efficiency (device is passed separately)
+    demucs_metadata = {
+        'segment': 1,  # Very small segment
+        'split': True,
+        'overlap': 0.05,  # Minimal overlap
+        'shifts': 0      # No shifts
+    }
+
+    # VR/MDX metadata with memory optimizations
+    vr_mdx_metadata = {
+        'aggressiveness': aggressiveness,
+        'batch_size': 1
+    }
+
+    if offline:
+        # Whole files are not latency bound: the model's own segment length, more overlap and a shift
+        demucs_metadata = {'segment': None, 'split': True, 'overlap': 0.25, 'shifts': 1}
+
+    if 'demucs' in model_name.lower():
+        model_class, metadata = 'Demucs', demucs_metadata
+    elif model_name.startswith('UVR') or 'MDX' in model_name:
+        if 'MDX' in model_name:
+            model_class, metadata = 'MDX', vr_mdx_metadata
+        else:
+            model_class, metadata = 'VrNetwork', vr_mdx_metadata
+    else:
+        logger.warning(f"Model type for '{model_name}' not explicitly handled, attempting generic load with {DEFAULT_MODEL}.")
+        model_class, model_name, metadata = 'Demucs', DEFAULT_MODEL, demucs_metadata
+
+    return ModelSpec(model_class, model_name, tuple(sorted(metadata.items())), device, backend, quantize)
+
+
+def load_uvr_model(spec):
+    """Construct the model described by a ModelSpec (blocking: loads weights from disk)"""
+    # Force CPU-only operation with environment variable
+    if spec.device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''  # Disable CUDA
+        os.environ['PYTORCH_MPS_HIGH_WATERMARK_RATIO'] = '0.0'  # Disable MPS limits
+
+    logger.info(f"Loading {spec.model_class} model: {spec.name} on {spec.device}")
+    if MODEL_CLASSES[spec.model_class] is None:
+        raise RuntimeError(f"Cannot load {spec.model_class} models: ultimatevocalremover_api is not installed "
+                           f"(run the server with --mock-engine to benchmark without it)")
+    model = MODEL_CLASSES[spec.model_class](name=spec.name, other_metadata=dict(spec.metadata), device=spec.device)
+
+    # Move model to CPU explicitly if it's not already
+    if spec.device == 'cpu' and hasattr(model, 'model') and hasattr(model.model, 'cpu'):
+        model.model = model.model.cpu()
+
+    if spec.quantize != QUANTIZE_NONE:
+        # Measures speed and quality against the float model; cached on disk per spec
+        model = quantize_model(model, spec)
+
+    if spec.backend != BACKEND_EAGER:
+        # Falls back to the eager model internally if export or the parity check fails
+        model = AcceleratedModel(model, spec)
+    return model
+
+
+def describe_model(model):
+    """Backend and quantization reports for a loaded model, for status messages"""
+    return {
+        'backend': getattr(model, 'report', None) or {'backend': BACKEND_EAGER},
+        'quantization': getattr(model, 'quantization_report', None),
+        'batching': getattr(model, 'batch_report', None),
+    }
+
+
+def estimate_model_bytes(model):
+    """Bytes held by the model's torch weights and buffers (0 if it exposes no torch module)"""
+    module = getattr(model, 'model', None)
+    if module is None or not hasattr(module, 'state_dict'):
+        return 0
+
+    # state_dict rather than parameters(): quantized layers keep their weights as packed params
+    def tensor_bytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(item) for item in value)
+        return 0
+    return sum(tensor_bytes(value) for value in module.state_dict().values())
+
+
+def separate_chunk(model, audio_input_np, sr, memory_manager=None, max_seconds=1.0):
+    """Run the actual separation (blocking operation) and return a dict of stems.
+
+    Audio longer than max_seconds is truncated (None for no cap). With a memory_manager the float32 input is copied into a reused scratch
+    buffer instead of a fresh array, and memory is checked (not collected)
+    after the chunk. The stems predict() returns are allocated by the model
+    on every call.
+    """
+    try:
+        logger.info(f"Running separation on audio shape: {audio_input_np.shape}, SR: {sr}")
+
+        if not isinstance(audio_input_np, np.ndarray):
+            audio_input_np = np.array(audio_input_np)
+
+        # Further reduce audio length for memory safety
+        max_samples = int(sr * max_seconds) if max_seconds is not None else None
+        if max_samples is not None and audio_input_np.shape[-1] > max_samples:
+            logger.warning(f"Truncating audio from {audio_input_np.shape[-1]} to {max_samples} samples")
+            audio_input_np = audio_input_np[..., :max_samples]
+
+        # The model needs contiguous float32; ring buffer views usually are neither
+        if memory_manager is not None:
+            model_input = memory_manager.workspace('chunk_input', audio_input_np.shape)
+            np.copyto(model_input, audio_input_np)
+        else:
+            model_input = np.ascontiguousarray(audio_input_np, dtype=np.float32)
+
+        # Run separation with explicit CPU mode
+        with torch.no_grad():  # Disable gradient computation to save memory
+            separated_output = model.predict(model_input, sampling_rate=sr)
+
+        if not isinstance(separated_output, dict):
+            logger.error(f"Model prediction did not return a dict. Got: {type(separated_output)}")
+            if isinstance(separated_output, (list, tuple)) and all(isinstance(arr, np.ndarray) for arr in separated_output):
+                stems = ['vocals', 'drums', 'bass', 'other']
+                separated_output = {stems[i]: separated_output[i] for i in range(min(len(stems), len(separated_output)))}
+            else:
+                raise ValueError("Model output format not recognized as a dictionary of stems.")
+
+        logger.info(f"Separation successful. Got stems: {list(separated_output.keys())}")
+        return separated_output
+
+    except Exception as e:
+        logger.error(f"Model separation error in separate_chunk: {e}", exc_info=True)
+        raise
+
+    finally:
+        if memory_manager is not None:
+            memory_manager.check()
+
+
+def _batchable_module(model):
+    """The model's torch module if a whole batch can go through one forward pass, else None"""
+    if getattr(model, 'backend', BACKEND_EAGER) != BACKEND_EAGER:
+        return None  # Exported graphs are specialised to a batch of one
+    module = getattr(model, 'model', None)
+    if not isinstance(module, torch.nn.Module) or not hasattr(module, 'sources'):
+        return None
+    if hasattr(module, 'models'):
+        return None  # Bags of models only implement per-model forward passes
+    return module
+
+
+def _forward_batch(module, inputs, memory_manager=None):
+    """One forward pass over equally shaped chunks, normalising each the way demucs' apply_model does"""
+    shape = (len(inputs),) + inputs[0].shape
+    if memory_manager is not None:
+        batch = memory_manager.workspace('batch_input', shape)
+    else:
+        batch = np.empty(shape, dtype=np.float32)
+    for index, audio in enumerate(inputs):
+        batch[index] = audio
+    logger.info(f"Running batched separation on audio shape: {batch.shape}")
+
+    reference = batch.mean(axis=1)  # [batch, frames]
+    means = reference.mean(axis=-1)[:, None, None]
+    stds = reference.std(axis=-1)[:, None, None] + 1e-8
+    batch -= means
+    batch /= stds
+
+    try:
+        with torch.no_grad():
+            output = module(torch.from_numpy(batch)).cpu().numpy()  # [batch, stems, channels, frames]
+    finally:
+        if memory_manager is not None:
+            memory_manager.check()
+    output *= stds[:, None]
+    output += means[:, None]
+
+    return [
+        {name: output[index, stem_index] for stem_index, name in enumerate(module.sources)}
+        for index in range(len(inputs))
+    ]
+
+
+def _batch_parity(batched, expected):
+    """Largest difference between batched stems and predict()'s, inf if they do not line up"""
+    error = 0.0
+    for got, want in zip(batched, expected):
+        if set(got) != set(want):
+            return float('inf')
+        for name, stem in want.items():
+            stem = np.asarray(stem)
+            if got[name].shape != stem.shape:
+                return float('inf')
+            error = max(error, float(np.abs(got[name] - stem).max(initial=0.0)))
+    return error
+
+
+def separate_batch(model, audio_batch, sr, memory_manager=None, max_seconds=1.0):
+    """Separate several equally shaped [channels, frames] chunks; returns one stem dict per chunk.
+
+    Demucs-style modules can take the whole batch in one forward pass, but
+    predict() may split, pad or normalise differently. The first batch of a
+    model therefore goes both ways: the forward pass is only used from then
+    on if it matches predict() within PARITY_TOLERANCE, and the result is kept
+    in model.batch_report. Other models get one predict call per chunk.
+    Chunks are capped at max_seconds like in separate_chunk().
+    """
+    report = getattr(model, 'batch_report', None)
+    module = _batchable_module(model)
+    if module is None or len(audio_batch) == 1 or (report is not None and not report['batched']):
+        return [separate_chunk(model, audio, sr, memory_manager, max_seconds) for audio in audio_batch]
+
+    max_samples = int(sr * max_seconds) if max_seconds is not None else None
+    inputs = [np.asarray(audio, dtype=np.float32)[..., :max_samples] for audio in audio_batch]
+    batched = _forward_batch(module, inputs, memory_manager)
+    if report is not None:
+        return batched
+
+    # Not proven yet: this batch is answered by predict(), which decides for the ones after it
+    expected = [separate_chunk(model, audio, sr, memory_manager, max_seconds) for audio in inputs]
+    error = _batch_parity(batched, expected)
+    model.batch_report = {'batched': bool(error <= PARITY_TOLERANCE), 'max_abs_error': error}
+    if model.batch_report['batched']:
+        logger.info(f"Batching {getattr(model, 'name', 'model')} in one forward pass (parity max {error:.2e})")
+    else:
+        logger.warning(f"Batched forward pass differs from predict by {error:.2e} (tolerance {PARITY_TOLERANCE}); "
+                       f"separating {getattr(model, 'name', 'model')} one chunk at a time")
+    return expected
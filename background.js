@@ -5,6 +5,77 @@ let websocket = null;
 let connectedTabId = null; // Tab ID that initiated the connection/separation
 let isConnecting = false; // Prevent multiple connection attempts simultaneously
 let pendingConfigureMessage = null; // To store config if CONFIGURE_MODEL arrives early
+let wireProtocol = 'json'; // Negotiated with the server via a 'hello' message
+
+// Binary frame layout, see backend/audio_protocol.py
+const FRAME_HEADER_SIZE = 24;
+const FRAME_PROTOCOL_VERSION = 1;
+const MSG_AUDIO_DATA = 1;
+const MSG_SEPARATED_AUDIO = 2;
+const DTYPE_FLOAT32 = 0;
+const DTYPE_FLOAT16 = 1;
+const DTYPE_INT16 = 2;
+const STEM_NAMES = ['mix', 'vocals', 'drums', 'bass', 'other', 'instrumental', 'remix'];
+let frameSeq = 0;
+
+function encodeAudioFrame(samples, sampleRate, channels, timestamp) {
+    const buffer = new ArrayBuffer(FRAME_HEADER_SIZE + samples.length * 4);
+    const view = new DataView(buffer);
+    view.setUint8(0, 0x41); // 'A'
+    view.setUint8(1, 0x53); // 'S'
+    view.setUint8(2, FRAME_PROTOCOL_VERSION);
+    view.setUint8(3, MSG_AUDIO_DATA);
+    view.setUint32(4, frameSeq, true);
+    view.setUint32(8, sampleRate, true);
+    view.setUint8(12, channels);
+    view.setUint8(13, DTYPE_FLOAT32);
+    view.setUint8(14, 0); // stem id 0 = original mix
+    view.setUint8(15, 0);
+    view.setFloat64(16, timestamp, true);
+    new Float32Array(buffer, FRAME_HEADER_SIZE).set(samples);
+    frameSeq = (frameSeq + 1) >>> 0;
+    return buffer;
+}
+
+function decodeSeparatedFrame(buffer) {
+    const view = new DataView(buffer);
+    if (view.getUint8(3) !== MSG_SEPARATED_AUDIO) {
+        throw new Error(`Unexpected binary message type: ${view.getUint8(3)}`);
+    }
+    return {
+        type: 'separated_audio',
+        seq: view.getUint32(4, true),
+        sample_rate: view.getUint32(8, true),
+        channels: view.getUint8(12),
+        stem: STEM_NAMES[view.getUint8(14)] || 'mix',
+        timestamp: view.getFloat64(16, true),
+        // chrome.runtime messaging is JSON based, so hand the tab a plain array
+        data: decodeSamples(buffer, view.getUint8(13))
+    };
+}
+
+function halfToFloat(bits) {
+    const sign = bits & 0x8000 ? -1 : 1;
+    const exponent = (bits >> 10) & 0x1f;
+    const fraction = bits & 0x3ff;
+    if (exponent === 0) return sign * fraction * 2 ** -24;
+    if (exponent === 0x1f) return fraction ? NaN : sign * Infinity;
+    return sign * (1 + fraction / 1024) * 2 ** (exponent - 15);
+}
+
+function decodeSamples(buffer, dtype) {
+    // chrome.runtime messaging is JSON based, so hand the tab a plain array of floats
+    if (dtype === DTYPE_FLOAT32) {
+        return Array.from(new Float32Array(buffer, FRAME_HEADER_SIZE));
+    }
+    if (dtype === DTYPE_FLOAT16) {
+        return Array.from(new Uint16Array(buffer, FRAME_HEADER_SIZE), halfToFloat);
+    }
+    if (dtype === DTYPE_INT16) {
+        return Array.from(new Int16Array(buffer, FRAME_HEADER_SIZE), sample => sample / 32768);
+    }
+    throw new Error(`Unsupported sample dtype: ${dtype}`);
+}
 
 function ensureWebSocketConnection() {
     return new Promise((resolve, reject) => {
@@ -46,6 +117,8 @@ function ensureWebSocketConnection() {
         }
 
         websocket = new WebSocket(WEBSOCKET_URL);
+        websocket.binaryType = 'arraybuffer';
+        wireProtocol = 'json';
 
         websocket.onopen = () => {
             isConnecting = false;
@@ -55,6 +128,9 @@ function ensureWebSocketConnection() {
                     .catch(err => console.warn("Could not send WS connected status to tab:", err));
             }
             
+            // Ask for binary audio frames; the server answers with a 'protocol' message
+            websocket.send(JSON.stringify({ type: 'hello', protocols: ['binary', 'json'] }));
+
             if (pendingConfigureMessage) {
                 console.log("Sending pending CONFIGURE_MODEL message:", pendingConfigureMessage);
                 if (websocket && websocket.readyState === WebSocket.OPEN) {
@@ -100,9 +176,21 @@ function ensureWebSocketConnection() {
 }
 
 function handleWebSocketMessage(event) {
-    console.log('Message from server:', event.data);
     try {
-        const message = JSON.parse(event.data);
+        let message;
+        if (event.data instanceof ArrayBuffer) {
+            message = decodeSeparatedFrame(event.data);
+        } else {
+            console.log('Message from server:', event.data);
+            message = JSON.parse(event.data);
+        }
+
+        if (message.type === 'protocol') {
+            wireProtocol = message.protocol;
+            console.log(`Using '${wireProtocol}' audio protocol.`);
+            return;
+        }
+
         // Prioritize sending to the specific tab that initiated separation if active
         let targetTabId = connectedTabId; // Use the currently active tab for separation context
 
@@ -118,7 +206,7 @@ function handleWebSocketMessage(event) {
                  .catch(err => console.warn("Could not send message to runtime (popup might be closed / no active tab):", err));
         }
     } catch (e) {
-        console.error("Failed to parse JSON from server or forward to client:", e, event.data);
+        console.error("Failed to decode message from server or forward to client:", e, event.data);
     }
 }
 
@@ -178,10 +266,19 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
         }
         return true; 
     } else if (message.type === 'AUDIO_DATA') {
+        if (wireProtocol === 'binary' && websocket && websocket.readyState === WebSocket.OPEN) {
+            websocket.send(encodeAudioFrame(
+                message.data.data,
+                message.data.sample_rate,
+                message.data.channels,
+                Date.now()
+            ));
+            return false;
+        }
         const serverMessage = {
             type: 'audio_data',
             data: message.data.data,
-            sample_rate: message.data.sampleRate,
+            sample_rate: message.data.sample_rate,
             channels: message.data.channels,
             audio_format: message.data.audio_format,
             timestamp: Date.now() 
@@ -194,6 +291,19 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
             // sendResponse({ error: 'WebSocket not open.' });
         }
         return false; // No async response needed for this primarily fire-and-forget message
+    } else if (message.type === 'UPDATE_GAINS') {
+        if (websocket && websocket.readyState === WebSocket.OPEN) {
+            websocket.send(JSON.stringify({ type: 'set_gains', gains: message.gains }));
+        }
+        return false;
+    } else if (message.type === 'UPDATE_SUBSCRIPTION') {
+        if (websocket && websocket.readyState === WebSocket.OPEN) {
+            websocket.send(JSON.stringify({ type: 'subscribe', stems: message.stems }));
+            sendResponse({ status: 'Subscription sent.' });
+        } else {
+            sendResponse({ error: 'WebSocket not open.' });
+        }
+        return false;
     } else if (message.type === 'STOP_WEBSOCKET') {
         disconnectWebSocket();
         sendResponse({ status: 'WebSocket disconnected by request.' });
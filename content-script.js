@@ -6,6 +6,19 @@ console.log('Music Separator content script loaded.');
 let separatedInstrumentalSource = null;
 let instrumentalGainNode = null;
 
+// Unseparated audio the server sends when it had to drop a chunk to keep up
+let separatedMixSource = null;
+let mixGainNode = null;
+
+// Slider volumes; a stem at 0 is dropped from the server-side subscription
+let stemVolumes = { vocals: 1.0, instrumental: 1.0 };
+
+// 'remix' (default): the server applies stemVolumes as gains and sends one mixed stream.
+// 'stems': every subscribed stem arrives separately and is mixed here with gain nodes.
+// Set per start with config.outputMode.
+let outputMode = 'remix';
+let separatedRemixSource = null;
+
 
 let audioContext = null;
 let audioSourceNode = null;
@@ -112,8 +125,11 @@ async function setupAudioProcessing() {
         vocalsGainNode = audioContext.createGain();
         instrumentalGainNode = audioContext.createGain();
 
+        mixGainNode = audioContext.createGain();
+
         vocalsGainNode.connect(audioContext.destination);
         instrumentalGainNode.connect(audioContext.destination);
+        mixGainNode.connect(audioContext.destination);
 
         console.log('Audio processing setup complete.');
         return true;
@@ -129,19 +145,37 @@ async function setupAudioProcessing() {
     }
 }
 
-function playSeparatedStem(stemName, audioBufferArray) {
+function playSeparatedStem(stemName, audioBufferArray, channels = 1) {
     if (!audioContext || audioContext.state === 'closed' || !audioBufferArray) return;
 
-    const buffer = audioContext.createBuffer(
-        1, // Number of channels (assuming mono stems for now)
-        audioBufferArray.length,
-        audioContext.sampleRate
-    );
-    buffer.copyToChannel(Float32Array.from(audioBufferArray), 0);
+    // Multi-channel audio arrives interleaved
+    const frames = Math.floor(audioBufferArray.length / channels);
+    const buffer = audioContext.createBuffer(channels, frames, audioContext.sampleRate);
+    if (channels === 1) {
+        buffer.copyToChannel(Float32Array.from(audioBufferArray), 0);
+    } else {
+        for (let ch = 0; ch < channels; ch++) {
+            const channelData = buffer.getChannelData(ch);
+            for (let i = 0; i < frames; i++) {
+                channelData[i] = audioBufferArray[i * channels + ch];
+            }
+        }
+    }
 
     const sourceNode = audioContext.createBufferSource();
     sourceNode.buffer = buffer;
 
+    if (stemName === 'remix') {
+        // Gains were already applied on the server; a fallback chunk still playing gives way
+        if (separatedRemixSource) separatedRemixSource.stop();
+        if (separatedMixSource) separatedMixSource.stop();
+        separatedMixSource = null;
+        separatedRemixSource = sourceNode;
+        sourceNode.connect(audioContext.destination);
+        sourceNode.start();
+        return;
+    }
+
     let gainNode;
     if (stemName === 'vocals') {
         if (separatedVocalsSource) separatedVocalsSource.stop();
@@ -154,6 +188,18 @@ function playSeparatedStem(stemName, audioBufferArray) {
         separatedInstrumentalSource = sourceNode;
         gainNode = instrumentalGainNode;
     }
+    else if (stemName === 'mix') {
+        // Fallback chunk: the original audio stands in for all stems
+        if (separatedVocalsSource) separatedVocalsSource.stop();
+        if (separatedInstrumentalSource) separatedInstrumentalSource.stop();
+        if (separatedRemixSource) separatedRemixSource.stop();
+        if (separatedMixSource) separatedMixSource.stop();
+        separatedVocalsSource = null;
+        separatedInstrumentalSource = null;
+        separatedRemixSource = null;
+        separatedMixSource = sourceNode;
+        gainNode = mixGainNode;
+    }
 
     if (gainNode) {
         sourceNode.connect(gainNode);
@@ -181,7 +227,12 @@ async function startSeparation(config) {
     // Configure model on backend
     // If config from popup contains modelConfig, use it, otherwise default to hdemucs_mmi
     const modelConfig = config?.modelConfig || { model: 'hdemucs_mmi', realTime: true };
-    await chrome.runtime.sendMessage({ type: 'CONFIGURE_MODEL', config: modelConfig });
+    if (config?.stemVolumes) stemVolumes = { ...stemVolumes, ...config.stemVolumes };
+    outputMode = config?.outputMode === 'stems' ? 'stems' : 'remix';
+    await chrome.runtime.sendMessage({
+        type: 'CONFIGURE_MODEL',
+        config: { ...modelConfig, stems: subscribedStems(), output: outputMode, gains: stemVolumes }
+    });
 
     if (audioElement) audioElement.muted = true; // Mute original audio
     if (workletNode) workletNode.connect(audioContext.destination); // This line is tricky. If the worklet passes audio through, this makes sense. If not, it shouldn't be connected. Our current worklet just buffers and sends.
@@ -211,8 +262,12 @@ function stopSeparation() {
 
     if (separatedVocalsSource) separatedVocalsSource.stop();
     if (separatedInstrumentalSource) separatedInstrumentalSource.stop();
+    if (separatedMixSource) separatedMixSource.stop();
+    if (separatedRemixSource) separatedRemixSource.stop();
     separatedVocalsSource = null;
     separatedInstrumentalSource = null;
+    separatedMixSource = null;
+    separatedRemixSource = null;
 
 
     isSeparationActive = false;
@@ -221,8 +276,24 @@ function stopSeparation() {
     return { status: 'Separation stopped.' };
 }
 
+function subscribedStems() {
+    return Object.keys(stemVolumes).filter(stemName => stemVolumes[stemName] > 0);
+}
+
 function setStemVolume(stemName, volume) { // volume is 0.0 to 1.0
     console.log(`Setting volume for ${stemName} to ${volume}`);
+
+    // Only tell the server when a stem is switched off or back on, not on every slider step
+    const wasAudible = stemVolumes[stemName] > 0;
+    stemVolumes[stemName] = volume;
+    if (isSeparationActive && outputMode === 'remix') {
+        chrome.runtime.sendMessage({ type: 'UPDATE_GAINS', gains: { [stemName]: volume } })
+            .catch(err => console.error('Error updating remix gains:', err));
+    } else if (isSeparationActive && wasAudible !== (volume > 0)) {
+        chrome.runtime.sendMessage({ type: 'UPDATE_SUBSCRIPTION', stems: subscribedStems() })
+            .catch(err => console.error('Error updating stem subscription:', err));
+    }
+
     if (!audioContext || audioContext.state === 'closed') return;
     
     let gainNode;
@@ -240,6 +311,13 @@ function setStemVolume(stemName, volume) { // volume is 0.0 to 1.0
     if (gainNode) {
         gainNode.gain.setValueAtTime(volume, audioContext.currentTime);
     }
+
+    // The mix contains every stem, so play it at the louder of the two stem volumes
+    if (gainNode && mixGainNode) {
+        const otherGainNode = gainNode === vocalsGainNode ? instrumentalGainNode : vocalsGainNode;
+        const mixVolume = Math.max(volume, otherGainNode.gain.value);
+        mixGainNode.gain.setValueAtTime(mixVolume, audioContext.currentTime);
+    }
 }
 
 // Listen for messages from the background script or popup
@@ -264,7 +342,7 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
     } else if (message.type === 'separated_audio') {
         // This is where we receive processed audio from the backend (via background.js)
         console.log('Received separated audio:', message.stem, /*message.data?.length*/); // Avoid error if data is missing
-        playSeparatedStem(message.stem, message.data);
+        playSeparatedStem(message.stem, message.data, message.channels || 1);
         sendResponse({status: "Stem received by content script"});
     } else if (message.type === 'WEBSOCKET_STATUS') {
         console.log('WebSocket status update from background:', message.status, message.error || '');